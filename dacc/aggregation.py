@@ -1,27 +1,210 @@
 from dacc.models import (
     RawMeasure,
     Aggregation,
+    PeriodAggregation,
     AggregationDate,
     MeasureDefinition,
     RefusedRawMeasure,
     tuple_as_dict,
 )
-from dacc import db, validate
-from sqlalchemy import func, bindparam, update
+from dacc import db, validate, staging, configdata
+from dacc.sketch import QuantileSketch
+from dacc.consts import SQL_AGGREGATION
+from dacc.utils import truncate_date
+from sqlalchemy import func, bindparam, insert, update, text
+from sqlalchemy import and_, case, cast, column, literal, tuple_, values
+from sqlalchemy.dialects.postgresql import JSONB
 from datetime import datetime
 from copy import copy
+from decimal import Decimal
+import numpy as np
 import math
 import logging
 import time
-import numpy as np
 import json
 from typing import Any, List
 
+EXISTING_AGGREGATES_BATCH_SIZE = 1000
+GROUPS = ["group1", "group2", "group3"]
+JSONB_NULL = text("'null'::jsonb")
+# The merged columns loaded as floats. The sums are kept as Decimal, so
+# that the moments stay exact.
+FLOAT_MERGED_COLUMNS = ("count", "count_not_zero", "min", "max", "avg", "std")
+
+# Aggregate the raw measures and merge them with the existing aggregates,
+# as compute_partial_aggregates does: the std is derived from the sum of
+# squares, unless the existing aggregate has none. The empty and null keys
+# are grouped together, as they are the same key for the unique index. In
+# the DO UPDATE clause, the agg columns are the existing values and
+# EXCLUDED the new aggregate. Only the keys of the inserted aggregates are
+# returned, or of all the upserted ones with :with_updated_keys.
+UPSERT_AGGREGATES_SQL = text(
+    """
+    WITH upserted AS (
+        INSERT INTO aggregation AS agg (
+            measure_name, start_date, created_by, group1, group2, group3,
+            count, count_not_zero, sum, min, max, avg, std, sum_of_squares,
+            last_updated
+        )
+        SELECT
+            :measure_name,
+            start_date,
+            nullif(created_by, ''),
+            nullif(group1, 'null'::jsonb),
+            nullif(group2, 'null'::jsonb),
+            nullif(group3, 'null'::jsonb),
+            count(value), count(nullif(value, 0)), sum(value), min(value),
+            max(value), avg(value), coalesce(stddev(value), 0),
+            sum(value * value), now()
+        FROM raw_measure
+        WHERE measure_name = :measure_name
+            AND last_updated > :start_date
+            AND last_updated <= :end_date
+        GROUP BY 2, 3, 4, 5, 6
+        ON CONFLICT (
+            measure_name,
+            start_date,
+            coalesce(created_by, ''),
+            coalesce(group1, 'null'::jsonb),
+            coalesce(group2, 'null'::jsonb),
+            coalesce(group3, 'null'::jsonb)
+        ) DO UPDATE SET
+            count = agg.count + EXCLUDED.count,
+            count_not_zero = agg.count_not_zero + EXCLUDED.count_not_zero,
+            sum = agg.sum + EXCLUDED.sum,
+            min = least(agg.min, EXCLUDED.min),
+            max = greatest(agg.max, EXCLUDED.max),
+            avg = (agg.sum + EXCLUDED.sum) / (agg.count + EXCLUDED.count),
+            sum_of_squares = agg.sum_of_squares + EXCLUDED.sum_of_squares,
+            std = CASE
+                WHEN agg.sum_of_squares IS NULL THEN sqrt(
+                    (
+                        (agg.count - 1) * power(agg.std, 2)
+                        + (EXCLUDED.count - 1) * power(EXCLUDED.std, 2)
+                        + agg.count * power(
+                            agg.avg - (agg.sum + EXCLUDED.sum)
+                            / (agg.count + EXCLUDED.count),
+                            2
+                        )
+                        + EXCLUDED.count * power(
+                            EXCLUDED.avg - (agg.sum + EXCLUDED.sum)
+                            / (agg.count + EXCLUDED.count),
+                            2
+                        )
+                    )
+                    / (agg.count + EXCLUDED.count - 1)
+                )
+                ELSE sqrt(greatest(
+                    (
+                        agg.sum_of_squares + EXCLUDED.sum_of_squares
+                        - power(agg.sum + EXCLUDED.sum, 2)
+                        / (agg.count + EXCLUDED.count)
+                    )
+                    / (agg.count + EXCLUDED.count - 1),
+                    0
+                ))
+            END,
+            last_updated = now()
+        RETURNING
+            agg.start_date, agg.created_by, agg.group1, agg.group2, agg.group3,
+            (xmax = 0) AS inserted
+    )
+    SELECT start_date, created_by, group1, group2, group3, inserted
+    FROM upserted
+    WHERE inserted OR :with_updated_keys
+    """
+)
+
+# Merge the aggregates of each period into a period aggregate, replacing
+# the existing one. A missing sum of squares is estimated from the std.
+# The {keys_join} restricts the period aggregates to merge.
+PERIOD_AGGREGATES_SQL = """
+    INSERT INTO period_aggregation AS agg (
+        measure_name, period, start_date, created_by, group1, group2, group3,
+        count, count_not_zero, sum, min, max, avg, std, sum_of_squares,
+        last_updated
+    )
+    SELECT
+        :measure_name,
+        :period,
+        date_trunc(:period, a.start_date),
+        nullif(a.created_by, ''),
+        nullif(a.group1, 'null'::jsonb),
+        nullif(a.group2, 'null'::jsonb),
+        nullif(a.group3, 'null'::jsonb),
+        sum(a.count),
+        sum(a.count_not_zero),
+        sum(a.sum),
+        min(a.min),
+        max(a.max),
+        sum(a.sum) / sum(a.count),
+        CASE WHEN sum(a.count) < 2 THEN 0 ELSE sqrt(greatest(
+            (
+                sum(a.sum_of_squares_or_estimate)
+                - power(sum(a.sum), 2) / sum(a.count)
+            )
+            / (sum(a.count) - 1),
+            0
+        )) END,
+        sum(a.sum_of_squares_or_estimate),
+        now()
+    FROM (
+        SELECT *, coalesce(
+            sum_of_squares,
+            (count - 1) * power(coalesce(std, 0), 2) + power(sum, 2) / count
+        ) AS sum_of_squares_or_estimate
+        FROM aggregation
+        WHERE measure_name = :measure_name AND count > 0
+    ) AS a
+    {keys_join}
+    GROUP BY 3, 4, 5, 6, 7
+    ON CONFLICT (
+        measure_name,
+        period,
+        start_date,
+        coalesce(created_by, ''),
+        coalesce(group1, 'null'::jsonb),
+        coalesce(group2, 'null'::jsonb),
+        coalesce(group3, 'null'::jsonb)
+    )
+    DO UPDATE SET
+        count = EXCLUDED.count,
+        count_not_zero = EXCLUDED.count_not_zero,
+        sum = EXCLUDED.sum,
+        min = EXCLUDED.min,
+        max = EXCLUDED.max,
+        avg = EXCLUDED.avg,
+        std = EXCLUDED.std,
+        sum_of_squares = EXCLUDED.sum_of_squares,
+        last_updated = now()
+"""
+
+# The period aggregate keys given as a JSON array, see get_period_keys
+PERIOD_KEYS_JOIN = """
+    JOIN jsonb_to_recordset(CAST(:keys AS jsonb)) AS k(
+        start_date timestamp,
+        created_by text,
+        group1 jsonb,
+        group2 jsonb,
+        group3 jsonb
+    )
+    ON a.start_date >= k.start_date
+        AND a.start_date < k.start_date + CAST('1 ' || :period AS interval)
+        AND coalesce(a.created_by, '') = k.created_by
+        AND coalesce(a.group1, 'null'::jsonb)
+            = coalesce(k.group1, 'null'::jsonb)
+        AND coalesce(a.group2, 'null'::jsonb)
+            = coalesce(k.group2, 'null'::jsonb)
+        AND coalesce(a.group3, 'null'::jsonb)
+            = coalesce(k.group3, 'null'::jsonb)
+"""
+
 
 def aggregation_query(
     m_definition: MeasureDefinition,
     query_args: list,
     filter_args: list,
+    wildcard_groups: List[str] = None,
 ):
     """Execute aggregation query on database
 
@@ -29,6 +212,8 @@ def aggregation_query(
         m_definition (MeasureDefinition): The measure definition
         query_args (list): The query (select) arguments
         filter_args (list): The filter argument
+        wildcard_groups (List[str], optional): The groups not to group by.
+        Defaults to None.
 
     Returns:
         list(RawMeasure): the aggregated measures
@@ -36,22 +221,119 @@ def aggregation_query(
     return (
         db.session.query(*query_args)
         .filter(*filter_args)
-        .group_by(
-            RawMeasure.created_by,
-            RawMeasure.start_date,
-            RawMeasure.group1,
-            RawMeasure.group2,
-            RawMeasure.group3,
-        )
+        .group_by(*get_group_by_columns(wildcard_groups))
         .all()
     )
 
 
+def get_group_columns(
+    m_definition: MeasureDefinition, wildcard_groups: List[str] = None
+):
+    """Get the group columns to aggregate the raw measures on.
+
+    A wildcard group is replaced by its wildcard JSON, e.g. {"slug": "*"},
+    so that the measures are aggregated together for any value of this
+    group, as aggregates of the same shape as the others.
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        wildcard_groups (List[str], optional): The groups to wildcard.
+        Defaults to None.
+
+    Returns:
+        dict: The group column expressions, by group name
+    """
+    columns = {}
+    for group in GROUPS:
+        if wildcard_groups and group in wildcard_groups:
+            columns[group] = get_wildcard_column(m_definition, group)
+        else:
+            columns[group] = getattr(RawMeasure, group)
+    return columns
+
+
+def get_wildcard_column(m_definition: MeasureDefinition, group: str):
+    key = getattr(m_definition, "{}_key".format(group))
+    wildcard = json.dumps(generate_wildcard_json(key))
+    return cast(literal(wildcard), JSONB)
+
+
+def get_grouping_sets_group_columns(
+    m_definition: MeasureDefinition, grouping_sets: List[List[str]]
+):
+    """Get the group columns to aggregate the raw measures on, for several
+    wildcard groups combinations at once.
+
+    In a grouping set, a group that is not grouped by is NULL: the
+    GROUPING() flag tells it apart from a NULL group, to replace it by its
+    wildcard JSON. See get_group_columns.
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        grouping_sets (List[List[str]]): The wildcard groups of each
+        grouping set
+
+    Returns:
+        dict: The group column expressions, by group name
+    """
+    columns = {}
+    for group in GROUPS:
+        wildcards = [group in groups for groups in grouping_sets]
+        group_column = getattr(RawMeasure, group)
+        if all(wildcards):
+            columns[group] = get_wildcard_column(m_definition, group)
+        elif not any(wildcards):
+            columns[group] = group_column
+        else:
+            columns[group] = case(
+                (
+                    func.grouping(group_column) == 1,
+                    get_wildcard_column(m_definition, group),
+                ),
+                else_=group_column,
+            )
+    return columns
+
+
+def get_wildcard_groups(m_definition: MeasureDefinition, agg: Aggregation):
+    """Get the wildcard groups of an aggregate
+
+    Returns:
+        List[str]: The groups with a wildcard value
+    """
+    return [
+        group
+        for group in GROUPS
+        if getattr(agg, group)
+        == generate_wildcard_json(
+            getattr(m_definition, "{}_key".format(group))
+        )
+    ]
+
+
+def get_created_by_column():
+    """Get the creator to aggregate the raw measures on.
+
+    A NULL and an empty creator are the same key for the unique aggregate
+    index, hence they are grouped together, as in UPSERT_AGGREGATES_SQL.
+    """
+    return func.nullif(RawMeasure.created_by, text("''"))
+
+
+def get_group_by_columns(wildcard_groups: List[str] = None):
+    columns = [get_created_by_column(), RawMeasure.start_date]
+    for group in GROUPS:
+        if not wildcard_groups or group not in wildcard_groups:
+            columns.append(getattr(RawMeasure, group))
+    return columns
+
+
 def get_distributive_funcs_aggregation_query():
     return [
         func.count(RawMeasure.value).label("count"),
         func.count(func.nullif(RawMeasure.value, 0)).label("count_not_zero"),
         func.sum(RawMeasure.value).label("sum"),
+        func.sum(RawMeasure.value * RawMeasure.value).label("sum_of_squares"),
         func.min(RawMeasure.value).label("min"),
         func.max(RawMeasure.value).label("max"),
     ]
@@ -78,30 +360,44 @@ def get_quartiles_funcs_aggregation_query():
     ]
 
 
-def get_all_aggregations_query_args(with_quartiles: bool):
-    args = [
-        RawMeasure.created_by,
-        RawMeasure.start_date,
-        RawMeasure.group1,
-        RawMeasure.group2,
-        RawMeasure.group3,
-    ]
+def get_sketch_funcs_aggregation_query():
+    return [func.array_agg(RawMeasure.value).label("raw_values")]
+
+
+def has_quantile_sketch(m_definition: MeasureDefinition):
+    """Whether the quartiles of the measure are computed with a sketch"""
+    return bool(
+        m_definition.with_quartiles and m_definition.with_quantile_sketch
+    )
+
+
+def get_group_query_args(group_columns: dict = None):
+    args = [get_created_by_column().label("created_by"), RawMeasure.start_date]
+    if group_columns is None:
+        return args + [getattr(RawMeasure, group) for group in GROUPS]
+    return args + [group_columns[group].label(group) for group in GROUPS]
+
+
+def get_all_aggregations_query_args(
+    with_quartiles: bool, with_sketch: bool = False, group_columns=None
+):
+    args = get_group_query_args(group_columns)
     args += get_distributive_funcs_aggregation_query()
     args += get_algebraic_funcs_aggregation_query()
     if with_quartiles:
         args += get_quartiles_funcs_aggregation_query()
+    if with_sketch:
+        args += get_sketch_funcs_aggregation_query()
     return args
 
 
-def get_quartiles_aggregation_query_args():
-    args = [
-        RawMeasure.created_by,
-        RawMeasure.start_date,
-        RawMeasure.group1,
-        RawMeasure.group2,
-        RawMeasure.group3,
-    ]
+def get_quartiles_aggregation_query_args(
+    with_sketch: bool = False, group_columns=None
+):
+    args = get_group_query_args(group_columns)
     args += get_quartiles_funcs_aggregation_query()
+    if with_sketch:
+        args += get_sketch_funcs_aggregation_query()
     return args
 
 
@@ -115,21 +411,11 @@ def get_filters_all_aggregations(
     ]
 
 
-def get_filters_quartiles(
-    m_definition: MeasureDefinition, existing_agg: Aggregation, end_date: str
-):
-    return [
-        RawMeasure.measure_name == m_definition.name,
-        RawMeasure.start_date == existing_agg.start_date,
-        RawMeasure.last_updated <= end_date,
-        RawMeasure.group1 == existing_agg.group1,
-        RawMeasure.group2 == existing_agg.group2,
-        RawMeasure.group3 == existing_agg.group3,
-    ]
-
-
 def compute_all_aggregates_from_raw_measures(
-    m_definition: MeasureDefinition, start_date: str, end_date: str
+    m_definition: MeasureDefinition,
+    start_date: str,
+    end_date: str,
+    wildcard_groups: List[str] = None,
 ):
     """Compute all aggregates on raw measures for the given time interval.
 
@@ -137,6 +423,8 @@ def compute_all_aggregates_from_raw_measures(
         m_definition (MeasureDefinition): The measure definition
         start_date (str): The start date of the query
         end_date (str): The end date of the query
+        wildcard_groups (List[str], optional): The groups to wildcard, see
+        get_group_columns. Defaults to None.
 
     Returns:
         list(RawMeasure): the aggregated measures
@@ -146,39 +434,136 @@ def compute_all_aggregates_from_raw_measures(
     if end_date is None:
         end_date = datetime.now()
 
-    query_args = get_all_aggregations_query_args(m_definition.with_quartiles)
+    query_args = get_all_aggregations_query_args(
+        m_definition.with_quartiles,
+        has_quantile_sketch(m_definition),
+        get_group_columns(m_definition, wildcard_groups),
+    )
     filter_args = get_filters_all_aggregations(
         m_definition, start_date, end_date
     )
 
-    return aggregation_query(m_definition, query_args, filter_args)
+    return aggregation_query(
+        m_definition, query_args, filter_args, wildcard_groups
+    )
 
 
-def compute_quartiles_from_raw_measures(
-    m_definition: MeasureDefinition, existing_agg: Aggregation, end_date: str
+def compute_wildcard_aggregates_from_raw_measures(
+    m_definition: MeasureDefinition,
+    start_date: str,
+    end_date: str,
+    wildcard_groups_sets: List[List[str]],
+    with_base: bool = True,
 ):
-    """Compute quartiles aggregates on raw measures for the given time interval.
-    It is used to recompute an existing aggregate quartiles.
+    """Compute the aggregates of several wildcard groups combinations on raw
+    measures for the given time interval, in a single scan.
+
+    The raw measures are grouped by GROUPING SETS, one per combination, and
+    one without wildcard for the regular aggregates if `with_base` is set.
 
     Args:
         m_definition (MeasureDefinition): The measure definition
-        existing_agg (Aggregation): The existing aggregate to recompute
-        end_date (str): The last raw measure date to include.
+        start_date (str): The start date of the query
+        end_date (str): The end date of the query
+        wildcard_groups_sets (List[List[str]]): The groups to wildcard, for
+        each combination
+        with_base (bool, optional): Whether to compute the regular
+        aggregates too. Defaults to True.
 
     Returns:
-        RawMeasure: the computed quartiles
+        list(RawMeasure): the aggregated measures
     """
-    query_args = get_quartiles_aggregation_query_args()
-    filters_args = get_filters_quartiles(m_definition, existing_agg, end_date)
-    aggs = aggregation_query(
-        m_definition,
-        query_args,
-        filters_args,
+    grouping_sets = [list(groups) for groups in wildcard_groups_sets]
+    if with_base:
+        grouping_sets.insert(0, [])
+    if len(grouping_sets) == 0:
+        return []
+    if len(grouping_sets) == 1:
+        # A plain GROUP BY is enough
+        return compute_all_aggregates_from_raw_measures(
+            m_definition, start_date, end_date, grouping_sets[0]
+        )
+    if start_date is None:
+        start_date = datetime.min
+    if end_date is None:
+        end_date = datetime.now()
+
+    query_args = get_all_aggregations_query_args(
+        m_definition.with_quartiles,
+        has_quantile_sketch(m_definition),
+        get_grouping_sets_group_columns(m_definition, grouping_sets),
+    )
+    filter_args = get_filters_all_aggregations(
+        m_definition, start_date, end_date
+    )
+    return (
+        db.session.query(*query_args)
+        .filter(*filter_args)
+        .group_by(
+            func.grouping_sets(
+                *[
+                    tuple_(*get_group_by_columns(groups))
+                    for groups in grouping_sets
+                ]
+            )
+        )
+        .all()
     )
 
-    if len(aggs) > 0:
-        return aggs[0]
-    return None
+
+def compute_quartiles_from_raw_measures(
+    m_definition: MeasureDefinition,
+    aggregates: List[Aggregation],
+    end_date: str,
+    wildcard_groups: List[str] = None,
+):
+    """Compute quartiles aggregates on raw measures for the given aggregates.
+    It is used to recompute the quartiles of existing aggregates.
+
+    The quartiles of all the aggregates are computed with a grouped query
+    per batch of `EXISTING_AGGREGATES_BATCH_SIZE` aggregates, joined with
+    the raw measures on the aggregate keys.
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        aggregates (List[Aggregation]): The existing aggregates to recompute
+        end_date (str): The last raw measure date to include.
+        wildcard_groups (List[str], optional): The wildcard groups of the
+        aggregates. Defaults to None.
+
+    Returns:
+        dict: The computed quartiles, by aggregate key
+    """
+    group_columns = get_group_columns(m_definition, wildcard_groups)
+    quartiles = {}
+    batch_size = EXISTING_AGGREGATES_BATCH_SIZE
+    for start in range(0, len(aggregates), batch_size):
+        end = start + batch_size
+        batch = aggregates[start:end]
+        keys = get_aggregate_keys_values(batch)
+        start_dates = [agg.start_date for agg in batch]
+        filter_args = [
+            RawMeasure.measure_name == m_definition.name,
+            RawMeasure.last_updated <= end_date,
+            # Narrow the raw measures before the join
+            RawMeasure.start_date >= min(start_dates),
+            RawMeasure.start_date <= max(start_dates),
+        ]
+        join_on = get_aggregate_keys_join(RawMeasure, keys, group_columns)
+        rows = (
+            db.session.query(
+                *get_quartiles_aggregation_query_args(
+                    has_quantile_sketch(m_definition), group_columns
+                )
+            )
+            .join(keys, and_(*join_on))
+            .filter(*filter_args)
+            .group_by(*get_group_by_columns(wildcard_groups))
+            .all()
+        )
+        for row in rows:
+            quartiles[build_aggregate_key(row)] = row
+    return quartiles
 
 
 def get_new_aggregation_date(m_definition: MeasureDefinition, date: str):
@@ -257,6 +642,23 @@ def compute_grouped_std(
     return math.sqrt(v)  # return std
 
 
+def compute_std_from_moments(count: int, sum: float, sum_of_squares: float):
+    """Compute sampled standard deviation from the moments of the values.
+
+    Args:
+        count (int): The number of values
+        sum (float): The sum of the values
+        sum_of_squares (float): The sum of the squared values
+
+    Returns:
+        float: sampled standard deviation
+    """
+    if count < 2:
+        return 0
+    variance = (sum_of_squares - sum * sum / count) / (count - 1)
+    return math.sqrt(max(variance, 0))
+
+
 def compute_partial_aggregates(
     measure_name: str, current_agg: Aggregation, new_agg: Aggregation
 ):
@@ -296,13 +698,119 @@ def compute_partial_aggregates(
     agg.max = max(agg.max, new_agg.max)
     # XXX - The mean could be computed on restitution instead of storing it.
     agg.avg = (current_agg.sum + new_agg.sum) / agg.count
-    # XXX - Using variance might be more precise to avoid float rounds
-    # and std computed on restitution
-    agg.std = compute_grouped_std(current_agg, new_agg, agg.avg)
+    if (
+        current_agg.sum_of_squares is not None
+        and new_agg.sum_of_squares is not None
+    ):
+        agg.sum_of_squares = current_agg.sum_of_squares
+        agg.sum_of_squares += new_agg.sum_of_squares
+        agg.std = compute_std_from_moments(
+            agg.count, agg.sum, agg.sum_of_squares
+        )
+    else:
+        # The std is merged from the rounded ones
+        agg.sum_of_squares = None
+        agg.std = compute_grouped_std(current_agg, new_agg, agg.avg)
 
     return agg
 
 
+def to_decimal(value):
+    if value is None or isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+def merge_partial_aggregates(aggregates: list):
+    """Merge new aggregates with the existing ones, column-wise.
+
+    This is the bulk equivalent of compute_partial_aggregates: the
+    statistics of all the aggregates are loaded in NumPy arrays and merged
+    at once. The sum and the sum of squares are kept as Decimal, in object
+    arrays, so that the std derived from them is exact. The merged
+    statistics are set on the existing aggregates, which must be detached
+    copies, see AggregateRecord.
+
+    Args:
+        aggregates (list(tuple)): The (existing aggregate, new aggregate)
+        pairs, with the same keys
+
+    Returns:
+        list(AggregateRecord): The merged aggregates
+    """
+    if len(aggregates) == 0:
+        return []
+    current_aggs = [current_agg for current_agg, _ in aggregates]
+
+    current = {}
+    new = {}
+    for name in FLOAT_MERGED_COLUMNS:
+        current[name] = np.array(
+            [getattr(agg, name) for agg, _ in aggregates], dtype=float
+        )
+        new[name] = np.array(
+            [getattr(agg, name) for _, agg in aggregates], dtype=float
+        )
+    for name in ("sum", "sum_of_squares"):
+        current[name] = np.array(
+            [to_decimal(getattr(agg, name)) for agg, _ in aggregates],
+            dtype=object,
+        )
+        new[name] = np.array(
+            [to_decimal(getattr(agg, name)) for _, agg in aggregates],
+            dtype=object,
+        )
+
+    count = current["count"] + new["count"]
+    merged = {
+        "count": count.astype(int),
+        "count_not_zero": (
+            current["count_not_zero"] + new["count_not_zero"]
+        ).astype(int),
+        "min": np.minimum(current["min"], new["min"]),
+        "max": np.maximum(current["max"], new["max"]),
+        "sum": current["sum"] + new["sum"],
+    }
+    # Python ints, to divide the Decimal sums
+    int_count = merged["count"].astype(object)
+    merged["avg"] = merged["sum"] / int_count
+
+    with_moments = ~(
+        np.equal(current["sum_of_squares"], None)
+        | np.equal(new["sum_of_squares"], None)
+    )
+    sum_of_squares = np.where(
+        with_moments,
+        np.where(with_moments, current["sum_of_squares"], 0)
+        + np.where(with_moments, new["sum_of_squares"], 0),
+        None,
+    )
+    merged["sum_of_squares"] = sum_of_squares
+    # The variance is computed in Decimal, without cancellation
+    several = count > 1
+    variance = (
+        np.where(with_moments, sum_of_squares, 0)
+        - merged["sum"] * merged["sum"] / int_count
+    ) / np.where(several, int_count - 1, 1)
+    variance = variance.astype(float)
+    # The std is merged from the rounded ones without sum of squares
+    merged_avg = merged["avg"].astype(float)
+    grouped_variance = (
+        (current["count"] - 1) * current["std"] ** 2
+        + (new["count"] - 1) * new["std"] ** 2
+        + current["count"] * (current["avg"] - merged_avg) ** 2
+        + new["count"] * (new["avg"] - merged_avg) ** 2
+    ) / np.where(several, count - 1, 1)
+    variance = np.where(with_moments, variance, grouped_variance)
+    merged["std"] = np.where(several, np.sqrt(np.maximum(variance, 0)), 0)
+
+    columns = {name: merged[name].tolist() for name in merged}
+    for i, agg in enumerate(current_aggs):
+        for name, merged_values in columns.items():
+            setattr(agg, name, merged_values[i])
+    return current_aggs
+
+
 def aggregate_to_insert(m_definition: MeasureDefinition, agg: Aggregation):
     if type(agg) is not dict:
         agg = agg._mapping
@@ -321,15 +829,38 @@ def aggregate_to_insert(m_definition: MeasureDefinition, agg: Aggregation):
         max=agg["max"],
         avg=agg["avg"],
         std=agg["std"],
+        sum_of_squares=agg["sum_of_squares"],
     )
     if m_definition.with_quartiles is True:
         # Save quartiles only when explicitly declared
         new_agg.median = agg["median"]
         new_agg.first_quartile = agg["first_quartile"]
         new_agg.third_quartile = agg["third_quartile"]
+    if has_quantile_sketch(m_definition):
+        sketch = QuantileSketch.from_values(agg["raw_values"])
+        new_agg.quantile_sketch = sketch.to_json()
     return new_agg
 
 
+def merge_quantile_sketches(
+    agg: Aggregation, existing_agg: Aggregation, new_agg: Aggregation
+):
+    """Merge the quantile sketch of new aggregated measures with the one of
+    the existing aggregate, and update the quartiles accordingly.
+
+    Args:
+        agg (Aggregation): The merged aggregate, to update
+        existing_agg (Aggregation): The existing aggregate, with a sketch
+        new_agg (Aggregation): The aggregated measures, with their values
+    """
+    sketch = QuantileSketch.from_json(existing_agg.quantile_sketch)
+    sketch = sketch.merge(QuantileSketch.from_values(new_agg.raw_values))
+    agg.quantile_sketch = sketch.to_json()
+    agg.median = sketch.quantile(0.5)
+    agg.first_quartile = sketch.quantile(0.25)
+    agg.third_quartile = sketch.quantile(0.75)
+
+
 def aggregate_to_update(m_definition: MeasureDefinition, agg: Aggregation):
     aggregate = {
         "b_id": agg.id,  # "id" cannot be mapped by SQLAlchemy
@@ -340,6 +871,7 @@ def aggregate_to_update(m_definition: MeasureDefinition, agg: Aggregation):
         "max": agg.max,
         "avg": agg.avg,
         "std": agg.std,
+        "sum_of_squares": agg.sum_of_squares,
         "last_updated": datetime.now(),  # TODO: should be a trigger
     }
     if m_definition.with_quartiles:
@@ -347,75 +879,132 @@ def aggregate_to_update(m_definition: MeasureDefinition, agg: Aggregation):
         aggregate["median"] = agg.median
         aggregate["first_quartile"] = agg.first_quartile
         aggregate["third_quartile"] = agg.third_quartile
+    if has_quantile_sketch(m_definition):
+        aggregate["quantile_sketch"] = agg.quantile_sketch
     return aggregate
 
 
+class AggregateRecord:
+    """A lightweight copy of an aggregate row, not tracked by the session.
+
+    The columns missing from the row, e.g. the quartiles of a period
+    aggregate, are None.
+    """
+
+    __slots__ = tuple(c.name for c in Aggregation.__table__.columns)
+
+    def __init__(self, row):
+        for name in self.__slots__:
+            setattr(self, name, getattr(row, name, None))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def build_group_key(group):
+    """Build a hashable and canonical key for a JSON group
+
+    Args:
+        group (dict): The group
+
+    Returns:
+        tuple|str: The group key, or None if there is no group
+    """
+    if group is None:
+        return None
+    if type(group) is dict and all(type(v) is str for v in group.values()):
+        # Typical case, e.g. {"device": "mobile"}
+        return tuple(sorted(group.items()))
+    return json.dumps(group, sort_keys=True)
+
+
 def build_aggregate_key(agg: Aggregation):
     """Build a dict key to retrieve aggregates
 
     After querying existing aggregates, we store them in a dict
-    with a key used to retrieve them quickly, which is a concatenation
-    of the search terms.
+    with a key used to retrieve them quickly, which is a tuple
+    of the search terms. As in the unique aggregate key, a NULL
+    created_by is the same as an empty one.
 
     Args:
         agg (Aggregation): The aggregate to build the key on
 
     Returns:
-        str: The built key
-    """
-    date_key = agg.start_date.isoformat()
-    created_by_key = agg.created_by or "null"
-    group1_key = json.dumps(agg.group1)
-    group2_key = json.dumps(agg.group2)
-    group3_key = json.dumps(agg.group3)
-    key = (
-        date_key
-        + "_"
-        + created_by_key
-        + "_"
-        + group1_key
-        + "_"
-        + group2_key
-        + "_"
-        + group3_key
+        tuple: The built key
+    """
+    return (
+        agg.start_date,
+        agg.created_by or "",
+        build_group_key(agg.group1),
+        build_group_key(agg.group2),
+        build_group_key(agg.group3),
     )
-    return key
 
 
-def find_existing_aggregate(
-    existing_aggregates: List[Aggregation], new_agg: Aggregation
-):
-    key = build_aggregate_key(new_agg)
-    if key in existing_aggregates:
-        return existing_aggregates[key]
-    return None
+def find_existing_aggregate(existing_aggregates: dict, new_agg: Aggregation):
+    return existing_aggregates.get(build_aggregate_key(new_agg))
 
 
-def get_column_filter(grouped_measures: List[Aggregation], column: Any):
-    """Get the filter to apply to the given Aggregation column
+def get_aggregate_keys_values(aggregates: List[Aggregation]):
+    """Get the keys of the given aggregates, as a VALUES list
 
     Args:
-        grouped_measures (List[Aggregation]): The aggregated raw measures
-        column (Any): An Aggregation column
+        aggregates (List[Aggregation]): The aggregates
 
     Returns:
-        Filter: The filter to apply on this column
+        Values: The VALUES list, named keys
     """
-    column_name = column.name
-    values = np.unique(
+    return values(
+        column("start_date", db.TIMESTAMP),
+        column("created_by", db.String),
+        column("group1", JSONB(none_as_null=True)),
+        column("group2", JSONB(none_as_null=True)),
+        column("group3", JSONB(none_as_null=True)),
+        name="keys",
+    ).data(
         [
-            json.dumps(gm[column_name])
-            if type(gm[column_name]) is dict
-            else gm[column_name]
-            for gm in grouped_measures
-            if gm[column_name] is not None
+            (
+                agg.start_date,
+                agg.created_by,
+                agg.group1,
+                agg.group2,
+                agg.group3,
+            )
+            for agg in aggregates
         ]
-    ).tolist()
+    )
 
-    if len(values) == 0:
-        return column.is_(None)
-    else:
-        return column.in_(values)
+
+def get_aggregate_keys_join(model: Any, keys: Any, group_columns=None):
+    """Get the conditions to join a table with a VALUES list of keys
+
+    The expressions are the ones of the unique aggregate key, to use its
+    index on the aggregation table.
+
+    Args:
+        model (Any): The model to join, Aggregation or RawMeasure
+        keys (Any): The keys, see get_aggregate_keys_values
+        group_columns (dict, optional): The group columns of the model, see
+        get_group_columns. Defaults to the model columns.
+
+    Returns:
+        list: The join conditions
+    """
+    conditions = [
+        model.start_date == keys.c.start_date,
+        func.coalesce(model.created_by, text("''"))
+        == func.coalesce(keys.c.created_by, text("''")),
+    ]
+    for group in GROUPS:
+        if group_columns is None:
+            group_column = getattr(model, group)
+        else:
+            group_column = group_columns[group]
+        conditions.append(
+            func.coalesce(group_column, JSONB_NULL)
+            == func.coalesce(cast(keys.c[group], JSONB), JSONB_NULL)
+        )
+    return conditions
 
 
 def query_existing_aggregates(
@@ -423,32 +1012,40 @@ def query_existing_aggregates(
 ):
     """Query the existing aggregates based on aggregated raw measures.
 
+    The keys of the aggregated measures are given as a VALUES list, joined
+    with the aggregation table on the unique aggregate key, so only the
+    matching aggregates are fetched. The keys are sent by batches of
+    `EXISTING_AGGREGATES_BATCH_SIZE`.
+
     Args:
         measure_name (str): The measure name
         grouped_measures (List[Aggregation]): The list of aggregated measures
 
     Returns:
-        dict: A dict of existing aggregates
+        dict: The existing aggregates, as AggregateRecord, by key
     """
-    filters = [
-        Aggregation.measure_name == measure_name,
-    ]
-    filters.append(get_column_filter(grouped_measures, Aggregation.start_date))
-    filters.append(get_column_filter(grouped_measures, Aggregation.created_by))
-    filters.append(get_column_filter(grouped_measures, Aggregation.group1))
-    filters.append(get_column_filter(grouped_measures, Aggregation.group2))
-    filters.append(get_column_filter(grouped_measures, Aggregation.group3))
-
-    aggs = db.session.query(Aggregation).filter(*filters).all()
     existing_aggregates = {}
-    for agg in aggs:
-        key = build_aggregate_key(agg)
-        existing_aggregates[key] = agg
+    batch_size = EXISTING_AGGREGATES_BATCH_SIZE
+    for start in range(0, len(grouped_measures), batch_size):
+        end = start + batch_size
+        keys = get_aggregate_keys_values(grouped_measures[start:end])
+        join_on = [Aggregation.measure_name == measure_name]
+        join_on += get_aggregate_keys_join(Aggregation, keys)
+        aggs = (
+            db.session.query(Aggregation.__table__)
+            .join(keys, and_(*join_on))
+            .all()
+        )
+        for agg in aggs:
+            key = build_aggregate_key(agg)
+            existing_aggregates[key] = AggregateRecord(agg)
     return existing_aggregates
 
 
 def backup_rejected_raw_measures(
-    m_definition: MeasureDefinition, agg: Aggregation, end_date: str
+    m_definition: MeasureDefinition,
+    aggregates: List[Aggregation],
+    end_date: str,
 ):
     """Backup raw measures that cannot be aggregated.
 
@@ -456,27 +1053,415 @@ def backup_rejected_raw_measures(
     We block this aggregation and backup the involved raw measures
     in the RefusedRawMeasures table.
 
+    The raw measures are copied in database, with an INSERT ... SELECT per
+    batch of `EXISTING_AGGREGATES_BATCH_SIZE` aggregates, joined with the
+    raw measures on the aggregate keys.
+
     Args:
         m_definition (MeasureDefinition): The measure definition
-        agg (Aggregation): The computed aggregate
+        aggregates (List[Aggregation]): The rejected aggregates
         end_date (str): The end date to query raw measures
     """
-    m_filter = get_filters_quartiles(m_definition, agg, end_date)
-    measures = db.session.query(RawMeasure).filter(*m_filter).all()
-    for m in measures:
-        RefusedRawMeasure.insert_from_raw_measure(m)
+    columns = [
+        "measure_name",
+        "value",
+        "start_date",
+        "last_updated",
+        "aggregation_period",
+        "created_by",
+        "group1",
+        "group2",
+        "group3",
+    ]
+    batch_size = EXISTING_AGGREGATES_BATCH_SIZE
+    for start in range(0, len(aggregates), batch_size):
+        end = start + batch_size
+        keys = get_aggregate_keys_values(aggregates[start:end])
+        measures = (
+            db.session.query(*[getattr(RawMeasure, c) for c in columns])
+            .join(keys, and_(*get_aggregate_keys_join(RawMeasure, keys)))
+            .filter(
+                RawMeasure.measure_name == m_definition.name,
+                RawMeasure.last_updated <= end_date,
+            )
+            .order_by(RawMeasure.id)
+        )
+        db.session.execute(
+            insert(RefusedRawMeasure).from_select(columns, measures)
+        )
+
+    for agg in aggregates:
+        logging.error(
+            "Prevent aggregate quartiles on purged measures {} - {}".format(
+                m_definition.name, agg.start_date
+            )
+        )
+
+
+def find_chunk_end_date(
+    m_definition: MeasureDefinition,
+    start_date: datetime,
+    end_date: datetime,
+    chunk_size: int,
+):
+    """Find the end date of the next chunk of raw measures to aggregate.
+
+    The chunk includes the `chunk_size` raw measures following the start
+    date, by last_updated, plus the measures having the same last_updated
+    as the last one, since a chunk cannot end in the middle of them.
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        start_date (datetime): The chunk start date, excluded
+        end_date (datetime): The end date of all the chunks, included
+        chunk_size (int): The number of raw measures in a chunk
+
+    Returns:
+        datetime: The chunk end date, included
+    """
+    filter_args = get_filters_all_aggregations(
+        m_definition, start_date, end_date
+    )
+    chunk_end = (
+        db.session.query(RawMeasure.last_updated)
+        .filter(*filter_args)
+        .order_by(RawMeasure.last_updated)
+        .offset(chunk_size - 1)
+        .limit(1)
+        .first()
+    )
+    if chunk_end is None:
+        return end_date
+    return chunk_end[0]
+
+
+def save_aggregates_chunk(
+    m_definition: MeasureDefinition,
+    start_date: datetime,
+    end_date: datetime,
+    with_base: bool = True,
+):
+    """Aggregate the raw measures updated between two dates, and merge them
+    with the existing aggregates, without committing.
+
+    The wildcard aggregates declared in the measure definition are
+    aggregated in the same scan as the regular ones, and merged the same
+    way, so they are maintained from the new raw measures only.
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        start_date (datetime): The start date, excluded
+        end_date (datetime): The end date, included
+        with_base (bool, optional): Whether to save the regular aggregates,
+        or only the wildcard ones. Defaults to True.
+
+    Raises:
+        Exception: Any exception raised during the process.
+
+    Returns:
+        (list(Aggregation), list(Aggregation)): The aggregated tuples, and
+        all the inserted or updated aggregates
+    """
+    measure_name = m_definition.name
+    grouped_measures = compute_wildcard_aggregates_from_raw_measures(
+        m_definition,
+        start_date,
+        end_date,
+        m_definition.wildcard_groups or [],
+        with_base,
+    )
+    existing_aggregates = {}
+    if len(grouped_measures) > 0:
+        existing_aggregates = query_existing_aggregates(
+            measure_name, grouped_measures
+        )
+
+    aggs_to_merge = []
+    for gm in grouped_measures:
+        existing_agg = find_existing_aggregate(existing_aggregates, gm)
+        if existing_agg is not None:
+            aggs_to_merge.append((existing_agg, gm))
+    # The existing aggregates are merged in place, all at once
+    merge_partial_aggregates(aggs_to_merge)
+
+    all_aggregates = []
+    aggs_to_insert = []
+    aggs_to_update = []
+    aggs_with_quartiles = []
+    aggs_to_reject = []
+    for gm in grouped_measures:
+        agg = find_existing_aggregate(existing_aggregates, gm)
+
+        if agg is None:
+            # This will be an insert in the Aggregation table
+            agg = aggregate_to_insert(m_definition, gm)
+            aggs_to_insert.append(agg)
+            all_aggregates.append(agg)
+        else:
+            # This will be an update in the Aggregation table
+            if has_quantile_sketch(m_definition) and (
+                agg.quantile_sketch is not None
+            ):
+                # The quartiles are merged, no need for the raw measures
+                merge_quantile_sketches(agg, agg, gm)
+                all_aggregates.append(agg)
+            elif m_definition.with_quartiles:
+                if agg.last_raw_measures_purged:
+                    # Measures with quartiles should not be aggregated
+                    # after a purge, since raw values are deleted.
+                    aggs_to_reject.append(agg)
+                    continue
+
+                # We cannot compute partial aggregates for quartiles,
+                # thus all raw measures must be queried, see below.
+                aggs_with_quartiles.append(agg)
+                all_aggregates.append(agg)
+
+            aggs_to_update.append(agg)
+
+    # A wildcard aggregate has no raw measures of its own to back up
+    aggs_to_reject = [
+        agg
+        for agg in aggs_to_reject
+        if len(get_wildcard_groups(m_definition, agg)) == 0
+    ]
+    if len(aggs_to_reject) > 0:
+        backup_rejected_raw_measures(m_definition, aggs_to_reject, end_date)
+
+    if len(aggs_with_quartiles) > 0:
+        # Additional check might be necessary to deal with purge
+        aggs_by_wildcard_groups = {}
+        for agg in aggs_with_quartiles:
+            wildcard_groups = tuple(get_wildcard_groups(m_definition, agg))
+            aggs_by_wildcard_groups.setdefault(wildcard_groups, [])
+            aggs_by_wildcard_groups[wildcard_groups].append(agg)
+        quartiles = {}
+        for wildcard_groups, aggs in aggs_by_wildcard_groups.items():
+            quartiles.update(
+                compute_quartiles_from_raw_measures(
+                    m_definition, aggs, end_date, list(wildcard_groups)
+                )
+            )
+        for agg in aggs_with_quartiles:
+            agg_quartiles = quartiles.get(build_aggregate_key(agg))
+            if agg_quartiles is None:
+                raise Exception(
+                    "No quartile computed for {}"
+                    "on start_date {}".format(measure_name, agg.start_date)
+                )
+            agg.median = agg_quartiles.median
+            agg.first_quartile = agg_quartiles.first_quartile
+            agg.third_quartile = agg_quartiles.third_quartile
+            if has_quantile_sketch(m_definition):
+                # The aggregate had no sketch yet
+                sketch = QuantileSketch.from_values(agg_quartiles.raw_values)
+                agg.quantile_sketch = sketch.to_json()
+
+    saved_aggregates = aggs_to_insert + aggs_to_update
+    aggs_to_update = [
+        aggregate_to_update(m_definition, agg) for agg in aggs_to_update
+    ]
+
+    if len(aggs_to_insert) > 0:
+        # Insert all new aggregates
+        db.session.add_all(aggs_to_insert)
+
+    if len(aggs_to_update) > 0:
+        # Update all the existing aggregates
+        stmt = update(Aggregation).where(Aggregation.id == bindparam("b_id"))
+        db.session.execute(stmt, aggs_to_update)
+    return all_aggregates, saved_aggregates
+
+
+def get_period_keys(aggregates: list, period: str):
+    """Get the keys of the period aggregates including the given aggregates
+
+    Args:
+        aggregates (list): The aggregates, or their keys
+        period (str): The period (day, week, month)
+
+    Returns:
+        str: The distinct keys, as a JSON array
+    """
+    keys = set()
+    for agg in aggregates:
+        keys.add(
+            (
+                truncate_date(agg.start_date, period).isoformat(),
+                agg.created_by or "",
+                json.dumps(agg.group1),
+                json.dumps(agg.group2),
+                json.dumps(agg.group3),
+            )
+        )
+    return json.dumps(
+        [
+            {
+                "start_date": start_date,
+                "created_by": created_by,
+                "group1": json.loads(group1),
+                "group2": json.loads(group2),
+                "group3": json.loads(group3),
+            }
+            for start_date, created_by, group1, group2, group3 in keys
+        ]
+    )
+
+
+def update_period_aggregates(
+    m_definition: MeasureDefinition, aggregates: list = None
+):
+    """Merge the aggregates into the period aggregates declared in the
+    measure definition, without committing.
+
+    A period aggregate is recomputed from the aggregates of its period,
+    never from the raw measures. Only the period aggregates including the
+    given aggregates are recomputed, or all of them if none is given.
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        aggregates (list, optional): The saved aggregates, or their keys.
+        Defaults to None.
+
+    Returns:
+        int: The number of saved period aggregates
+    """
+    if aggregates is not None and len(aggregates) == 0:
+        return 0
+    keys_join = "" if aggregates is None else PERIOD_KEYS_JOIN
+    stmt = text(PERIOD_AGGREGATES_SQL.format(keys_join=keys_join))
+
+    n_aggregates = 0
+    for period in m_definition.rollup_periods or []:
+        params = {"measure_name": m_definition.name, "period": period}
+        if aggregates is not None:
+            params["keys"] = get_period_keys(aggregates, period)
+        result = db.session.execute(stmt, params)
+        n_aggregates += result.rowcount
+    return n_aggregates
+
+
+def compute_period_aggregates(m_definition: MeasureDefinition):
+    """Recompute all the period aggregates of a measure from its aggregates
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+
+    Returns:
+        int: The number of saved period aggregates
+    """
+    db.session.query(PeriodAggregation).filter(
+        PeriodAggregation.measure_name == m_definition.name
+    ).delete()
+    n_aggregates = update_period_aggregates(m_definition)
+    db.session.commit()
+    return n_aggregates
+
+
+def aggregate_raw_measures_chunk(
+    m_definition: MeasureDefinition, start_date: datetime, end_date: datetime
+):
+    """Aggregate the raw measures updated between two dates.
+
+    The aggregates, including the wildcard ones, are committed together
+    with the new AggregationDate, so that an aggregation can resume from
+    the last committed chunk.
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        start_date (datetime): The start date, excluded
+        end_date (datetime): The end date, included
+
+    Raises:
+        Exception: Any exception raised during the process.
+
+    Returns:
+        list(Aggregation): The aggregated tuples
+    """
+    start_time = time.time()
+
+    measure_name = m_definition.name
+    all_aggregates, saved_aggregates = save_aggregates_chunk(
+        m_definition, start_date, end_date
+    )
+    # The new aggregates must be flushed to be merged in the periods
+    db.session.flush()
+    update_period_aggregates(m_definition, saved_aggregates)
+
+    agg_date = get_new_aggregation_date(m_definition, end_date)
+
+    if agg_date is None:
+        raise Exception(
+            "No new aggregation date for measure {}".format(measure_name)
+        )
+    db.session.add(agg_date)
+    db.session.commit()
+
+    logging.debug(
+        "--- %s seconds to update aggregate---" % (time.time() - start_time)
+    )
+    return all_aggregates
+
+
+def upsert_raw_measures_chunk(
+    m_definition: MeasureDefinition, start_date: datetime, end_date: datetime
+):
+    """Aggregate the raw measures updated between two dates, in database.
 
-    logging.error(
-        "Prevent aggregate quartiles on purged measures {} - {}".format(
-            m_definition.name, agg.start_date
+    The raw measures are aggregated and merged with the existing aggregates
+    by a single upsert statement, so no raw measure is loaded in Python.
+    The quartiles cannot be merged this way, hence they are not computed.
+    The wildcard aggregates are maintained as in the python mode.
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        start_date (datetime): The start date, excluded
+        end_date (datetime): The end date, included
+
+    Returns:
+        list(Row): The keys of the inserted aggregates
+    """
+    start_time = time.time()
+
+    saved_aggregates = db.session.execute(
+        UPSERT_AGGREGATES_SQL,
+        {
+            "measure_name": m_definition.name,
+            "start_date": start_date,
+            "end_date": end_date,
+            # The updated keys are only needed for the period aggregates
+            "with_updated_keys": bool(m_definition.rollup_periods),
+        },
+    ).fetchall()
+    aggs = [agg for agg in saved_aggregates if agg.inserted]
+    if m_definition.wildcard_groups:
+        wildcard_aggs, saved_wildcard_aggs = save_aggregates_chunk(
+            m_definition, start_date, end_date, with_base=False
         )
+        aggs += wildcard_aggs
+        saved_aggregates += saved_wildcard_aggs
+        db.session.flush()
+    update_period_aggregates(m_definition, saved_aggregates)
+
+    agg_date = get_new_aggregation_date(m_definition, end_date)
+    db.session.add(agg_date)
+    db.session.commit()
+
+    logging.debug(
+        "--- %s seconds to upsert aggregate---" % (time.time() - start_time)
     )
+    return aggs
 
 
 def aggregate_raw_measures(m_definition: MeasureDefinition, force=False):
     """Aggregate raw measures on a time period and save them in the
     Aggregation table.
 
+    The raw measures are aggregated by chunks of about
+    `aggregation:chunk_size` measures, each one committed on its own. In
+    the `sql` aggregation mode, the chunks are aggregated in database,
+    except for measures with quartiles.
+
     Args:
         m_definition (MeasureDefinition): The measure definition
 
@@ -484,10 +1469,12 @@ def aggregate_raw_measures(m_definition: MeasureDefinition, force=False):
         Exception: Any exception raised during the process.
 
     Returns:
-        (list(Aggregation), str): The aggregated tuples and the last saved
+        (int, str): The number of saved aggregates and the last saved
         aggregated date
     """
     try:
+        if staging.is_staging_enabled():
+            staging.merge_staged_measures(m_definition.name)
         start_date, end_date = find_dates_bounds(m_definition)
         if end_date is None:
             # No measures to aggregate
@@ -504,88 +1491,29 @@ def aggregate_raw_measures(m_definition: MeasureDefinition, force=False):
             )
             return (None, None)
 
-        start_time = time.time()
-
-        measure_name = m_definition.name
-        grouped_measures = compute_all_aggregates_from_raw_measures(
-            m_definition, start_date, end_date
-        )
-        existing_aggregates = []
-        if len(grouped_measures) > 0:
-            existing_aggregates = query_existing_aggregates(
-                measure_name, grouped_measures
-            )
-
-        all_aggregates = []
-        aggs_to_insert = []
-        aggs_to_update = []
-        for gm in grouped_measures:
-            existing_agg = find_existing_aggregate(existing_aggregates, gm)
-
-            if existing_agg is None:
-                # This will be an insert in the Aggregation table
-                agg = aggregate_to_insert(m_definition, gm)
-                aggs_to_insert.append(agg)
-                all_aggregates.append(agg)
-            else:
-                # This will be an update in the Aggregation table
-                agg = compute_partial_aggregates(
-                    measure_name, existing_agg, gm
+        aggregate_chunk = aggregate_raw_measures_chunk
+        mode = configdata.get("aggregation:mode", "python")
+        if mode == SQL_AGGREGATION and not m_definition.with_quartiles:
+            aggregate_chunk = upsert_raw_measures_chunk
+
+        chunk_size = configdata.get("aggregation:chunk_size", 100000)
+        # Only counted, so that the aggregates of a chunk are not kept
+        n_aggregates = 0
+        chunk_start = start_date
+        while chunk_start < end_date:
+            chunk_end = end_date
+            if chunk_size:
+                chunk_end = find_chunk_end_date(
+                    m_definition, chunk_start, end_date, chunk_size
                 )
-                if m_definition.with_quartiles:
-                    if existing_agg.last_raw_measures_purged:
-                        # Measures with quartiles should not be aggregated
-                        # after a purge, since raw values are deleted.
-                        backup_rejected_raw_measures(
-                            m_definition, agg, end_date
-                        )
-                        continue
-
-                    # We cannot compute partial aggregates for quartiles,
-                    # thus all raw measures must be queried.
-                    # Additional check might be necessary to deal with purge
-                    quartiles = compute_quartiles_from_raw_measures(
-                        m_definition, existing_agg, end_date
-                    )
-                    if quartiles is None:
-                        raise Exception(
-                            "No quartile computed for {}"
-                            "on start_date {}".format(measure_name, start_date)
-                        )
-                    agg.median = quartiles.median
-                    agg.first_quartile = quartiles.first_quartile
-                    agg.third_quartile = quartiles.third_quartile
-                    all_aggregates.append(agg)
-
-                aggs_to_update.append(aggregate_to_update(m_definition, agg))
-
-        if len(aggs_to_insert) > 0:
-            # Insert all new aggregates
-            db.session.add_all(aggs_to_insert)
-
-        if len(aggs_to_update) > 0:
-            # Update all the existing aggregates
-            stmt = update(Aggregation).where(
-                Aggregation.id == bindparam("b_id")
+            n_aggregates += len(
+                aggregate_chunk(m_definition, chunk_start, chunk_end)
             )
-            db.session.execute(stmt, aggs_to_update)
-
-        agg_date = get_new_aggregation_date(m_definition, end_date)
-
-        if agg_date is None:
-            raise Exception(
-                "No new aggregation date for measure {}".format(measure_name)
-            )
-        db.session.add(agg_date)
-        db.session.commit()
-
-        logging.debug(
-            "--- %s seconds to update aggregate---"
-            % (time.time() - start_time)
-        )
-        return all_aggregates, agg_date.last_aggregated_measure_date
+            chunk_start = chunk_end
+        return n_aggregates, end_date
 
     except Exception as err:
+        db.session.rollback()
         print("Error while aggregating: " + repr(err))
 
 
@@ -616,71 +1544,44 @@ def compute_wildcard_aggregate(
     Returns:
         list(Aggregation): The inserted wildcard aggregates
     """
+    return compute_wildcard_aggregates(
+        m_definition, [wildcard_groups], from_date, to_date
+    )
 
-    # TODO: groups might be dynamics in the future
-    not_wildcard_groups = ["group1", "group2", "group3"]
-    for group in wildcard_groups:
-        not_wildcard_groups.remove(group)
 
-    query_args = [
-        RawMeasure.created_by,
-        RawMeasure.start_date,
-    ]
-    groupby_args = [RawMeasure.created_by, RawMeasure.start_date]
-
-    # TODO: could be improved by mapping column name
-    for group in not_wildcard_groups:
-        if group == "group1":
-            query_args.append(RawMeasure.group1)
-            groupby_args.append(RawMeasure.group1)
-        if group == "group2":
-            query_args.append(RawMeasure.group2)
-            groupby_args.append(RawMeasure.group2)
-        if group == "group3":
-            query_args.append(RawMeasure.group3)
-            groupby_args.append(RawMeasure.group3)
-
-    query_args += get_distributive_funcs_aggregation_query()
-    query_args += get_algebraic_funcs_aggregation_query()
-    if m_definition.with_quartiles is True:
-        query_args += get_quartiles_funcs_aggregation_query()
+def compute_wildcard_aggregates(
+    m_definition: MeasureDefinition,
+    wildcard_groups_sets: List[List[str]],
+    from_date: datetime,
+    to_date: datetime,
+):
+    """Compute wildcard aggregates for several groups combinations, in a
+    single scan of the raw measures. See compute_wildcard_aggregate.
 
-    filters_args = get_filters_all_aggregations(
-        m_definition, from_date, to_date
-    )
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        wildcard_groups_sets (List[List[str]]): The groups to wildcard, for
+        each combination
+        from_date (datetime): The starting date to query measures
+        to_date (datetime): The ending date to query measures
 
-    aggs = (
-        db.session.query(*query_args)
-        .filter(*filters_args)
-        .group_by(*groupby_args)
-        .all()
+    Returns:
+        list(Aggregation): The inserted wildcard aggregates
+    """
+    aggs = compute_wildcard_aggregates_from_raw_measures(
+        m_definition, from_date, to_date, wildcard_groups_sets, with_base=False
     )
 
     inserted_aggs = []
     for agg in aggs:
         measure = tuple_as_dict(agg)
-
-        # TODO: groups might be dynamics in the future
-        measure["group1"] = (
-            generate_wildcard_json(m_definition.group1_key)
-            if "group1" in wildcard_groups
-            else agg.group1
-        )
-        measure["group2"] = (
-            generate_wildcard_json(m_definition.group2_key)
-            if "group2" in wildcard_groups
-            else agg.group2
-        )
-        measure["group3"] = (
-            generate_wildcard_json(m_definition.group3_key)
-            if "group3" in wildcard_groups
-            else agg.group3
-        )
         existing_agg = Aggregation.query_aggregate_by_measure(
             m_definition.name, measure
         )
         if existing_agg is not None:
             db.session.delete(existing_agg)
+            # The inserts are flushed before the deletes otherwise
+            db.session.flush()
 
         agg_to_insert = aggregate_to_insert(m_definition, measure)
         db.session.add(agg_to_insert)
@@ -1,13 +1,16 @@
 import click
+import csv
 import sys
 import os
 import uuid
 import json
 import time
+import signal
+import threading
 from datetime import datetime, timedelta, date
 import warnings
-from dacc import dacc, db, aggregation, consts, insertion
-from tests.fixtures import fixtures
+from dacc import dacc, db, aggregation, configdata, consts, insertion
+from dacc import registry, scheduler, staging, validate
 from dacc.models import (
     MeasureDefinition,
     Auth,
@@ -182,7 +185,8 @@ def delete_aggregation(measure_name, start_date):
         for agg in aggs:
             db.session.delete(agg)
 
-        m_def_id = MeasureDefinition.query_by_name(measure_name).id
+        m_def = MeasureDefinition.query_by_name(measure_name)
+        m_def_id = m_def.id
         db.session.query(AggregationDate).filter(
             AggregationDate.measure_definition_id == m_def_id
         ).update({"last_aggregated_measure_date": start_date})
@@ -193,6 +197,10 @@ def delete_aggregation(measure_name, start_date):
             )
         )
         db.session.commit()
+        if m_def.rollup_periods:
+            # The period aggregates must not include the deleted aggregates
+            n_aggs = aggregation.compute_period_aggregates(m_def)
+            print("{} period aggregates recomputed".format(n_aggs))
 
     except Exception as err:
         print("Command failed: {}".format(repr(err)))
@@ -214,6 +222,9 @@ def insert_measure_definition_json(file_path):
         data = json.load(f)
         definitions = data["definitions"]
         for m_def in definitions:
+            validate.check_rollup_periods(
+                m_def.get("rollupPeriods"), m_def.get("aggregationPeriod")
+            )
             db_def = MeasureDefinition.query.get(m_def.get("id"))
             if db_def:
                 db_def.name = m_def.get("name")
@@ -231,10 +242,16 @@ def insert_measure_definition_json(file_path):
                 db_def.access_app = m_def.get("accessApp")
                 db_def.access_public = m_def.get("accessPublic")
                 db_def.with_quartiles = m_def.get("withQuartiles")
+                db_def.with_quantile_sketch = m_def.get(
+                    "withQuantileSketch", False
+                )
+                db_def.wildcard_groups = m_def.get("wildcardGroups")
+                db_def.rollup_periods = m_def.get("rollupPeriods")
             else:
                 insertion.insert_measure_definition(m_def)
                 print("New definition inserted: {}".format(m_def.get("name")))
 
+        registry.measure_definitions.notify_change()
         db.session.commit()
         print("Done.")
     except Exception as err:
@@ -252,6 +269,7 @@ def measures():
 @click.argument("fixture_type")
 def insert_fixtures_definition(fixture_type):
     """Insert fixture file in database"""
+    from tests.fixtures import fixtures
 
     if fixture_type == "raw":
         fixtures.insert_raw_measures_from_file()
@@ -262,6 +280,78 @@ def insert_fixtures_definition(fixture_type):
     db.session.commit()
 
 
+@measures.command("bulk-load")
+@click.argument("file_path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(["jsonl", "csv"]),
+    help="The file format. Defaults to the file extension.",
+)
+@click.option("-c", "--chunk_size", default=10000, show_default=True)
+def bulk_load(file_path, file_format, chunk_size):
+    """Load raw measures from a JSONL or CSV file with COPY
+
+    Each JSONL line is a measure, in the same format as the /measure API.
+    The CSV columns are the measure fields, with JSON-formatted groups.
+    """
+    if file_format is None:
+        file_format = "csv" if file_path.endswith(".csv") else "jsonl"
+    start_time = time.time()
+
+    def print_progress(n_loaded, n_rejected):
+        elapsed = time.time() - start_time
+        rate = n_loaded / elapsed if elapsed > 0 else 0
+        print(
+            "{} measures loaded, {} rejected ({:.0f} measures/s)".format(
+                n_loaded, n_rejected, rate
+            )
+        )
+
+    try:
+        with open(file_path, "r", newline="") as f:
+            if file_format == "csv":
+                lines = csv.DictReader(f)
+                parse = insertion.parse_csv_row
+                first_line = 2  # After the header
+            else:
+                lines = f
+                parse = insertion.parse_json_line
+                first_line = 1
+            (
+                n_loaded,
+                n_rejected,
+                errors,
+            ) = insertion.insert_raw_measures_from_lines(
+                lines,
+                chunk_size=chunk_size,
+                parse=parse,
+                insert=insertion.copy_raw_measures,
+                first_line=first_line,
+                on_chunk=print_progress,
+            )
+        for error in errors:
+            print("Line {}: {}".format(error["line"], error["error"]))
+        print_progress(n_loaded, n_rejected)
+        print("Done.")
+    except Exception as err:
+        print("Command failed: {}".format(repr(err)))
+        raise click.Abort()
+
+
+@measures.command("flush-staging")
+@click.option("-m", "--measure_name")
+@click.option("-b", "--batch_size", type=int)
+def flush_staging(measure_name, batch_size):
+    """Move the staged raw measures into the raw_measure table"""
+    try:
+        n_moved = staging.merge_staged_measures(measure_name, batch_size)
+        print("{} staged measures moved".format(n_moved))
+    except Exception as err:
+        print("Command failed: {}".format(repr(err)))
+        raise click.Abort()
+
+
 @measures.command("insert-random-measures")
 @click.option("-n", "--n_measures", default=1, show_default=True)
 @click.option("-d", "--days", default=1, show_default=True)
@@ -271,6 +361,7 @@ def insert_fixtures_definition(fixture_type):
 @click.option("-m", "--measure_name")
 def insert_fixtures(n_measures, days, starting_day, measure_name):
     """Insert random measures in database"""
+    from tests.fixtures import fixtures
 
     fixtures.insert_random_raw_measures(
         n_measures, days, starting_day, measure_name
@@ -290,6 +381,7 @@ def send_random_measures(
     dacc_address, n_measures, days, starting_day, measure_name, token
 ):
     """Send random measures to a dacc server"""
+    from tests.fixtures import fixtures
 
     measures = fixtures.generate_random_raw_measures(
         n_measures, days, starting_day, measure_name
@@ -324,11 +416,11 @@ def compute_aggregation(measure_name, force):
         if m_def is None:
             print("No measure definition found for: {}".format(measure_name))
             sys.exit()
-        agg, date = aggregation.aggregate_raw_measures(m_def, force=force)
-        if agg is None:
+        n_aggs, date = aggregation.aggregate_raw_measures(m_def, force=force)
+        if n_aggs is None:
             print("No aggregation were made for: {}".format(measure_name))
         else:
-            print("{} aggregations saved until: {}".format(len(agg), date))
+            print("{} aggregations saved until: {}".format(n_aggs, date))
     except Exception as err:
         print("Command failed: {}".format(repr(err)))
         raise click.Abort()
@@ -340,19 +432,31 @@ def compute_aggregation(measure_name, force):
     "--force",
     is_flag=True,
 )
-def compute_all_aggregations(force):
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of measures aggregated at the same time",
+)
+def compute_all_aggregations(force, jobs):
     """Compute aggregation for all measures"""
 
     try:
+        if jobs > 1:
+            compute_all_aggregations_in_parallel(force, jobs)
+            return
         m_defs = db.session.query(MeasureDefinition).all()
         for m_def in m_defs:
-            agg, date = aggregation.aggregate_raw_measures(m_def, force=force)
-            if agg is None:
+            n_aggs, date = aggregation.aggregate_raw_measures(
+                m_def, force=force
+            )
+            if n_aggs is None:
                 print("No aggregation were made for: {}".format(m_def.name))
             else:
                 print(
                     "{} aggregations saved until {} for: {}".format(
-                        len(agg), date, m_def.name
+                        n_aggs, date, m_def.name
                     )
                 )
     except Exception as err:
@@ -360,9 +464,81 @@ def compute_all_aggregations(force):
         raise click.Abort()
 
 
+def compute_all_aggregations_in_parallel(force, jobs):
+    names = [name for name, in db.session.query(MeasureDefinition.name)]
+    failures = []
+    for result in scheduler.aggregate_measures(names, jobs, force=force):
+        print_aggregation_result(result)
+        if result["error"] is not None:
+            failures.append(result["measure_name"])
+    if len(failures) > 0:
+        raise Exception(
+            "{} measures failed: {}".format(len(failures), ", ".join(failures))
+        )
+
+
+def print_aggregation_result(result):
+    name = result["measure_name"]
+    if result["error"] is not None:
+        print("Aggregation failed for {}: {}".format(name, result["error"]))
+    elif result["aggregates"] is None:
+        print("No aggregation were made for: {}".format(name))
+    else:
+        print(
+            "{} aggregations saved until {} for: {}".format(
+                result["aggregates"], result["date"], name
+            )
+        )
+
+
+@dacc.cli.command("aggregation-daemon")
+@click.argument("measure_names", nargs=-1)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of measures aggregated at the same time",
+)
+@click.option(
+    "--poll-interval",
+    type=click.FloatRange(min=0, min_open=True),
+    default=configdata.get("aggregation:daemon_poll_interval", 60),
+    help="Seconds before retrying a measure with nothing to aggregate",
+)
+def aggregation_daemon(measure_names, jobs, poll_interval):
+    """Aggregate each measure as soon as it is due, until stopped.
+
+    All the measures are scheduled, unless some measure names are given.
+    """
+    daemon = scheduler.AggregationDaemon(
+        jobs=jobs,
+        measure_names=list(measure_names) or None,
+        poll_interval=poll_interval,
+        refresh_interval=configdata.get(
+            "aggregation:daemon_refresh_interval", 300
+        ),
+        on_result=print_aggregation_result,
+    )
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        print("Stopping after the running aggregations...")
+        stopped.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print("Aggregation daemon started with {} jobs".format(jobs))
+    try:
+        daemon.run(stopped)
+    except Exception as err:
+        print("Command failed: {}".format(repr(err)))
+        raise click.Abort()
+
+
 @dacc.cli.command("compute-wildcard-aggregate")
 @click.argument("measure_name")
-@click.argument("groups")
+@click.argument("groups", nargs=-1, required=True)
 @click.option(
     "--from-date",
     type=click.DateTime(formats=["%Y-%m-%d"]),
@@ -376,12 +552,14 @@ def compute_all_aggregations(force):
 def compute_wildcard_aggregate(measure_name, from_date, groups, to_date):
     """Compute wildcard aggregates.
 
-    The groups must be separated by a comma, e.g. "group1,group2"
+    The groups must be separated by a comma, e.g. "group1,group2". Several
+    groups combinations can be given, e.g. "group1 group1,group2", to
+    compute them all in a single scan of the raw measures.
     """
     m_def = MeasureDefinition.query_by_name(measure_name)
-    groups_array = groups.split(",")
-    aggs = aggregation.compute_wildcard_aggregate(
-        m_def, groups_array, from_date, to_date
+    groups_sets = [groups_set.split(",") for groups_set in groups]
+    aggs = aggregation.compute_wildcard_aggregates(
+        m_def, groups_sets, from_date, to_date
     )
     if len(aggs) == 0:
         print("No wildcard aggregate generated")
@@ -391,6 +569,23 @@ def compute_wildcard_aggregate(measure_name, from_date, groups, to_date):
         print("{} wildcard aggregates generated".format(len(aggs)))
 
 
+@dacc.cli.command("compute-period-aggregates")
+@click.argument("measure_name")
+def compute_period_aggregates(measure_name):
+    """Recompute all the period aggregates of a measure, for the periods
+    declared in its rollupPeriods, from its aggregates.
+    """
+    try:
+        m_def = MeasureDefinition.query_by_name(measure_name)
+        if m_def is None:
+            raise Exception("No measure definition found")
+        n_aggs = aggregation.compute_period_aggregates(m_def)
+        print("{} period aggregates computed".format(n_aggs))
+    except Exception as err:
+        print("Command failed: {}".format(repr(err)))
+        raise click.Abort()
+
+
 @dacc.cli.group()
 def view():
     """View commands."""
@@ -451,6 +646,7 @@ def create_token(org):
         token = uuid.uuid4()
         auth = Auth(org=org, token=token)
         db.session.add(auth)
+        registry.tokens.notify_change()
         db.session.commit()
         print("Token created for {}: {}".format(org, token))
     except Exception as err:
@@ -477,6 +673,7 @@ def update_token(org):
     try:
         auth = Auth.query_by_org(org)
         auth.token = uuid.uuid4()
+        registry.tokens.notify_change()
         db.session.commit()
         print("Token updated for {}: {}".format(org, auth.token))
     except Exception as err:
@@ -491,6 +688,7 @@ def delete_org(org):
     try:
         auth = Auth.query_by_org(org)
         db.session.delete(auth)
+        registry.tokens.notify_change()
         db.session.commit()
     except Exception as err:
         print("Command failed: {}".format(repr(err)))
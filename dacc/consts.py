@@ -8,6 +8,16 @@ MONTH_PERIOD = "month"
 
 TIME_PERIOD = {DAY_PERIOD: 1, WEEK_PERIOD: 7, MONTH_PERIOD: 30}
 
+# The raw values are saved as NUMERIC(12, 2)
+MAX_RAW_MEASURE_VALUE = 9999999999.99
+
+SYNC_INGESTION = "sync"
+ASYNC_INGESTION = "async"
+GROUP_COMMIT_INGESTION = "group-commit"
+
+PYTHON_AGGREGATION = "python"
+SQL_AGGREGATION = "sql"
+
 AUTHORIZED_COLUMNS_FOR_RESTITUTION = [
     "measure_name",
     "start_date",
@@ -4,3 +4,7 @@ class AccessException(Exception):
 
 class ValidationException(Exception):
     """Raise for input validation exception"""
+
+
+class BufferFullException(Exception):
+    """Raise when the ingestion buffer cannot accept more measures"""
@@ -0,0 +1,322 @@
+from dacc import dacc, configdata, insertion, logger
+from dacc.exceptions import BufferFullException
+import abc
+import atexit
+import json
+import queue
+import threading
+import time
+
+
+class BackgroundBatcher(abc.ABC):
+    """Base class for the background threads writing raw measures by batches.
+
+    Items are put in a queue, which is consumed by a background thread: a
+    batch is processed as soon as `batch_size` items are pending, or
+    `batch_interval` seconds after the first pending item. The pending items
+    are processed before the thread stops, including on process exit.
+    """
+
+    thread_name = "dacc-batcher"
+
+    def __init__(
+        self,
+        app,
+        batch_size: int,
+        batch_interval: float,
+        max_size: int = 0,
+        poll_interval: float = 1.0,
+    ):
+        self.app = app
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.poll_interval = poll_interval
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the background thread, if not already started"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name=self.thread_name, daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout: float = None):
+        """Stop the background thread, after processing pending items"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._stopped.set()
+        thread.join(timeout)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _collect(self):
+        """Wait for items until a batch is triggered
+
+        Returns:
+            list: The items to process
+        """
+        try:
+            items = [self._queue.get(timeout=self.poll_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_interval
+        while len(items) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stopped.is_set():
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _drain(self):
+        items = []
+        while len(items) < self.batch_size:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while not self._stopped.is_set():
+            items = self._collect()
+            if len(items) > 0:
+                self._process(items)
+        # Process all the remaining items before exiting
+        items = self._drain()
+        while len(items) > 0:
+            self._process(items)
+            items = self._drain()
+
+    @abc.abstractmethod
+    def _process(self, items: list):
+        """Process a batch of items, from the background thread"""
+
+
+class WriteBehindBuffer(BackgroundBatcher):
+    """Bounded in-process buffer of raw measures, written in background.
+
+    The measures are appended to a bounded queue, which is flushed to the
+    raw_measure table by a background thread, with multi-row inserts. A
+    flush is triggered as soon as `flush_size` measures are pending, or
+    `flush_interval` seconds after the first pending measure, and on
+    process exit.
+
+    The last_updated date is set on flush, not on append, so that a measure
+    flushed after an aggregation run is not older than the last aggregated
+    measure. Note the buffered measures are lost if the process crashes
+    before they are flushed.
+
+    After `max_retries` failed inserts, the measures are saved in the
+    staging table instead, to be merged later on.
+    """
+
+    thread_name = "dacc-write-behind"
+
+    def __init__(
+        self,
+        app,
+        max_size: int = 10000,
+        flush_size: int = 500,
+        flush_interval: float = 1.0,
+        max_retries: int = 3,
+    ):
+        super().__init__(
+            app,
+            batch_size=flush_size,
+            batch_interval=flush_interval,
+            max_size=max_size,
+            poll_interval=flush_interval,
+        )
+        self.max_retries = max_retries
+
+    def append(self, measure: dict):
+        """Append a raw measure to the buffer
+
+        Args:
+            measure (dict): The JSON-formatted raw measure
+
+        Raises:
+            BufferFullException: The buffer is full
+        """
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait(measure)
+        except queue.Full:
+            raise BufferFullException(
+                "The ingestion buffer is full, please retry later"
+            )
+
+    def _process(self, measures: list):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                with self.app.app_context():
+                    insertion.insert_raw_measures(measures)
+                return
+            except Exception as err:
+                message = "Error on buffered measures insertion: {}".format(
+                    repr(err)
+                )
+                logger.log("error", message)
+                if attempt < self.max_retries:
+                    time.sleep(self.batch_interval)
+        self._dead_letter(measures)
+
+    def _dead_letter(self, measures: list):
+        """Keep the measures that could not be inserted in the staging table
+
+        When the staging table cannot be written either, the measures are
+        logged, so that they can still be replayed.
+
+        Args:
+            measures (list): The JSON-formatted raw measures
+        """
+        message = "{} buffered measures could not be inserted".format(
+            len(measures)
+        )
+        try:
+            with self.app.app_context():
+                insertion.stage_raw_measures(measures)
+            message += ", they are saved in the staging table"
+        except Exception as err:
+            message += ", nor saved in the staging table: {}: {}".format(
+                repr(err), json.dumps(measures, default=str)
+            )
+        logger.log("error", message)
+
+
+class PendingInsert:
+    """A raw measure waiting for its group commit"""
+
+    __slots__ = ("measure", "done", "error", "claimed", "cancelled")
+
+    def __init__(self, measure: dict):
+        self.measure = measure
+        self.done = threading.Event()
+        self.error = None
+        # Both set under the committer lock, see GroupCommitter.submit
+        self.claimed = False
+        self.cancelled = False
+
+
+class GroupCommitter(BackgroundBatcher):
+    """Group the raw measures inserts of concurrent requests.
+
+    The measures submitted within `window` seconds are inserted together,
+    in a single transaction, and all the submitters are released once it
+    is committed. Hence, a measure is durable when `submit` returns.
+
+    When the grouped insert fails, the measures are inserted one by one, so
+    that an invalid measure only fails its own request.
+
+    At most `queue_size` measures wait for a group commit, and a submitter
+    waits `timeout` seconds for its measure to be committed, or twice as
+    long once its insert started.
+    """
+
+    thread_name = "dacc-group-commit"
+
+    def __init__(
+        self,
+        app,
+        window: float = 0.005,
+        max_size: int = 500,
+        queue_size: int = 10000,
+        timeout: float = 5.0,
+    ):
+        super().__init__(
+            app,
+            batch_size=max_size,
+            batch_interval=window,
+            max_size=queue_size,
+        )
+        self.timeout = timeout
+        self._claim_lock = threading.Lock()
+
+    def submit(self, measure: dict):
+        """Insert a raw measure with the next group commit
+
+        Args:
+            measure (dict): The JSON-formatted raw measure
+
+        Raises:
+            BufferFullException: The queue is full, or the measure was not
+            committed in time
+            Exception: Any exception raised by the measure insertion
+        """
+        if self._thread is None:
+            self.start()
+        pending = PendingInsert(measure)
+        try:
+            self._queue.put_nowait(pending)
+        except queue.Full:
+            raise BufferFullException(
+                "The group commit queue is full, please retry later"
+            )
+        if not pending.done.wait(self.timeout):
+            with self._claim_lock:
+                # A measure not yet claimed is never inserted
+                pending.cancelled = not pending.claimed
+            if pending.cancelled:
+                raise BufferFullException(
+                    "The group commit timed out, please retry later"
+                )
+            if not pending.done.wait(self.timeout):
+                raise BufferFullException(
+                    "The group commit timed out, the measure might be saved"
+                )
+        if pending.error is not None:
+            raise pending.error
+
+    def _process(self, pending_inserts: list):
+        with self._claim_lock:
+            pending_inserts = [p for p in pending_inserts if not p.cancelled]
+            for pending in pending_inserts:
+                pending.claimed = True
+        if len(pending_inserts) == 0:
+            return
+        with self.app.app_context():
+            try:
+                insertion.insert_raw_measures(
+                    [p.measure for p in pending_inserts]
+                )
+            except Exception:
+                for pending in pending_inserts:
+                    try:
+                        insertion.insert_raw_measures([pending.measure])
+                    except Exception as err:
+                        pending.error = err
+            finally:
+                for pending in pending_inserts:
+                    pending.done.set()
+
+
+write_behind_buffer = WriteBehindBuffer(
+    dacc,
+    max_size=configdata.get("ingestion:buffer_size", 10000),
+    flush_size=configdata.get("ingestion:flush_size", 500),
+    flush_interval=configdata.get("ingestion:flush_interval", 1.0),
+)
+
+group_committer = GroupCommitter(
+    dacc,
+    window=configdata.get("ingestion:group_commit_window", 0.005),
+    max_size=configdata.get("ingestion:group_commit_size", 500),
+    queue_size=configdata.get("ingestion:group_commit_queue_size", 10000),
+    timeout=configdata.get("ingestion:group_commit_timeout", 5.0),
+)
@@ -1,5 +1,62 @@
-from dacc.models import RawMeasure, MeasureDefinition
-from dacc import db
+from dacc.models import RawMeasure, RawMeasureStaging, MeasureDefinition
+from dacc import db, validate, registry, staging
+from dacc.exceptions import ValidationException
+from sqlalchemy import func, insert, select
+import csv
+import io
+import json
+
+COPY_COLUMNS = [
+    "measure_name",
+    "value",
+    "start_date",
+    "last_updated",
+    "aggregation_period",
+    "created_by",
+    "group1",
+    "group2",
+    "group3",
+]
+JSONB_COLUMNS = ["group1", "group2", "group3"]
+COPY_NULL = "\\N"
+COPY_RAW_MEASURES_SQL = (
+    "COPY raw_measure ({}) FROM STDIN WITH (FORMAT csv, NULL '{}')".format(
+        ", ".join(COPY_COLUMNS), COPY_NULL
+    )
+)
+
+
+def raw_measure_to_row(measure):
+    """Convert a JSON raw measure into a raw_measure row
+
+    Args:
+        measure (JSON): The JSON-formatted raw measure
+
+    Returns:
+        dict: The raw_measure columns values
+    """
+    return {
+        "measure_name": measure.get("measureName"),
+        "value": measure.get("value"),
+        "start_date": measure.get("startDate"),
+        "aggregation_period": measure.get("aggregationPeriod"),
+        "created_by": measure.get("createdBy"),
+        "group1": measure.get("group1"),
+        "group2": measure.get("group2"),
+        "group3": measure.get("group3"),
+    }
+
+
+def get_raw_measure_model():
+    """Get the model in which the incoming raw measures are inserted
+
+    Returns:
+        db.Model: RawMeasureStaging when staging is enabled, RawMeasure
+        otherwise
+    """
+    if staging.is_staging_enabled():
+        return RawMeasureStaging
+    return RawMeasure
 
 
 def insert_raw_measure(measure):
@@ -9,19 +66,12 @@ def insert_raw_measure(measure):
         measure (JSON): The JSON-formatted raw measure
 
     Returns:
-        RawMeasure: The inserted raw measure in database
+        RawMeasure: The inserted raw measure in database, or the staged
+        raw measure when staging is enabled
     """
     try:
-        m = RawMeasure(
-            measure_name=measure.get("measureName"),
-            value=measure.get("value"),
-            start_date=measure.get("startDate"),
-            aggregation_period=measure.get("aggregationPeriod"),
-            created_by=measure.get("createdBy"),
-            group1=measure.get("group1"),
-            group2=measure.get("group2"),
-            group3=measure.get("group3"),
-        )
+        model = get_raw_measure_model()
+        m = model(**raw_measure_to_row(measure))
         db.session.add(m)
         db.session.commit()
         return m
@@ -29,6 +79,213 @@ def insert_raw_measure(measure):
         print("Error on measure insertion: " + repr(err))
 
 
+def insert_raw_measures(measures):
+    """Insert JSON raw measures in database
+
+    All the measures are inserted with a single multi-row INSERT, in one
+    transaction.
+
+    Args:
+        measures (list(JSON)): The JSON-formatted raw measures
+
+    Returns:
+        int: The number of inserted raw measures
+    """
+    if len(measures) == 0:
+        return 0
+    rows = [raw_measure_to_row(m) for m in measures]
+    try:
+        db.session.execute(insert(get_raw_measure_model()).values(rows))
+        db.session.commit()
+        return len(rows)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def stage_raw_measures(measures):
+    """Insert JSON raw measures in the staging table, whatever the config
+
+    It is used to keep the measures that could not be inserted in the
+    raw_measure table, until they are merged, see
+    staging.merge_staged_measures.
+
+    Args:
+        measures (list(JSON)): The JSON-formatted raw measures
+
+    Returns:
+        int: The number of staged raw measures
+    """
+    rows = [raw_measure_to_row(m) for m in measures]
+    try:
+        db.session.execute(insert(RawMeasureStaging).values(rows))
+        db.session.commit()
+        return len(rows)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def parse_json_line(line):
+    """Parse a NDJSON line into a JSON raw measure
+
+    Args:
+        line (str): The NDJSON line
+
+    Raises:
+        ValidationException: The line is not a JSON object
+
+    Returns:
+        dict: The JSON-formatted raw measure, or None for a blank line
+    """
+    if not line.strip():
+        return None
+    try:
+        measure = json.loads(line)
+    except ValueError:
+        raise ValidationException("The line is not a valid JSON")
+    if not isinstance(measure, dict):
+        raise ValidationException("The measure format is incorrect")
+    return measure
+
+
+def parse_csv_row(row):
+    """Parse a CSV row into a JSON raw measure
+
+    The CSV columns are the JSON raw measure fields, where the groups are
+    JSON-formatted, e.g. `{"device": "mobile"}`. Empty values are ignored.
+
+    Args:
+        row (dict): The CSV row, by column name
+
+    Raises:
+        ValidationException: A group is not a valid JSON
+
+    Returns:
+        dict: The JSON-formatted raw measure
+    """
+    measure = {key: value for key, value in row.items() if value}
+    for group in ["group1", "group2", "group3"]:
+        if group in measure:
+            try:
+                measure[group] = json.loads(measure[group])
+            except ValueError:
+                raise ValidationException("groups format is incorrect")
+    return measure
+
+
+def insert_raw_measures_from_lines(
+    lines,
+    chunk_size=1000,
+    max_errors=100,
+    parse=parse_json_line,
+    insert=insert_raw_measures,
+    first_line=1,
+    on_chunk=None,
+):
+    """Insert raw measures from NDJSON lines, by bounded chunks
+
+    Each line is parsed and checked on the fly, and the valid measures are
+    inserted every `chunk_size` measures, each chunk in its own
+    transaction. The memory used thus does not depend on the number of
+    lines.
+
+    Args:
+        lines (iterable): The NDJSON lines, one JSON raw measure per line
+        chunk_size (int, optional): The maximum number of measures inserted
+        at once. Defaults to 1000.
+        max_errors (int, optional): The maximum number of reported errors.
+        Defaults to 100.
+        parse (function, optional): The function parsing a line into a JSON
+        raw measure. Defaults to parse_json_line.
+        insert (function, optional): The function inserting a chunk of
+        measures. Defaults to insert_raw_measures.
+        first_line (int, optional): The number of the first line, for error
+        reporting. Defaults to 1.
+        on_chunk (function, optional): Called with the number of inserted
+        and rejected measures after each inserted chunk. Defaults to None.
+
+    Returns:
+        (int, int, list(dict)): The number of inserted measures, the number
+        of rejected measures and the first errors, with their line number
+    """
+    chunk = []
+    n_inserted = 0
+    n_rejected = 0
+    errors = []
+    for line_number, line in enumerate(lines, start=first_line):
+        try:
+            measure = parse(line)
+            if measure is None:
+                continue
+            validate.check_incoming_raw_measure(measure)
+        except ValidationException as err:
+            n_rejected += 1
+            if len(errors) < max_errors:
+                errors.append({"line": line_number, "error": str(err)})
+            continue
+
+        chunk.append(measure)
+        if len(chunk) >= chunk_size:
+            n_inserted += insert(chunk)
+            chunk = []
+            if on_chunk is not None:
+                on_chunk(n_inserted, n_rejected)
+
+    if len(chunk) > 0:
+        n_inserted += insert(chunk)
+        if on_chunk is not None:
+            on_chunk(n_inserted, n_rejected)
+    return n_inserted, n_rejected, errors
+
+
+def to_copy_value(column, value):
+    if value is None:
+        return COPY_NULL
+    if column in JSONB_COLUMNS:
+        return json.dumps(value)
+    return value
+
+
+def copy_raw_measures(measures):
+    """Insert JSON raw measures in the raw_measure table with COPY
+
+    The measures are streamed to PostgreSQL in the CSV format, which is much
+    faster than INSERT statements for large volumes. They all get the same
+    last_updated date, which is the database transaction date, as it
+    would be with INSERT statements.
+
+    Args:
+        measures (list(JSON)): The JSON-formatted raw measures
+
+    Returns:
+        int: The number of inserted raw measures
+    """
+    if len(measures) == 0:
+        return 0
+    try:
+        last_updated = db.session.execute(
+            select(func.localtimestamp())
+        ).scalar()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for measure in measures:
+            row = raw_measure_to_row(measure)
+            row["last_updated"] = last_updated
+            writer.writerow(
+                [to_copy_value(column, row[column]) for column in COPY_COLUMNS]
+            )
+        buffer.seek(0)
+
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(COPY_RAW_MEASURES_SQL, buffer)
+        db.session.commit()
+        return len(measures)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
 def insert_measure_definition(definition):
     """Insert JSON measure definition in database
 
@@ -39,6 +296,10 @@ def insert_measure_definition(definition):
         MeasureDefinition: The inserted definition in database
     """
     try:
+        validate.check_rollup_periods(
+            definition.get("rollupPeriods"),
+            definition.get("aggregationPeriod"),
+        )
         d = MeasureDefinition(
             id=definition.get("id"),
             name=definition.get("name"),
@@ -53,8 +314,13 @@ def insert_measure_definition(definition):
             aggregation_threshold=definition.get("aggregationThreshold"),
             access_app=definition.get("accessApp"),
             access_public=definition.get("accessPublic"),
+            with_quartiles=definition.get("withQuartiles", False),
+            with_quantile_sketch=definition.get("withQuantileSketch", False),
+            wildcard_groups=definition.get("wildcardGroups"),
+            rollup_periods=definition.get("rollupPeriods"),
         )
         db.session.add(d)
+        registry.measure_definitions.notify_change()
         db.session.commit()
         return d
     except Exception as err:
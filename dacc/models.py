@@ -1,5 +1,5 @@
 from dacc import db
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func, text
 from sqlalchemy.schema import DropTable
@@ -32,6 +32,8 @@ class Auth(db.Model):
     org = db.Column(db.String(100))
     token = db.Column(db.String(200))
 
+    db.Index("idx_auth_by_token", token)
+
     @staticmethod
     def query_by_org(org):
         return db.session.query(Auth).filter(Auth.org == org).first()
@@ -41,6 +43,31 @@ class Auth(db.Model):
         return db.session.query(Auth).filter(Auth.token == token).first()
 
 
+class RegistryVersion(db.Model):
+    # Increased with each change of a registry rows, e.g. the tokens or the
+    # measure definitions, so that all the processes reload their in-memory
+    # registry, see registry.py
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, server_default=text("0"))
+
+    @staticmethod
+    def query_version(name):
+        return (
+            db.session.query(RegistryVersion.version)
+            .filter(RegistryVersion.name == name)
+            .scalar()
+        )
+
+    @staticmethod
+    def increment(name):
+        stmt = pg_insert(RegistryVersion).values(name=name, version=1)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[RegistryVersion.name],
+            set_={"version": RegistryVersion.version + 1},
+        )
+        db.session.execute(stmt)
+
+
 class RawMeasure(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     measure_name = db.Column(db.String(100))
@@ -91,6 +118,22 @@ class RawMeasure(db.Model):
         return self.last_updated + timedelta(days=max_days)
 
 
+class RawMeasureStaging(db.Model):
+    # UNLOGGED and without index, to make inserts as cheap as possible.
+    # The staged measures are lost on a database crash.
+    __table_args__ = {"prefixes": ["UNLOGGED"]}
+
+    id = db.Column(db.Integer, primary_key=True)
+    measure_name = db.Column(db.String(100))
+    value = db.Column(db.Numeric(precision=12, scale=2), default=1)
+    start_date = db.Column(db.TIMESTAMP)
+    aggregation_period = db.Column(db.String(100))
+    created_by = db.Column(db.String(100))
+    group1 = db.Column(JSONB(none_as_null=True))
+    group2 = db.Column(JSONB(none_as_null=True))
+    group3 = db.Column(JSONB(none_as_null=True))
+
+
 class RefusedRawMeasure(db.Model):
     # TODO: mutualize with RawMeasure?
     id = db.Column(db.Integer, primary_key=True)
@@ -141,6 +184,11 @@ class MeasureDefinition(db.Model):
     max_days_to_update_quartile = db.Column(
         db.Integer, server_default=text("100")
     )
+    with_quantile_sketch = db.Column(db.Boolean, server_default=text("false"))
+    # List of groups combinations to wildcard, e.g. [["group1", "group3"]]
+    wildcard_groups = db.Column(JSONB(none_as_null=True))
+    # List of coarser periods to maintain aggregates for, e.g. ["month"]
+    rollup_periods = db.Column(JSONB(none_as_null=True))
     aggregation_date = relationship(
         "AggregationDate",
         uselist=False,
@@ -208,9 +256,12 @@ class Aggregation(db.Model):
     max = db.Column(db.Numeric(precision=12, scale=2))
     avg = db.Column(db.Numeric(precision=12, scale=2))
     std = db.Column(db.Numeric(precision=12, scale=2), default=0)
+    # Exact sum of the squared values, to merge the std without rounding
+    sum_of_squares = db.Column(db.Numeric)
     median = db.Column(db.Numeric(precision=12, scale=2))
     first_quartile = db.Column(db.Numeric(precision=12, scale=2))
     third_quartile = db.Column(db.Numeric(precision=12, scale=2))
+    quantile_sketch = db.Column(JSONB(none_as_null=True))
 
     db.Index(
         "idx_by_mname_and_sdate_and_created_by_and_groups",
@@ -228,21 +279,38 @@ class Aggregation(db.Model):
         start_date,
     )
 
+    # The aggregate key, with NULL values made comparable, which is
+    # required by the upsert of aggregates, see aggregation.py
+    db.Index(
+        "idx_unique_aggregate_key",
+        measure_name,
+        start_date,
+        func.coalesce(created_by, text("''")),
+        func.coalesce(group1, text("'null'::jsonb")),
+        func.coalesce(group2, text("'null'::jsonb")),
+        func.coalesce(group3, text("'null'::jsonb")),
+        unique=True,
+    )
+
     @staticmethod
     def query_aggregate_by_measure(measure_name, m):
+        # Match the unique aggregate key, where an empty or NULL creator
+        # and a NULL group are the same
         m = tuple_as_dict(m)
-        return (
-            db.session.query(Aggregation)
-            .filter(
-                Aggregation.measure_name == measure_name,
-                Aggregation.start_date == m["start_date"],
-                Aggregation.created_by == m["created_by"],
-                Aggregation.group1 == m["group1"],
-                Aggregation.group2 == m["group2"],
-                Aggregation.group3 == m["group3"],
-            )
-            .first()
-        )
+        filters = [
+            Aggregation.measure_name == measure_name,
+            Aggregation.start_date == m["start_date"],
+            func.coalesce(Aggregation.created_by, "")
+            == (m["created_by"] or ""),
+        ]
+        jsonb_null = text("'null'::jsonb")
+        for group in ["group1", "group2", "group3"]:
+            column = func.coalesce(getattr(Aggregation, group), jsonb_null)
+            if m[group] is None:
+                filters.append(column == jsonb_null)
+            else:
+                filters.append(column == m[group])
+        return db.session.query(Aggregation).filter(*filters).first()
 
     @staticmethod
     def query_aggregates_by_measure_name_from_date(measure_name, date):
@@ -257,7 +325,7 @@ class Aggregation(db.Model):
 
     @staticmethod
     def query_range_with_threshold(
-        measure_name, start_date, end_date, created_by=None
+        measure_name, start_date, end_date, created_by=None, threshold=None
     ):
         filters = [
             Aggregation.measure_name == measure_name,
@@ -267,11 +335,76 @@ class Aggregation(db.Model):
         if created_by is not None:
             filters.append(Aggregation.created_by == created_by)
 
-        subquery_threshold = MeasureDefinition.query_threshold(measure_name)
-        filters.append(Aggregation.count >= subquery_threshold)
+        if threshold is None:
+            threshold = MeasureDefinition.query_threshold(measure_name)
+        filters.append(Aggregation.count >= threshold)
         return (
             db.session.query(Aggregation)
             .filter(*filters)
             .order_by(Aggregation.start_date)
             .all()
         )
+
+
+class PeriodAggregation(db.Model):
+    # An aggregate on a coarser period than the measure aggregation period,
+    # merged from the aggregates, see aggregation.update_period_aggregates.
+    # The quartiles cannot be merged, hence they are not saved.
+    id = db.Column(db.Integer, primary_key=True)
+    measure_name = db.Column(db.String(100))
+    period = db.Column(db.String(50))
+    start_date = db.Column(db.TIMESTAMP)
+    last_updated = db.Column(db.DateTime, default=func.now())
+    created_by = db.Column(db.String(100))
+    group1 = db.Column(JSONB(none_as_null=True))
+    group2 = db.Column(JSONB(none_as_null=True))
+    group3 = db.Column(JSONB(none_as_null=True))
+    sum = db.Column(db.Numeric(precision=12, scale=2))
+    count = db.Column(db.Integer)
+    count_not_zero = db.Column(db.Integer)
+    min = db.Column(db.Numeric(precision=12, scale=2))
+    max = db.Column(db.Numeric(precision=12, scale=2))
+    avg = db.Column(db.Numeric(precision=12, scale=2))
+    std = db.Column(db.Numeric(precision=12, scale=2), default=0)
+    sum_of_squares = db.Column(db.Numeric)
+
+    # The period aggregate key, see aggregation.PERIOD_AGGREGATES_SQL
+    db.Index(
+        "idx_unique_period_aggregate_key",
+        measure_name,
+        period,
+        start_date,
+        func.coalesce(created_by, text("''")),
+        func.coalesce(group1, text("'null'::jsonb")),
+        func.coalesce(group2, text("'null'::jsonb")),
+        func.coalesce(group3, text("'null'::jsonb")),
+        unique=True,
+    )
+
+    @staticmethod
+    def query_range_with_threshold(
+        measure_name,
+        period,
+        start_date,
+        end_date,
+        created_by=None,
+        threshold=None,
+    ):
+        filters = [
+            PeriodAggregation.measure_name == measure_name,
+            PeriodAggregation.period == period,
+            PeriodAggregation.start_date >= start_date,
+            PeriodAggregation.start_date < end_date,
+        ]
+        if created_by is not None:
+            filters.append(PeriodAggregation.created_by == created_by)
+
+        if threshold is None:
+            threshold = MeasureDefinition.query_threshold(measure_name)
+        filters.append(PeriodAggregation.count >= threshold)
+        return (
+            db.session.query(PeriodAggregation)
+            .filter(*filters)
+            .order_by(PeriodAggregation.start_date)
+            .all()
+        )
@@ -5,7 +5,13 @@ from dacc.models import (
     MeasureDefinition,
     Aggregation,
 )
-from dacc.aggregation import aggregation_query
+from dacc.aggregation import (
+    aggregation_query,
+    generate_wildcard_json,
+    get_created_by_column,
+    JSONB_NULL,
+)
+from sqlalchemy import func, or_
 from datetime import datetime
 
 
@@ -38,7 +44,8 @@ def has_not_aggregated_measures(
 
 
 def get_quartiles_filter(m_definition: MeasureDefinition):
-    if m_definition.with_quartiles:
+    # With a quantile sketch, the quartiles do not need the raw measures
+    if m_definition.with_quartiles and not m_definition.with_quantile_sketch:
         max_days = m_definition.max_days_to_update_quartile
         return [datetime.now() > RawMeasure.max_retention_date(max_days)]
     return []
@@ -57,13 +64,58 @@ def get_filters_measures(
     return filters
 
 
+def get_impacted_aggregates_filters(m_definition: MeasureDefinition, gm):
+    """Get the filters of the aggregates including the given grouped
+    measures, i.e. their aggregate and the wildcard aggregates covering it
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        gm (Row): The grouped measures
+
+    Returns:
+        list: The filters
+    """
+    filters = [
+        Aggregation.measure_name == m_definition.name,
+        Aggregation.start_date == gm.start_date,
+        func.coalesce(Aggregation.created_by, "") == (gm.created_by or ""),
+    ]
+    for group in ["group1", "group2", "group3"]:
+        column = getattr(Aggregation, group)
+        value = getattr(gm, group)
+        if value is None:
+            condition = func.coalesce(column, JSONB_NULL) == JSONB_NULL
+        else:
+            condition = column == value
+        group_key = getattr(m_definition, "{}_key".format(group))
+        if group_key is not None:
+            wildcard = generate_wildcard_json(group_key)
+            condition = or_(condition, column == wildcard)
+        filters.append(condition)
+    return filters
+
+
 def update_impacted_aggregates(
     m_definition: MeasureDefinition, grouped_measures
 ):
+    """Set the purge date of the aggregates of the purged measures.
+
+    The wildcard aggregates including purged measures are updated as well,
+    so that their quartiles are not recomputed from the remaining measures.
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        grouped_measures (list(Row)): The purged measures, grouped by key
+
+    Returns:
+        int: The number of purged aggregate keys
+    """
+    purge_date = datetime.now()
     for gm in grouped_measures:
-        agg = Aggregation.query_aggregate_by_measure(m_definition.name, gm)
-        db.session.query(Aggregation).filter(Aggregation.id == agg.id).update(
-            {"last_raw_measures_purged": datetime.now()}
+        filters = get_impacted_aggregates_filters(m_definition, gm)
+        db.session.query(Aggregation).filter(*filters).update(
+            {"last_raw_measures_purged": purge_date},
+            synchronize_session=False,
         )
 
     return len(grouped_measures)
@@ -73,7 +125,7 @@ def query_grouped_measures(
     m_definition: MeasureDefinition, purge_date: datetime
 ):
     query_args = [
-        RawMeasure.created_by,
+        get_created_by_column().label("created_by"),
         RawMeasure.start_date,
         RawMeasure.group1,
         RawMeasure.group2,
@@ -108,8 +160,8 @@ def purge_measures(
     All the raw measures with a last_updated date inferior to the purge
     date should be erased, except for the following cases:
      - Some raw measures are not aggregated yet.
-     - The definition includes quartiles and some measures do not reach the
-       `max_days_to_update_quartile` threshold..
+     - The definition includes quartiles without quantile sketch and some
+       measures do not reach the `max_days_to_update_quartile` threshold.
     Furthermore, each impacted aggregate updates its `last_raw_measures_purged`
     date.
 
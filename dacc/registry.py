@@ -0,0 +1,240 @@
+from dacc import db, configdata
+from dacc.models import (
+    Auth,
+    MeasureDefinition,
+    RegistryVersion,
+    tuple_as_dict,
+)
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+MAX_UNKNOWN_NAMES = 1000
+MAX_UNKNOWN_TOKENS = 10000
+
+
+class Registry:
+    """Base class of the in-memory registries loaded at once from database.
+
+    The registry is reloaded when invalidated, or after `refresh_interval`
+    seconds. The changes made by another process are seen through the
+    shared version of the registry, see RegistryVersion: it is checked at
+    most every `check_interval` seconds, and the registry is reloaded when
+    it was increased. The `version` is increased on each load.
+
+    The state is swapped as a whole: it is a tuple of the loaded entries,
+    the unknown keys, the load time and the shared version.
+    """
+
+    # The name of the shared version
+    name = None
+
+    def __init__(self, refresh_interval: int = 60, check_interval: int = 1):
+        self.refresh_interval = refresh_interval
+        self.check_interval = check_interval
+        self.version = 0
+        self._state = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def query_shared_version(self):
+        return RegistryVersion.query_version(self.name)
+
+    def set_state(self, entries: dict, shared_version: int):
+        """Replace the state with newly loaded entries
+
+        Args:
+            entries (dict): The loaded entries
+            shared_version (int): The shared version, queried before the
+            entries
+
+        Returns:
+            tuple: The new state
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._state = (entries, OrderedDict(), now, shared_version)
+            self._checked_at = now
+            self.version += 1
+        return self._state
+
+    def invalidate(self):
+        """Force a reload on the next access, in this process only"""
+        with self._lock:
+            self._state = None
+
+    def notify_change(self):
+        """Force a reload in all the processes, once the current
+        transaction is committed"""
+        RegistryVersion.increment(self.name)
+        self.invalidate()
+
+    def is_stale(self, state):
+        if state is None:
+            return True
+        now = time.monotonic()
+        if now - state[2] > self.refresh_interval:
+            return True
+        if now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        return self.query_shared_version() != state[3]
+
+
+def remember_unknown(unknown_keys: OrderedDict, key, max_unknown: int):
+    """Remember an unknown key, forgetting the oldest ones beyond the limit
+
+    Args:
+        unknown_keys (OrderedDict): The unknown keys of a registry state
+        key (Any): The unknown key
+        max_unknown (int): The maximum number of unknown keys
+    """
+    while len(unknown_keys) >= max_unknown:
+        try:
+            unknown_keys.popitem(last=False)
+        except KeyError:
+            # Emptied by a concurrent request
+            break
+    unknown_keys[key] = None
+
+
+class MeasureDefinitionEntry:
+    """A read-only copy of a MeasureDefinition, detached from any session.
+
+    The raw measures validator compiled from the definition is cached in
+    `validator`, see `validate.get_validator`.
+    """
+
+    def __init__(self, m_def: MeasureDefinition):
+        self.__dict__.update(tuple_as_dict(m_def))
+        self.validator = None
+
+
+class MeasureDefinitionRegistry(Registry):
+    """In-memory registry of the measure definitions, by name, see Registry.
+
+    The definitions commands increase the shared version, so that all the
+    processes use the new definitions within `check_interval` seconds.
+
+    A name missing from the registry is looked up in database, as the
+    definition might have been inserted since the last load. Names that do
+    not match any definition are remembered until the next load, up to
+    `MAX_UNKNOWN_NAMES`: beyond that, the oldest one is forgotten.
+    """
+
+    name = "measure_definitions"
+
+    def load(self):
+        """Load all the measure definitions from database
+
+        Returns:
+            tuple: The registry state, i.e. the definitions by name, the
+            unknown names, the load time and the shared version
+        """
+        shared_version = self.query_shared_version()
+        m_defs = db.session.query(MeasureDefinition).all()
+        definitions = {
+            m_def.name: MeasureDefinitionEntry(m_def) for m_def in m_defs
+        }
+        return self.set_state(definitions, shared_version)
+
+    def get(self, name: str):
+        """Get a measure definition by its name
+
+        Args:
+            name (str): The measure name
+
+        Returns:
+            MeasureDefinitionEntry: The definition, or None if not found
+        """
+        state = self._state
+        if self.is_stale(state):
+            state = self.load()
+        definitions, unknown_names = state[:2]
+
+        entry = definitions.get(name)
+        if entry is None and name not in unknown_names:
+            m_def = MeasureDefinition.query_by_name(name)
+            if m_def is None:
+                remember_unknown(unknown_names, name, MAX_UNKNOWN_NAMES)
+            else:
+                entry = MeasureDefinitionEntry(m_def)
+                definitions[name] = entry
+        return entry
+
+
+def hash_token(token: str):
+    return hashlib.sha256(str(token).encode("utf-8")).digest()
+
+
+class TokenRegistry(Registry):
+    """In-memory registry of the authentication tokens, see Registry.
+
+    The orgs are indexed by a hash of their token, so that the tokens
+    themselves are not kept in memory. The token commands increase the
+    shared version, so that a deleted or updated token is refused by all
+    the processes within `check_interval` seconds.
+
+    An unknown token is looked up in database, in case it was created since
+    the last load, and is then rejected without lookup until the next
+    load. At most `MAX_UNKNOWN_TOKENS` are remembered: beyond that, the
+    oldest one is forgotten, so that a valid token is never rejected
+    without lookup.
+    """
+
+    name = "tokens"
+
+    def load(self):
+        """Load all the tokens from database
+
+        Returns:
+            tuple: The registry state, i.e. the orgs by token hash, the
+            unknown token hashes, the load time and the shared version
+        """
+        shared_version = self.query_shared_version()
+        auths = db.session.query(Auth.org, Auth.token).all()
+        orgs = {
+            hash_token(auth.token): auth.org
+            for auth in auths
+            if auth.token is not None
+        }
+        return self.set_state(orgs, shared_version)
+
+    def get_org(self, token: str):
+        """Get the org authenticated by a token
+
+        Args:
+            token (str): The authentication token
+
+        Returns:
+            str: The org, or None if the token is unknown
+        """
+        if not token:
+            return None
+        state = self._state
+        if self.is_stale(state):
+            state = self.load()
+        orgs, unknown_tokens = state[:2]
+
+        token_hash = hash_token(token)
+        org = orgs.get(token_hash)
+        if org is not None or token_hash in unknown_tokens:
+            return org
+        auth = Auth.query_by_token(token)
+        if auth is None:
+            remember_unknown(unknown_tokens, token_hash, MAX_UNKNOWN_TOKENS)
+            return None
+        orgs[token_hash] = auth.org
+        return auth.org
+
+
+measure_definitions = MeasureDefinitionRegistry(
+    refresh_interval=configdata.get("registry:refresh_interval", 60),
+    check_interval=configdata.get("registry:check_interval", 1),
+)
+
+tokens = TokenRegistry(
+    refresh_interval=configdata.get("registry:refresh_interval", 60),
+    check_interval=configdata.get("registry:check_interval", 1),
+)
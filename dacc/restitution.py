@@ -1,12 +1,124 @@
-from dacc.models import Aggregation, tuple_as_dict
-from dacc.utils import to_camel_case
+from dacc import registry, aggregation
+from dacc.models import Aggregation, PeriodAggregation, tuple_as_dict
+from dacc.sketch import QuantileSketch
+from dacc.utils import (
+    get_period_end,
+    parse_date,
+    to_camel_case,
+    truncate_date,
+)
 from dacc.consts import AUTHORIZED_COLUMNS_FOR_RESTITUTION
+from decimal import Decimal, ROUND_HALF_UP
+
+# The aggregate columns stored as numeric(12, 2)
+ROUNDED_COLUMNS = (
+    "sum",
+    "min",
+    "max",
+    "avg",
+    "std",
+    "median",
+    "first_quartile",
+    "third_quartile",
+)
 
 
 def is_authorized_column(column_name):
     return column_name in AUTHORIZED_COLUMNS_FOR_RESTITUTION
 
 
+def round_aggregate(agg: dict):
+    """Round a merged aggregate as a stored one
+
+    Args:
+        agg (dict): The merged aggregate
+
+    Returns:
+        dict: The rounded aggregate
+    """
+    for name in ROUNDED_COLUMNS:
+        if agg[name] is not None:
+            agg[name] = Decimal(str(agg[name])).quantize(
+                Decimal("0.01"), rounding=ROUND_HALF_UP
+            )
+    return agg
+
+
+def rollup_aggregates(m_definition, aggregates: list, rollup: dict):
+    """Merge stored aggregates into wildcard or coarser period aggregates.
+
+    The groups to collapse are replaced by their wildcard, e.g.
+    {"slug": "*"}, and the start dates are truncated to the period start.
+    The aggregates with the same resulting key are merged as
+    compute_partial_aggregates does, and rounded as the stored ones. The
+    quartiles cannot be merged, except from quantile sketches: otherwise,
+    they are dropped from the merged aggregates.
+
+    Args:
+        m_definition (MeasureDefinition): The measure definition
+        aggregates (list(Aggregation)): The stored aggregates, sorted by
+        start date
+        rollup (dict): The groups to collapse and the target period
+
+    Returns:
+        list(dict): The merged aggregates
+    """
+    groups = rollup.get("groups", [])
+    period = rollup.get("period")
+    merged = {}
+    for agg in aggregates:
+        if len(aggregation.get_wildcard_groups(m_definition, agg)) > 0:
+            # Stored wildcard aggregates would be counted twice
+            continue
+        record = aggregation.AggregateRecord(agg)
+        if period is not None:
+            record.start_date = truncate_date(record.start_date, period)
+        for group in groups:
+            key = getattr(m_definition, "{}_key".format(group))
+            setattr(record, group, aggregation.generate_wildcard_json(key))
+
+        key = aggregation.build_aggregate_key(record)
+        current = merged.get(key)
+        if current is None:
+            merged[key] = record
+            continue
+        merged_agg = aggregation.compute_partial_aggregates(
+            m_definition.name, current, record
+        )
+        merged_agg.median = None
+        merged_agg.first_quartile = None
+        merged_agg.third_quartile = None
+        if current.quantile_sketch and record.quantile_sketch:
+            sketch = QuantileSketch.from_json(current.quantile_sketch)
+            sketch = sketch.merge(
+                QuantileSketch.from_json(record.quantile_sketch)
+            )
+            merged_agg.quantile_sketch = sketch.to_json()
+            merged_agg.median = sketch.quantile(0.5)
+            merged_agg.first_quartile = sketch.quantile(0.25)
+            merged_agg.third_quartile = sketch.quantile(0.75)
+        else:
+            merged_agg.quantile_sketch = None
+        merged[key] = merged_agg
+    return [round_aggregate(agg.as_dict()) for agg in merged.values()]
+
+
+def filter_threshold(aggregates: list, threshold: int):
+    """Keep the merged aggregates reaching the threshold
+
+    Args:
+        aggregates (list(dict)): The merged aggregates
+        threshold (int): The aggregation threshold
+
+    Returns:
+        list(dict): The aggregates reaching the threshold
+    """
+    if threshold is None:
+        # As in database, no aggregate reaches an undefined threshold
+        return []
+    return [agg for agg in aggregates if agg["count"] >= threshold]
+
+
 def get_aggregated_results(params):
     """Get aggregated results for a measure.
 
@@ -14,6 +126,14 @@ def get_aggregated_results(params):
     the aggregation_threshold defined in the measure definition: otherwise,
     it won't be returned.
 
+    With the `rollup` option, the stored aggregates are merged into
+    wildcard or coarser period aggregates, see rollup_aggregates. The
+    threshold then applies to the merged aggregates. When the period is
+    maintained for the measure, see `rollup_periods`, the stored period
+    aggregates are read instead, without quartiles. In both cases, the
+    dates are extended to whole periods, so that the periods at the bounds
+    are not partially merged.
+
     Args:
         params (JSON): The JSON-formatted query parameters
 
@@ -24,10 +144,43 @@ def get_aggregated_results(params):
     created_by = params.get("createdBy")
     start_date = params.get("startDate")
     end_date = params.get("endDate")
+    rollup = params.get("rollup")
+
+    m_def = registry.measure_definitions.get(measure_name)
+    threshold = m_def.aggregation_threshold if m_def else None
+
+    period = rollup.get("period") if rollup else None
+    if period is not None:
+        start_date = truncate_date(parse_date(start_date), period)
+        end_date = get_period_end(parse_date(end_date), period)
 
-    aggs = Aggregation.query_range_with_threshold(
-        measure_name, start_date, end_date, created_by
-    )
+    if rollup is None:
+        aggs = Aggregation.query_range_with_threshold(
+            measure_name, start_date, end_date, created_by, threshold
+        )
+    elif m_def and period in (m_def.rollup_periods or []):
+        if not rollup.get("groups"):
+            aggs = PeriodAggregation.query_range_with_threshold(
+                measure_name,
+                period,
+                start_date,
+                end_date,
+                created_by,
+                threshold,
+            )
+        else:
+            aggs = PeriodAggregation.query_range_with_threshold(
+                measure_name, period, start_date, end_date, created_by, 0
+            )
+            aggs = rollup_aggregates(m_def, aggs, {"groups": rollup["groups"]})
+            aggs = filter_threshold(aggs, threshold)
+    else:
+        aggs = Aggregation.query_range_with_threshold(
+            measure_name, start_date, end_date, created_by, threshold=0
+        )
+        aggs = filter_threshold(
+            rollup_aggregates(m_def, aggs, rollup), threshold
+        )
     results = []
     for agg in aggs:
         # Use camelCase for JSON API
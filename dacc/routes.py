@@ -1,10 +1,18 @@
 from dacc import dacc, db, validate, insertion, restitution, logger
-from dacc.models import Auth
+from dacc import configdata, registry, ingestion
+from dacc.consts import (
+    ASYNC_INGESTION,
+    GROUP_COMMIT_INGESTION,
+    SYNC_INGESTION,
+)
 from flask import json, jsonify, request
 from werkzeug.exceptions import HTTPException
 from flask_httpauth import HTTPTokenAuth
-from dacc import cache
-from dacc.exceptions import AccessException, ValidationException
+from dacc.exceptions import (
+    AccessException,
+    BufferFullException,
+    ValidationException,
+)
 
 auth = HTTPTokenAuth(scheme="Bearer")
 
@@ -14,11 +22,19 @@ def handle_error(err, code):
     return jsonify({"error": str(err)}), code
 
 
+@dacc.before_first_request
+def load_registries():
+    """Load the in-memory registries before serving the first request"""
+    try:
+        registry.measure_definitions.load()
+        registry.tokens.load()
+    except Exception as err:
+        logger.log("error", err)
+
+
 @auth.verify_token
-@cache.memoize(timeout=60)  # Cache for 1 minute
 def verify_token(token):
-    auth = Auth.query_by_token(token)
-    return auth.org if auth else None
+    return registry.tokens.get_org(token)
 
 
 @dacc.errorhandler(HTTPException)
@@ -35,6 +51,10 @@ def handle_exception(e):
 def add_raw_measure():
     """Add a raw measure to the database
 
+    In the async ingestion mode, the measure is appended to the write-behind
+    buffer and inserted later on. In the group-commit mode, it is inserted
+    in the same transaction as the measures of concurrent requests.
+
     Returns:
         HTTP response: {"ok": true} if everything went well
     """
@@ -44,10 +64,109 @@ def add_raw_measure():
             "info", "Received measure for: {}".format(measure["measureName"])
         )
         if validate.check_incoming_raw_measure(measure):
+            mode = configdata.get("ingestion:mode", SYNC_INGESTION)
+            if mode == ASYNC_INGESTION:
+                ingestion.write_behind_buffer.append(measure)
+                return jsonify({"ok": True}), 202
+            if mode == GROUP_COMMIT_INGESTION:
+                ingestion.group_committer.submit(measure)
+                return jsonify({"ok": True}), 201
             insertion.insert_raw_measure(measure)
             return jsonify({"ok": True}), 201
     except ValidationException as err:
         return handle_error(err, 400)
+    except BufferFullException as err:
+        return handle_error(err, 503)
+    except Exception as err:
+        return handle_error(err, 500)
+
+
+@dacc.route("/measures", methods=["POST"])
+@auth.login_required
+def add_raw_measures():
+    """Add a batch of raw measures to the database
+
+    Each measure is checked independently: the valid ones are inserted
+    together in a single transaction, while the invalid ones are reported
+    with their index in the batch.
+
+    With an application/x-ndjson body, the measures are read line by line
+    and inserted by chunks instead, see `add_raw_measures_stream`.
+
+    Returns:
+        HTTP response: {"ok": true, "inserted": n, "errors": []} if
+        everything went well
+    """
+    if request.mimetype == "application/x-ndjson":
+        return add_raw_measures_stream()
+    try:
+        measures = request.get_json()
+        valid_measures, errors = validate.check_incoming_raw_measures(
+            measures,
+            max_measures=configdata.get("ingestion:max_batch_size", 1000),
+        )
+        n_inserted = insertion.insert_raw_measures(valid_measures)
+        logger.log(
+            "info",
+            "Received {} measures, {} inserted".format(
+                len(measures), n_inserted
+            ),
+        )
+        code = 201 if n_inserted > 0 else 400
+        return (
+            jsonify(
+                {
+                    "ok": len(errors) == 0,
+                    "inserted": n_inserted,
+                    "errors": errors,
+                }
+            ),
+            code,
+        )
+    except ValidationException as err:
+        return handle_error(err, 400)
+    except Exception as err:
+        return handle_error(err, 500)
+
+
+def add_raw_measures_stream():
+    """Add raw measures streamed as NDJSON to the database
+
+    The request body is never fully loaded in memory: the measures are
+    parsed line by line and inserted by chunks of `ingestion:chunk_size`.
+
+    Returns:
+        HTTP response: {"ok": true, "inserted": n, "rejected": 0,
+        "errors": []} if everything went well
+    """
+    try:
+        (
+            n_inserted,
+            n_rejected,
+            errors,
+        ) = insertion.insert_raw_measures_from_lines(
+            request.stream,
+            chunk_size=configdata.get("ingestion:chunk_size", 1000),
+            max_errors=configdata.get("ingestion:max_reported_errors", 100),
+        )
+        logger.log(
+            "info",
+            "Received streamed measures: {} inserted, {} rejected".format(
+                n_inserted, n_rejected
+            ),
+        )
+        code = 201 if n_inserted > 0 else 400
+        return (
+            jsonify(
+                {
+                    "ok": n_rejected == 0,
+                    "inserted": n_inserted,
+                    "rejected": n_rejected,
+                    "errors": errors,
+                }
+            ),
+            code,
+        )
     except Exception as err:
         return handle_error(err, 500)
 
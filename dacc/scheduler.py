@@ -0,0 +1,303 @@
+from dacc import dacc, db, aggregation, consts, logger
+from dacc.models import AggregationDate, MeasureDefinition
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from datetime import datetime, timedelta
+import heapq
+import threading
+import time
+
+
+def aggregate_measure(measure_name: str, force=False):
+    """Aggregate the raw measures of a measure, in its own app context.
+
+    Args:
+        measure_name (str): The measure name
+        force (bool, optional): Ignore the execution frequency. Defaults to
+        False.
+
+    Returns:
+        dict: The aggregation result, with the measure name, the number of
+        saved aggregates, the last aggregated date and the error, if any.
+        The number of aggregates is None if no aggregation was made.
+    """
+    result = {
+        "measure_name": measure_name,
+        "aggregates": None,
+        "date": None,
+        "error": None,
+    }
+    with dacc.app_context():
+        try:
+            m_def = MeasureDefinition.query_by_name(measure_name)
+            if m_def is None:
+                result["error"] = "No measure definition found"
+                return result
+            aggregated = aggregation.aggregate_raw_measures(m_def, force=force)
+            if aggregated is None:
+                # The error is already logged by the aggregation
+                result["error"] = "The aggregation failed"
+                return result
+            n_aggs, date = aggregated
+            if n_aggs is not None:
+                result["aggregates"] = n_aggs
+                result["date"] = date
+        except Exception as err:
+            result["error"] = repr(err)
+        finally:
+            db.session.remove()
+    return result
+
+
+def init_worker():
+    """Make sure a worker process does not reuse the parent connections"""
+    with dacc.app_context():
+        db.engine.dispose()
+
+
+def aggregate_measures(measure_names: list, jobs: int, force=False):
+    """Aggregate several measures at the same time, in a process pool.
+
+    Each worker process has its own engine and session, and the measures
+    are aggregated independently: a failure does not stop the others.
+
+    Args:
+        measure_names (list(str)): The measure names
+        jobs (int): The number of worker processes
+        force (bool, optional): Ignore the execution frequency. Defaults to
+        False.
+
+    Yields:
+        dict: The aggregation result of each measure, as it completes. See
+        `aggregate_measure`.
+    """
+    # The workers are forked: do not let them inherit open connections
+    db.session.remove()
+    db.engine.dispose()
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=init_worker
+    ) as executor:
+        futures = {
+            executor.submit(aggregate_measure, name, force): name
+            for name in measure_names
+        }
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as err:
+                # The worker process itself failed
+                yield {
+                    "measure_name": futures[future],
+                    "aggregates": None,
+                    "date": None,
+                    "error": repr(err),
+                }
+
+
+def get_next_run_date(execution_frequency: str, last_date: datetime):
+    """Get the date a measure is due for aggregation, i.e. one execution
+    period after its last aggregated measure, see
+    `validate.is_execution_frequency_respected`.
+
+    Args:
+        execution_frequency (str): The execution frequency (day, week,
+        month)
+        last_date (datetime): The last aggregated measure date, or None if
+        the measure was never aggregated
+
+    Returns:
+        datetime: The next run date
+    """
+    if last_date is None:
+        return datetime.min
+    if execution_frequency is None:
+        execution_frequency = consts.DAY_PERIOD
+    days = consts.TIME_PERIOD[execution_frequency]
+    return last_date + timedelta(days=days)
+
+
+def query_next_run_dates(measure_names: list = None):
+    """Get the next run dates of the measures, in its own app context
+
+    Args:
+        measure_names (list(str), optional): The measure names. Defaults to
+        None, for all the measures.
+
+    Returns:
+        dict: The next run date by measure name
+    """
+    with dacc.app_context():
+        try:
+            query = db.session.query(
+                MeasureDefinition.name,
+                MeasureDefinition.execution_frequency,
+                AggregationDate.last_aggregated_measure_date,
+            ).outerjoin(MeasureDefinition.aggregation_date)
+            if measure_names is not None:
+                query = query.filter(MeasureDefinition.name.in_(measure_names))
+            return {
+                name: get_next_run_date(frequency, last_date)
+                for name, frequency, last_date in query
+            }
+        finally:
+            db.session.remove()
+
+
+class AggregationDaemon:
+    """Long-running aggregation of the measures, when they are due.
+
+    Each measure is scheduled at its next run date, see `get_next_run_date`,
+    and the due measures are aggregated by a pool of `jobs` threads. The
+    threads share the engine of the process, so the connections are kept
+    warm between runs.
+
+    A measure with nothing new to aggregate, or whose aggregation failed,
+    is retried after `poll_interval` seconds. The measure definitions are
+    reloaded every `refresh_interval` seconds, to schedule the new ones.
+    Only the given `measure_names` are scheduled, if any.
+    """
+
+    def __init__(
+        self,
+        jobs: int = 1,
+        measure_names: list = None,
+        poll_interval: float = 60,
+        refresh_interval: float = 300,
+        on_result=None,
+    ):
+        self.jobs = jobs
+        self.measure_names = measure_names
+        self.poll_interval = poll_interval
+        self.refresh_interval = refresh_interval
+        self.on_result = on_result
+        # (next run date, measure name) heap
+        self._schedule = []
+        self._scheduled = set()
+        self._running = {}
+        self._next_refresh = 0
+
+    def next_run_dates(self):
+        """Get the scheduled measures
+
+        Returns:
+            dict: The next run date by measure name, except for the
+            measures being aggregated
+        """
+        return {name: date for date, name in self._schedule}
+
+    def schedule(self, name: str, run_date: datetime):
+        heapq.heappush(self._schedule, (run_date, name))
+        self._scheduled.add(name)
+
+    def refresh(self):
+        """Schedule the measures that are not scheduled yet"""
+        running = set(self._running.values())
+        run_dates = query_next_run_dates(self.measure_names)
+        for name, run_date in run_dates.items():
+            if name not in self._scheduled and name not in running:
+                self.schedule(name, run_date)
+        self._next_refresh = time.monotonic() + self.refresh_interval
+
+    def reschedule(self, result: dict):
+        """Schedule the next run of an aggregated measure
+
+        Args:
+            result (dict): The aggregation result, see `aggregate_measure`
+        """
+        name = result["measure_name"]
+        retry_date = datetime.now() + timedelta(seconds=self.poll_interval)
+        try:
+            run_dates = query_next_run_dates([name])
+        except Exception as err:
+            message = "Cannot reschedule {}: {}".format(name, repr(err))
+            logger.log("error", message)
+            run_dates = {name: retry_date}
+        run_date = run_dates.get(name)
+        if run_date is None:
+            # The definition was removed
+            return
+        if result["error"] is not None or run_date <= datetime.now():
+            run_date = retry_date
+        self.schedule(name, run_date)
+
+    def submit_due_measures(self, executor: ThreadPoolExecutor):
+        now = datetime.now()
+        while (
+            len(self._schedule) > 0
+            and self._schedule[0][0] <= now
+            and len(self._running) < self.jobs
+        ):
+            _, name = heapq.heappop(self._schedule)
+            self._scheduled.discard(name)
+            future = executor.submit(aggregate_measure, name)
+            self._running[future] = name
+
+    def get_wait_timeout(self):
+        """Get the time to wait before the next due measure or refresh
+
+        Returns:
+            float: The timeout, in seconds
+        """
+        timeout = self._next_refresh - time.monotonic()
+        if len(self._schedule) > 0 and len(self._running) < self.jobs:
+            run_date = self._schedule[0][0]
+            due_in = (run_date - datetime.now()).total_seconds()
+            timeout = min(timeout, due_in)
+        return max(timeout, 0)
+
+    def complete(self, future):
+        name = self._running.pop(future)
+        try:
+            result = future.result()
+        except Exception as err:
+            result = {
+                "measure_name": name,
+                "aggregates": None,
+                "date": None,
+                "error": repr(err),
+            }
+        self.reschedule(result)
+        if self.on_result is not None:
+            self.on_result(result)
+
+    def run(self, stopped: threading.Event):
+        """Aggregate the due measures until stopped. The running
+        aggregations are completed before returning.
+
+        Args:
+            stopped (threading.Event): The event stopping the daemon
+        """
+        with ThreadPoolExecutor(
+            max_workers=self.jobs, thread_name_prefix="dacc-aggregation"
+        ) as executor:
+            while not stopped.is_set():
+                if time.monotonic() >= self._next_refresh:
+                    try:
+                        self.refresh()
+                    except Exception as err:
+                        message = "Cannot refresh the schedule: {}".format(
+                            repr(err)
+                        )
+                        logger.log("error", message)
+                        self._next_refresh = (
+                            time.monotonic() + self.poll_interval
+                        )
+                self.submit_due_measures(executor)
+
+                timeout = min(self.get_wait_timeout(), self.poll_interval)
+                if len(self._running) == 0:
+                    stopped.wait(timeout)
+                    continue
+                done, _ = wait(
+                    self._running, timeout=timeout, return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    self.complete(future)
+            for future in list(self._running):
+                self.complete(future)
@@ -0,0 +1,192 @@
+import math
+
+DEFAULT_COMPRESSION = 100
+
+
+def scale(q: float, compression: int):
+    """The t-digest k1 scale function, mapping a quantile to a centroid
+    index, so that the centroids are smaller at the tails"""
+    return compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch, a simplified t-digest.
+
+    The values are summarized by centroids, i.e. [mean, weight] pairs,
+    sorted by mean. As long as there are at most `compression` distinct
+    values, each centroid is a distinct value and the quantiles are exact,
+    interpolated as percentile_cont does. Beyond that, adjacent centroids
+    are merged, keeping about `compression / 2` centroids, smaller at the
+    tails, and the quantiles are approximated.
+
+    Two sketches can be merged, so that an aggregate sketch can be updated
+    with the sketch of new measures only.
+    """
+
+    def __init__(
+        self,
+        centroids: list = None,
+        compression: int = DEFAULT_COMPRESSION,
+        exact: bool = True,
+        min_value: float = None,
+        max_value: float = None,
+    ):
+        self.centroids = centroids or []
+        self.compression = compression
+        self.exact = exact
+        self.min = min_value
+        self.max = max_value
+
+    @classmethod
+    def from_values(cls, values: list, compression=DEFAULT_COMPRESSION):
+        """Build a sketch from raw values
+
+        Args:
+            values (list): The values
+            compression (int, optional): The maximum number of exact
+            centroids. Defaults to DEFAULT_COMPRESSION.
+
+        Returns:
+            QuantileSketch: The sketch
+        """
+        sketch = cls(compression=compression)
+        sketch._add_centroids([[float(v), 1] for v in values])
+        return sketch
+
+    @classmethod
+    def from_json(cls, data: dict):
+        if data is None:
+            return None
+        return cls(
+            centroids=data["centroids"],
+            compression=data["compression"],
+            exact=data["exact"],
+            min_value=data["min"],
+            max_value=data["max"],
+        )
+
+    def to_json(self):
+        return {
+            "centroids": self.centroids,
+            "compression": self.compression,
+            "exact": self.exact,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @property
+    def count(self):
+        return sum(weight for _, weight in self.centroids)
+
+    def merge(self, other: "QuantileSketch"):
+        """Merge with another sketch
+
+        Args:
+            other (QuantileSketch): The sketch to merge
+
+        Returns:
+            QuantileSketch: The merged sketch
+        """
+        merged = QuantileSketch(
+            centroids=[list(c) for c in self.centroids],
+            compression=max(self.compression, other.compression),
+            exact=self.exact and other.exact,
+            min_value=self.min,
+            max_value=self.max,
+        )
+        merged._add_centroids([list(c) for c in other.centroids])
+        if other.min is not None:
+            merged.min = min(merged.min, other.min)
+            merged.max = max(merged.max, other.max)
+        return merged
+
+    def _add_centroids(self, centroids: list):
+        centroids = sorted(self.centroids + centroids)
+        if len(centroids) == 0:
+            return
+        # When compressed, the centroids means are not the extreme values
+        lowest, highest = centroids[0][0], centroids[-1][0]
+        self.min = lowest if self.min is None else min(self.min, lowest)
+        self.max = highest if self.max is None else max(self.max, highest)
+
+        # Centroids of the same value are merged without loss
+        distinct = [centroids[0]]
+        for mean, weight in centroids[1:]:
+            if mean == distinct[-1][0]:
+                distinct[-1][1] += weight
+            else:
+                distinct.append([mean, weight])
+
+        if len(distinct) > self.compression:
+            distinct = self._compress(distinct)
+            self.exact = False
+        self.centroids = distinct
+
+    def _compress(self, centroids: list):
+        total = sum(weight for _, weight in centroids)
+        compressed = [list(centroids[0])]
+        weight_before = 0
+        k_lower = scale(0, self.compression)
+        for mean, weight in centroids[1:]:
+            current = compressed[-1]
+            q = (weight_before + current[1] + weight) / total
+            if scale(q, self.compression) - k_lower <= 1:
+                new_weight = current[1] + weight
+                current[0] += (mean - current[0]) * weight / new_weight
+                current[1] = new_weight
+            else:
+                weight_before += current[1]
+                k_lower = scale(weight_before / total, self.compression)
+                compressed.append([mean, weight])
+        return compressed
+
+    def quantile(self, q: float):
+        """Get the value of the given quantile
+
+        Args:
+            q (float): The quantile, between 0 and 1
+
+        Returns:
+            float: The value, or None if the sketch is empty
+        """
+        if len(self.centroids) == 0:
+            return None
+        if self.exact:
+            return self._exact_quantile(q)
+        return self._approximate_quantile(q)
+
+    def _exact_quantile(self, q: float):
+        # Linear interpolation between the closest ranks, as percentile_cont
+        position = q * (self.count - 1)
+        lower_rank = math.floor(position)
+        lower = upper = None
+        rank = 0
+        for mean, weight in self.centroids:
+            if lower is None and lower_rank < rank + weight:
+                lower = mean
+            if lower_rank + 1 < rank + weight:
+                upper = mean
+                break
+            rank += weight
+        if upper is None:
+            upper = lower
+        return lower + (upper - lower) * (position - lower_rank)
+
+    def _approximate_quantile(self, q: float):
+        # Interpolation between the centroids centers
+        target = q * self.count
+        previous_center = 0
+        previous_mean = self.min
+        rank = 0
+        for mean, weight in self.centroids:
+            center = rank + weight / 2
+            if target < center:
+                ratio = (target - previous_center) / (center - previous_center)
+                return previous_mean + (mean - previous_mean) * ratio
+            previous_center = center
+            previous_mean = mean
+            rank += weight
+        if rank == previous_center:
+            return self.max
+        ratio = (target - previous_center) / (rank - previous_center)
+        return previous_mean + (self.max - previous_mean) * ratio
@@ -0,0 +1,61 @@
+from dacc import db, configdata
+from sqlalchemy.sql import text
+
+MERGE_STAGED_MEASURES_SQL = """
+    WITH moved AS (
+        DELETE FROM raw_measure_staging
+        WHERE id IN (
+            SELECT id FROM raw_measure_staging
+            {filter}
+            ORDER BY id
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING measure_name, value, start_date, aggregation_period,
+        created_by, group1, group2, group3
+    )
+    INSERT INTO raw_measure (measure_name, value, start_date, last_updated,
+    aggregation_period, created_by, group1, group2, group3)
+    SELECT measure_name, value, start_date, now(), aggregation_period,
+    created_by, group1, group2, group3
+    FROM moved
+"""
+
+
+def is_staging_enabled():
+    return configdata.get("ingestion:staging", False) is True
+
+
+def merge_staged_measures(measure_name: str = None, batch_size: int = None):
+    """Move the staged raw measures into the raw_measure table.
+
+    The measures are moved by batches of `batch_size` rows, each batch with
+    a single INSERT ... SELECT statement in its own transaction. The
+    last_updated date is set when a measure is moved, so that it is
+    aggregated by the next aggregation run.
+
+    Args:
+        measure_name (str, optional): Only move the measures with this name.
+        Defaults to None.
+        batch_size (int, optional): The maximum number of measures moved in
+        a transaction. Defaults to the ingestion:staging_batch_size config.
+
+    Returns:
+        int: The number of moved measures
+    """
+    if batch_size is None:
+        batch_size = configdata.get("ingestion:staging_batch_size", 100000)
+    params = {"batch_size": batch_size}
+    measure_filter = ""
+    if measure_name is not None:
+        measure_filter = "WHERE measure_name = :measure_name"
+        params["measure_name"] = measure_name
+    stmt = text(MERGE_STAGED_MEASURES_SQL.format(filter=measure_filter))
+
+    n_moved = 0
+    while True:
+        n_batch = db.session.execute(stmt, params).rowcount
+        db.session.commit()
+        n_moved += n_batch
+        if n_batch < batch_size:
+            return n_moved
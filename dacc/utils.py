@@ -1,5 +1,6 @@
 from dacc import consts
-from datetime import datetime
+from datetime import datetime, timedelta
+from dateutil.parser import parse
 from sqlalchemy.engine.reflection import Inspector
 from alembic import op
 
@@ -52,3 +53,72 @@ def to_camel_case(snake_str: str):
     """
     tokens = snake_str.split("_")
     return tokens[0] + "".join(x.title() for x in tokens[1:])
+
+
+def parse_date(value):
+    """Parse a date, expected in the ISO 8601 format
+
+    The strict ISO 8601 parsing is tried first, as it is much faster.
+    Other formats fall back on dateutil parsing.
+
+    Args:
+        value (str): The date to parse
+
+    Raises:
+        ValueError: The value is not a date
+
+    Returns:
+        datetime: The parsed date
+    """
+    if isinstance(value, datetime):
+        return value
+    try:
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        return datetime.fromisoformat(value)
+    except (AttributeError, ValueError):
+        pass
+    try:
+        return parse(value)
+    except (TypeError, OverflowError) as err:
+        raise ValueError(str(err))
+
+
+def truncate_date(date: datetime, period: str):
+    """Truncate a date to the start of its period
+
+    Args:
+        date (datetime): The date to truncate
+        period (str): The time period (day, week, month). A week starts on
+        Monday.
+
+    Returns:
+        datetime: The start of the period
+    """
+    day = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == consts.WEEK_PERIOD:
+        return day - timedelta(days=day.weekday())
+    if period == consts.MONTH_PERIOD:
+        return day.replace(day=1)
+    return day
+
+
+def get_period_end(date: datetime, period: str):
+    """Get the end of the period of a date, i.e. the start of the next
+    period, unless the date is the start of its period
+
+    Args:
+        date (datetime): The date
+        period (str): The time period (day, week, month)
+
+    Returns:
+        datetime: The end of the period, excluded
+    """
+    start = truncate_date(date, period)
+    if start == date:
+        return date
+    if period == consts.WEEK_PERIOD:
+        return start + timedelta(days=7)
+    if period == consts.MONTH_PERIOD:
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
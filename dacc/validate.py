@@ -1,20 +1,120 @@
 from dacc.models import MeasureDefinition
-from dacc import utils
+from dacc import consts, utils, registry
 from dacc.exceptions import AccessException, ValidationException
-from dateutil.parser import parse
 from datetime import datetime
 
 
 def check_date(params, date_key):
+    """Check the date is valid and replace it by the parsed date.
+
+    The time zone offset is dropped, as PostgreSQL does when a date is
+    given for a TIMESTAMP column: the parsed date can thus be used as is
+    for insertion and queries.
+
+    Args:
+        params (dict): The params including the date
+        date_key (str): The date key in params
+
+    Raises:
+        ValidationException: The date is not given
+        ValidationException: The date is not correct
+
+    Returns:
+        datetime: The parsed date
+    """
     if date_key not in params:
         raise ValidationException("{} must be given".format(date_key))
     try:
-        parse(params[date_key])
-        return True
+        date = utils.parse_date(params[date_key]).replace(tzinfo=None)
     except ValueError:
         raise ValidationException(
             "{} type is incorrect, it must be a date".format(date_key)
         )
+    params[date_key] = date
+    return date
+
+
+class RawMeasureValidator:
+    """Validator of the raw measures of a measure definition.
+
+    The expected groups are compiled once from the definition, so that
+    checking a measure does not allocate nor query anything.
+    """
+
+    __slots__ = ("groups",)
+
+    def __init__(self, m_def):
+        # (group name, name used in errors, expected key)
+        self.groups = tuple(
+            (
+                "group{}".format(i),
+                "Group{}".format(i),
+                getattr(m_def, "group{}_key".format(i)),
+            )
+            for i in range(1, 4)
+        )
+
+    def validate(self, measure: dict):
+        """Check the measure value, date and groups
+
+        Args:
+            measure (dict): The raw measure, with a known measure name
+
+        Raises:
+            ValidationException: The measure is not valid
+        """
+        if "value" not in measure:
+            raise ValidationException("A value must be given")
+        value = measure["value"]
+        if type(value) is not int and type(value) is not float:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise ValidationException(
+                    "value type is incorrect, it must be a number"
+                )
+        # Not a comparison the other way round, to refuse NaN
+        if not abs(value) <= consts.MAX_RAW_MEASURE_VALUE:
+            error = "value is out of range, it must be between -{0} and {0}"
+            raise ValidationException(
+                error.format(consts.MAX_RAW_MEASURE_VALUE)
+            )
+
+        check_date(measure, "startDate")
+
+        # A wrong groups format takes precedence over a key mismatch
+        mismatch = None
+        for name, label, expected_key in self.groups:
+            key = None
+            if name in measure:
+                group = measure[name]
+                if not isinstance(group, dict) or len(group) == 0:
+                    raise ValidationException("groups format is incorrect")
+                key = next(iter(group))
+            if key != expected_key and mismatch is None:
+                mismatch = "{} key does not match measure definition: {}"
+                mismatch = mismatch.format(label, key)
+        if mismatch is not None:
+            raise ValidationException(mismatch)
+
+
+def get_validator(m_def):
+    """Get the validator of a measure definition, compiled on first use.
+
+    The validator is cached on the registry entry, hence it is compiled
+    again when the definitions are reloaded.
+
+    Args:
+        m_def (MeasureDefinitionEntry): The measure definition
+
+    Returns:
+        RawMeasureValidator: The validator
+    """
+    validator = m_def.validator
+    if validator is None:
+        validator = RawMeasureValidator(m_def)
+        m_def.validator = validator
+    return validator
 
 
 def check_incoming_raw_measure(measure):
@@ -28,6 +128,7 @@ def check_incoming_raw_measure(measure):
         ValidationException: The measure name does not exist
         ValidationException: The value is not given
         ValidationException: The value type is not correct
+        ValidationException: The value is out of range
         ValidationException: The startDate is not given
         ValidationException: The startDate is not correct
         ValidationException: The groups format is not correct
@@ -43,7 +144,7 @@ def check_incoming_raw_measure(measure):
     if "measureName" not in measure:
         raise ValidationException("A measure name must be given")
 
-    m_def = MeasureDefinition.query_by_name(measure["measureName"])
+    m_def = registry.measure_definitions.get(measure["measureName"])
     if m_def is None:
         raise ValidationException(
             "No measure definition found for: {}".format(
@@ -51,49 +152,52 @@ def check_incoming_raw_measure(measure):
             )
         )
 
-    if "value" not in measure:
-        raise ValidationException("A value must be given")
-    try:
-        float(measure["value"])
-    except ValueError:
-        raise ValidationException(
-            "value type is incorrect, it must be a number"
-        )
+    get_validator(m_def).validate(measure)
+    return True
 
-    check_date(measure, "startDate")
 
-    group1_key = None
-    group2_key = None
-    group3_key = None
-    try:
-        if "group1" in measure:
-            group1_key = list(measure["group1"].keys())[0]
-        if "group2" in measure:
-            group2_key = list(measure["group2"].keys())[0]
-        if "group3" in measure:
-            group3_key = list(measure["group3"].keys())[0]
-    except Exception:
-        raise ValidationException("groups format is incorrect")
-
-    if m_def.group1_key != group1_key:
-        raise ValidationException(
-            "Group1 key does not match measure definition: {}".format(
-                group1_key
-            )
-        )
-    if m_def.group2_key != group2_key:
-        raise ValidationException(
-            "Group2 key does not match measure definition: {}".format(
-                group2_key
-            )
-        )
-    if m_def.group3_key != group3_key:
+def check_incoming_raw_measures(measures, max_measures=None):
+    """Check a batch of incoming raw measures.
+
+    Each measure is checked independently: an invalid measure does not
+    invalidate the others.
+
+    Args:
+        measures (list(dict)): The raw measures
+        max_measures (int, optional): The maximum number of measures
+        accepted in a batch. Defaults to None.
+
+    Raises:
+        ValidationException: The measures are not given as a list
+        ValidationException: The measures list is empty
+        ValidationException: There are too many measures
+
+    Returns:
+        (list(dict), list(dict)): The valid measures and the errors, with
+        the index of the invalid measure in the batch
+    """
+    if not isinstance(measures, list):
+        raise ValidationException("The measures must be given as a list")
+    if len(measures) == 0:
+        raise ValidationException("The measures cannot be empty")
+    if max_measures is not None and len(measures) > max_measures:
         raise ValidationException(
-            "Group3 key does not match measure definition: {}".format(
-                group3_key
+            "Too many measures: {} given, {} maximum".format(
+                len(measures), max_measures
             )
         )
-    return True
+
+    valid_measures = []
+    errors = []
+    for index, measure in enumerate(measures):
+        try:
+            if not isinstance(measure, dict):
+                raise ValidationException("The measure format is incorrect")
+            check_incoming_raw_measure(measure)
+            valid_measures.append(measure)
+        except ValidationException as err:
+            errors.append({"index": index, "error": str(err)})
+    return valid_measures, errors
 
 
 def is_execution_frequency_respected(
@@ -134,6 +238,7 @@ def check_restitution_params(params):
         ValidationException: The startDate is not correct
         ValidationException: The endDate is not given
         ValidationException: The endDate is not correct
+        ValidationException: The rollup option is not correct
         AccessException: The access is not authorized for this measure
 
     Returns:
@@ -145,7 +250,7 @@ def check_restitution_params(params):
     if "measureName" not in params:
         raise ValidationException("A measure name must be given")
 
-    m_def = MeasureDefinition.query_by_name(params["measureName"])
+    m_def = registry.measure_definitions.get(params["measureName"])
     if m_def is None:
         raise ValidationException(
             "No measure definition found for: {}".format(params["measureName"])
@@ -158,5 +263,96 @@ def check_restitution_params(params):
 
     check_date(params, "startDate")
     check_date(params, "endDate")
+    check_rollup(params.get("rollup"), m_def)
 
     return True
+
+
+def check_rollup_period(period: str, aggregation_period: str):
+    """Check the aggregates of a measure can be merged into a period.
+
+    The period must be coarser than the aggregation period, and made of
+    whole aggregation periods: as a week can straddle two months, weekly
+    aggregates cannot be merged by month. Without aggregation period, only
+    the period itself is checked.
+
+    Args:
+        period (str): The period to merge the aggregates into
+        aggregation_period (str): The aggregation period of the measure
+
+    Raises:
+        ValidationException: The period is not a time period
+        ValidationException: The period is not coarser than the aggregation
+        period
+        ValidationException: Weekly aggregates are merged by month
+    """
+    if period not in consts.TIME_PERIOD:
+        raise ValidationException(
+            "The rollup period must be one of: {}".format(
+                ", ".join(consts.TIME_PERIOD.keys())
+            )
+        )
+    if aggregation_period not in consts.TIME_PERIOD:
+        return
+    if consts.TIME_PERIOD[period] <= consts.TIME_PERIOD[aggregation_period]:
+        raise ValidationException(
+            "The rollup period must be coarser than the aggregation period: "
+            "{}".format(aggregation_period)
+        )
+    if (
+        aggregation_period == consts.WEEK_PERIOD
+        and period == consts.MONTH_PERIOD
+    ):
+        raise ValidationException(
+            "The weekly aggregates cannot be rolled up by month"
+        )
+
+
+def check_rollup_periods(rollup_periods, aggregation_period: str):
+    """Check the rollup periods of a measure definition.
+
+    Args:
+        rollup_periods (list(str)): The rollup periods. Can be None.
+        aggregation_period (str): The aggregation period of the measure
+
+    Raises:
+        ValidationException: The rollup periods are not a list
+        ValidationException: A rollup period is not correct, see
+        check_rollup_period
+    """
+    if rollup_periods is None:
+        return
+    if type(rollup_periods) is not list:
+        raise ValidationException("The rollup periods must be a list")
+    for period in rollup_periods:
+        check_rollup_period(period, aggregation_period)
+
+
+def check_rollup(rollup, m_def):
+    """Check the rollup option of an aggregate restitution query.
+
+    Args:
+        rollup (dict): The rollup option, with the groups to collapse and
+        the target period. Can be None.
+        m_def (MeasureDefinitionEntry): The measure definition
+
+    Raises:
+        ValidationException: The rollup option is not an object
+        ValidationException: The groups are not a list of groups
+        ValidationException: The period is not correct, see
+        check_rollup_period
+    """
+    if rollup is None:
+        return
+    if type(rollup) is not dict:
+        raise ValidationException("The rollup must be an object")
+    groups = rollup.get("groups", [])
+    if type(groups) is not list or any(
+        g not in ["group1", "group2", "group3"] for g in groups
+    ):
+        raise ValidationException(
+            "The rollup groups must be a list of group1, group2, group3"
+        )
+    period = rollup.get("period")
+    if period is not None:
+        check_rollup_period(period, m_def.aggregation_period)
@@ -0,0 +1,49 @@
+"""empty message
+
+Revision ID: 392ef62467f2
+Revises: f6eb789920e2
+Create Date: 2026-10-18 10:12:41.218634
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "392ef62467f2"
+down_revision = "f6eb789920e2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "raw_measure_staging",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("measure_name", sa.String(length=100), nullable=True),
+        sa.Column("value", sa.Numeric(precision=12, scale=2), nullable=True),
+        sa.Column("start_date", sa.TIMESTAMP(), nullable=True),
+        sa.Column("aggregation_period", sa.String(length=100), nullable=True),
+        sa.Column("created_by", sa.String(length=100), nullable=True),
+        sa.Column(
+            "group1",
+            postgresql.JSONB(none_as_null=True, astext_type=sa.Text()),
+            nullable=True,
+        ),
+        sa.Column(
+            "group2",
+            postgresql.JSONB(none_as_null=True, astext_type=sa.Text()),
+            nullable=True,
+        ),
+        sa.Column(
+            "group3",
+            postgresql.JSONB(none_as_null=True, astext_type=sa.Text()),
+            nullable=True,
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        prefixes=["UNLOGGED"],
+    )
+
+
+def downgrade():
+    op.drop_table("raw_measure_staging")
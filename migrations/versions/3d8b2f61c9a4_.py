@@ -0,0 +1,34 @@
+"""empty message
+
+Revision ID: 3d8b2f61c9a4
+Revises: e1f83c5a9d27
+Create Date: 2026-10-18 21:12:45.318204
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "3d8b2f61c9a4"
+down_revision = "e1f83c5a9d27"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "registry_version",
+        sa.Column("name", sa.String(length=50), nullable=False),
+        sa.Column(
+            "version",
+            sa.Integer(),
+            server_default=sa.text("0"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+
+def downgrade():
+    op.drop_table("registry_version")
@@ -0,0 +1,27 @@
+"""empty message
+
+Revision ID: 5c1e0b7d2a94
+Revises: 392ef62467f2
+Create Date: 2026-10-18 14:02:17.604215
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5c1e0b7d2a94"
+down_revision = "392ef62467f2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "idx_auth_by_token",
+        "auth",
+        ["token"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("idx_auth_by_token", table_name="auth")
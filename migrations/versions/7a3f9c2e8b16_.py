@@ -0,0 +1,107 @@
+"""empty message
+
+Revision ID: 7a3f9c2e8b16
+Revises: 5c1e0b7d2a94
+Create Date: 2026-10-18 15:21:43.118503
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "7a3f9c2e8b16"
+down_revision = "5c1e0b7d2a94"
+branch_labels = None
+depends_on = None
+
+AGGREGATE_KEY = """
+    measure_name,
+    start_date,
+    coalesce(created_by, ''),
+    coalesce(group1, 'null'::jsonb),
+    coalesce(group2, 'null'::jsonb),
+    coalesce(group3, 'null'::jsonb)
+"""
+
+# Merge the aggregates with the same key into the one with the highest
+# count, which keeps its quartiles, and delete the others. The std is
+# merged from the sums of squares estimated from each std.
+MERGE_DUPLICATE_AGGREGATES_SQL = """
+    WITH duplicates AS (
+        SELECT
+            id,
+            first_value(id) OVER key_window AS kept_id,
+            count(*) OVER key_window AS n_aggregates
+        FROM aggregation
+        WINDOW key_window AS (
+            PARTITION BY {key} ORDER BY count DESC NULLS LAST, id
+            ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+        )
+    ), merged AS (
+        SELECT
+            d.kept_id,
+            sum(a.count) AS count,
+            sum(a.count_not_zero) AS count_not_zero,
+            sum(a.sum) AS sum,
+            min(a.min) AS min,
+            max(a.max) AS max,
+            sum(
+                (a.count - 1) * power(coalesce(a.std, 0), 2)
+                + power(a.sum, 2) / nullif(a.count, 0)
+            ) AS sum_of_squares,
+            max(a.last_updated) AS last_updated,
+            max(a.last_raw_measures_purged) AS last_raw_measures_purged
+        FROM duplicates AS d
+        JOIN aggregation AS a ON a.id = d.id
+        WHERE d.n_aggregates > 1
+        GROUP BY d.kept_id
+    ), updated AS (
+        UPDATE aggregation AS agg
+        SET
+            count = merged.count,
+            count_not_zero = merged.count_not_zero,
+            sum = merged.sum,
+            min = merged.min,
+            max = merged.max,
+            avg = merged.sum / nullif(merged.count, 0),
+            std = CASE WHEN merged.count < 2 THEN 0 ELSE sqrt(greatest(
+                (
+                    merged.sum_of_squares
+                    - power(merged.sum, 2) / merged.count
+                )
+                / (merged.count - 1),
+                0
+            )) END,
+            last_updated = merged.last_updated,
+            last_raw_measures_purged = merged.last_raw_measures_purged
+        FROM merged
+        WHERE agg.id = merged.kept_id
+    )
+    DELETE FROM aggregation AS agg
+    USING duplicates AS d
+    WHERE agg.id = d.id AND d.id <> d.kept_id
+""".format(
+    key=AGGREGATE_KEY
+)
+
+
+def upgrade():
+    # The unique index cannot be created over duplicate aggregates
+    op.execute(MERGE_DUPLICATE_AGGREGATES_SQL)
+    op.create_index(
+        "idx_unique_aggregate_key",
+        "aggregation",
+        [
+            "measure_name",
+            "start_date",
+            sa.text("coalesce(created_by, '')"),
+            sa.text("coalesce(group1, 'null'::jsonb)"),
+            sa.text("coalesce(group2, 'null'::jsonb)"),
+            sa.text("coalesce(group3, 'null'::jsonb)"),
+        ],
+        unique=True,
+    )
+
+
+def downgrade():
+    op.drop_index("idx_unique_aggregate_key", table_name="aggregation")
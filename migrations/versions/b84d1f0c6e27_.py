@@ -0,0 +1,41 @@
+"""empty message
+
+Revision ID: b84d1f0c6e27
+Revises: 7a3f9c2e8b16
+Create Date: 2026-10-18 16:48:09.337021
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "b84d1f0c6e27"
+down_revision = "7a3f9c2e8b16"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "measure_definition",
+        sa.Column(
+            "with_quantile_sketch",
+            sa.Boolean(),
+            server_default=sa.text("false"),
+            nullable=True,
+        ),
+    )
+    op.add_column(
+        "aggregation",
+        sa.Column(
+            "quantile_sketch",
+            postgresql.JSONB(none_as_null=True, astext_type=sa.Text()),
+            nullable=True,
+        ),
+    )
+
+
+def downgrade():
+    op.drop_column("aggregation", "quantile_sketch")
+    op.drop_column("measure_definition", "with_quantile_sketch")
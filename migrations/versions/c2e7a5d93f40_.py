@@ -0,0 +1,35 @@
+"""empty message
+
+Revision ID: c2e7a5d93f40
+Revises: b84d1f0c6e27
+Create Date: 2026-10-18 17:35:52.640118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "c2e7a5d93f40"
+down_revision = "b84d1f0c6e27"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "aggregation",
+        sa.Column("sum_of_squares", sa.Numeric(), nullable=True),
+    )
+    # Best effort from the rounded std, as the raw measures might be purged
+    op.execute(
+        """
+        UPDATE aggregation
+        SET sum_of_squares =
+            (count - 1) * power(coalesce(std, 0), 2) + power(sum, 2) / count
+        WHERE count > 0
+        """
+    )
+
+
+def downgrade():
+    op.drop_column("aggregation", "sum_of_squares")
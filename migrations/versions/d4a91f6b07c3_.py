@@ -0,0 +1,31 @@
+"""empty message
+
+Revision ID: d4a91f6b07c3
+Revises: c2e7a5d93f40
+Create Date: 2026-10-18 18:12:40.518273
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "d4a91f6b07c3"
+down_revision = "c2e7a5d93f40"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "measure_definition",
+        sa.Column(
+            "wildcard_groups",
+            postgresql.JSONB(none_as_null=True, astext_type=sa.Text()),
+            nullable=True,
+        ),
+    )
+
+
+def downgrade():
+    op.drop_column("measure_definition", "wildcard_groups")
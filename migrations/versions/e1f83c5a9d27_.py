@@ -0,0 +1,82 @@
+"""empty message
+
+Revision ID: e1f83c5a9d27
+Revises: d4a91f6b07c3
+Create Date: 2026-10-18 19:03:27.784512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "e1f83c5a9d27"
+down_revision = "d4a91f6b07c3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "period_aggregation",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("measure_name", sa.String(length=100), nullable=True),
+        sa.Column("period", sa.String(length=50), nullable=True),
+        sa.Column("start_date", sa.TIMESTAMP(), nullable=True),
+        sa.Column("last_updated", sa.DateTime(), nullable=True),
+        sa.Column("created_by", sa.String(length=100), nullable=True),
+        sa.Column(
+            "group1",
+            postgresql.JSONB(none_as_null=True, astext_type=sa.Text()),
+            nullable=True,
+        ),
+        sa.Column(
+            "group2",
+            postgresql.JSONB(none_as_null=True, astext_type=sa.Text()),
+            nullable=True,
+        ),
+        sa.Column(
+            "group3",
+            postgresql.JSONB(none_as_null=True, astext_type=sa.Text()),
+            nullable=True,
+        ),
+        sa.Column("sum", sa.Numeric(precision=12, scale=2), nullable=True),
+        sa.Column("count", sa.Integer(), nullable=True),
+        sa.Column("count_not_zero", sa.Integer(), nullable=True),
+        sa.Column("min", sa.Numeric(precision=12, scale=2), nullable=True),
+        sa.Column("max", sa.Numeric(precision=12, scale=2), nullable=True),
+        sa.Column("avg", sa.Numeric(precision=12, scale=2), nullable=True),
+        sa.Column("std", sa.Numeric(precision=12, scale=2), nullable=True),
+        sa.Column("sum_of_squares", sa.Numeric(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "idx_unique_period_aggregate_key",
+        "period_aggregation",
+        [
+            "measure_name",
+            "period",
+            "start_date",
+            sa.text("coalesce(created_by, '')"),
+            sa.text("coalesce(group1, 'null'::jsonb)"),
+            sa.text("coalesce(group2, 'null'::jsonb)"),
+            sa.text("coalesce(group3, 'null'::jsonb)"),
+        ],
+        unique=True,
+    )
+    op.add_column(
+        "measure_definition",
+        sa.Column(
+            "rollup_periods",
+            postgresql.JSONB(none_as_null=True, astext_type=sa.Text()),
+            nullable=True,
+        ),
+    )
+
+
+def downgrade():
+    op.drop_column("measure_definition", "rollup_periods")
+    op.drop_index(
+        "idx_unique_period_aggregate_key", table_name="period_aggregation"
+    )
+    op.drop_table("period_aggregation")
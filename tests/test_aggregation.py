@@ -1,17 +1,21 @@
 import pytest
-from dacc import db, aggregation, purge
+from dacc import db, aggregation, purge, configdata
 from dacc.models import (
     RawMeasure,
     AggregationDate,
     Aggregation,
     MeasureDefinition,
     RefusedRawMeasure,
+    PeriodAggregation,
 )
 
 import pandas as pd
 from sqlalchemy import distinct
 import numpy as np
+import json
 from datetime import datetime, timedelta
+from types import SimpleNamespace
+from decimal import Decimal
 
 
 def query_all_measures_name():
@@ -296,6 +300,135 @@ def test_compute_partial_aggregates():
     assert round(agg.std, 4) == round(np.std(values_g1 + values_g2, ddof=1), 4)
 
 
+def test_compute_partial_aggregates_with_moments():
+    measure_name = "connection-count-daily"
+    start_date = "2021-05-01"
+    batches = [[5.5, 10, 10.25], [0, 6, 20], [1.125], [3, 3.5, 7, 9.75]]
+
+    def to_aggregate(values):
+        return Aggregation(
+            measure_name=measure_name,
+            start_date=start_date,
+            sum=np.sum(values),
+            count=len(values),
+            count_not_zero=len(np.nonzero(values)[0]),
+            min=np.min(values),
+            max=np.max(values),
+            avg=np.mean(values),
+            # Rounded as in database
+            std=round(np.std(values, ddof=1), 2) if len(values) > 1 else 0,
+            sum_of_squares=np.sum(np.square(values)),
+        )
+
+    agg = to_aggregate(batches[0])
+    for values in batches[1:]:
+        agg = aggregation.compute_partial_aggregates(
+            measure_name, agg, to_aggregate(values)
+        )
+    all_values = [v for values in batches for v in values]
+    assert agg.sum_of_squares == np.sum(np.square(all_values))
+    # Exact, despite the rounded std of each batch
+    assert agg.std == pytest.approx(np.std(all_values, ddof=1), abs=1e-9)
+
+    # Without sum of squares, the std is merged from the rounded ones
+    current_agg = to_aggregate(batches[0])
+    current_agg.sum_of_squares = None
+    agg = aggregation.compute_partial_aggregates(
+        measure_name, current_agg, to_aggregate(batches[1])
+    )
+    assert agg.sum_of_squares is None
+    assert agg.std == pytest.approx(
+        np.std(batches[0] + batches[1], ddof=1), abs=0.01
+    )
+
+
+def test_merge_partial_aggregates():
+    measure_name = "connection-count-daily"
+    start_date = "2021-05-01"
+    rng = np.random.default_rng(42)
+
+    def to_aggregate(values, with_sum_of_squares=True):
+        return Aggregation(
+            measure_name=measure_name,
+            start_date=start_date,
+            sum=np.sum(values),
+            count=len(values),
+            count_not_zero=len(np.nonzero(values)[0]),
+            min=np.min(values),
+            max=np.max(values),
+            avg=np.mean(values),
+            std=np.std(values, ddof=1) if len(values) > 1 else 0,
+            sum_of_squares=(
+                np.sum(np.square(values)) if with_sum_of_squares else None
+            ),
+        )
+
+    pairs = []
+    for i in range(50):
+        current_values = rng.integers(0, 100, rng.integers(1, 20)).tolist()
+        new_values = rng.integers(0, 100, rng.integers(1, 20)).tolist()
+        pairs.append(
+            (
+                to_aggregate(current_values, with_sum_of_squares=i % 5 > 0),
+                to_aggregate(new_values),
+            )
+        )
+    expected = [
+        aggregation.compute_partial_aggregates(measure_name, current, new)
+        for current, new in pairs
+    ]
+    merged = aggregation.merge_partial_aggregates(pairs)
+
+    assert aggregation.merge_partial_aggregates([]) == []
+    assert len(merged) == len(expected)
+    for agg, expected_agg in zip(merged, expected):
+        assert type(agg.count) is int
+        assert agg.count == expected_agg.count
+        assert agg.count_not_zero == expected_agg.count_not_zero
+        # The sums are kept exact
+        assert type(agg.sum) is Decimal
+        assert float(agg.sum) == pytest.approx(expected_agg.sum)
+        assert agg.min == expected_agg.min
+        assert agg.max == expected_agg.max
+        assert float(agg.avg) == pytest.approx(expected_agg.avg)
+        assert agg.std == pytest.approx(expected_agg.std)
+        if expected_agg.sum_of_squares is None:
+            assert agg.sum_of_squares is None
+        else:
+            assert type(agg.sum_of_squares) is Decimal
+            assert float(agg.sum_of_squares) == pytest.approx(
+                expected_agg.sum_of_squares
+            )
+
+
+def test_merge_partial_aggregates_exact_moments():
+    # Large values with a small spread: the float moments would cancel
+    current_values = [Decimal("123456789.01"), Decimal("123456789.03")]
+    new_values = [Decimal("123456789.02"), Decimal("123456789.04")]
+
+    def to_aggregate(values):
+        return aggregation.AggregateRecord(
+            SimpleNamespace(
+                sum=sum(values),
+                count=len(values),
+                count_not_zero=len(values),
+                min=min(values),
+                max=max(values),
+                avg=sum(values) / len(values),
+                std=0,
+                sum_of_squares=sum(v * v for v in values),
+            )
+        )
+
+    [agg] = aggregation.merge_partial_aggregates(
+        [(to_aggregate(current_values), to_aggregate(new_values))]
+    )
+    values = current_values + new_values
+    assert agg.sum == sum(values)
+    assert agg.sum_of_squares == sum(v * v for v in values)
+    assert agg.std == pytest.approx(np.std([1, 3, 2, 4], ddof=1) / 100)
+
+
 def test_compute_grouped_std():
 
     values = [0, 5, 10, 10, 15, 20, 20]
@@ -317,8 +450,8 @@ def test_compute_grouped_std():
 
 def test_aggregation_execution():
     m_def = MeasureDefinition.query_by_name("connection-count-daily")
-    agg, date = aggregation.aggregate_raw_measures(m_def)
-    assert len(agg) == 3
+    n_aggs, date = aggregation.aggregate_raw_measures(m_def)
+    assert n_aggs == 3
     assert date == datetime(2021, 5, 3, 0, 0, 0, 4000)
 
     # No new measure
@@ -335,8 +468,8 @@ def test_aggregation_execution():
     )
     db.session.add(m)
     db.session.commit()
-    agg, date = aggregation.aggregate_raw_measures(m_def)
-    assert len(agg) == 1
+    n_aggs, date = aggregation.aggregate_raw_measures(m_def)
+    assert n_aggs == 1
 
     # Execution date is too close
     m = RawMeasure(
@@ -356,10 +489,16 @@ def test_aggregation_execution():
     agg_date.last_aggregated_measure_date = datetime.now() - timedelta(days=1)
     db.session.add(m)
     db.session.commit()
-    agg, date = aggregation.aggregate_raw_measures(m_def)
-    assert len(agg) == 2
-    assert agg[0].start_date == datetime(2021, 5, 2)
-    assert agg[1].start_date == datetime(2021, 5, 3)
+    n_aggs, date = aggregation.aggregate_raw_measures(m_def)
+    assert n_aggs == 2
+    aggs = Aggregation.query.filter(
+        Aggregation.measure_name == m_def.name,
+        Aggregation.start_date >= datetime(2021, 5, 2),
+    )
+    assert {agg.start_date for agg in aggs} == {
+        datetime(2021, 5, 2),
+        datetime(2021, 5, 3),
+    }
 
 
 def get_raw_values_as_dataframes(start_date):
@@ -392,8 +531,16 @@ def test_incremental_aggregation_quartiles():
 
     df_food, df_hobby = get_raw_values_as_dataframes("2021-06-01")
 
-    agg, date = aggregation.aggregate_raw_measures(m_def)
+    def query_aggregates():
+        return (
+            Aggregation.query.filter(Aggregation.measure_name == measure_name)
+            .order_by(Aggregation.start_date, Aggregation.group1)
+            .all()
+        )
 
+    n_aggs, date = aggregation.aggregate_raw_measures(m_def)
+    assert n_aggs == 2
+    agg = query_aggregates()
     assert len(agg) == 2
     assert agg[0].group1 == {"category": "food"}
     assert agg[0].median == df_food["value"].quantile(0.5)
@@ -449,7 +596,10 @@ def test_incremental_aggregation_quartiles():
 
     df_food, df_hobby = get_raw_values_as_dataframes("2021-06-01")
 
-    agg, date = aggregation.aggregate_raw_measures(m_def)
+    n_aggs, date = aggregation.aggregate_raw_measures(m_def)
+    assert n_aggs == 3
+    db.session.expire_all()
+    agg = query_aggregates()
     assert len(agg) == 3
     assert agg[0].group1 == {"category": "food"}
     assert agg[0].median == df_food["value"].quantile(0.5)
@@ -505,7 +655,7 @@ def test_backup_rejected_raw_measures():
     for m in measures:
         db.session.add(m)
 
-    aggs, date = aggregation.aggregate_raw_measures(m_def)
+    n_aggs, date = aggregation.aggregate_raw_measures(m_def)
 
     all_refused = db.session.query(RefusedRawMeasure).all()
     assert len(all_refused) == 3
@@ -516,7 +666,54 @@ def test_backup_rejected_raw_measures():
     assert all_refused[2].value == 40
     assert all_refused[2].rejected_date is not None
 
-    assert len(aggs) == 0
+    assert n_aggs == 0
+
+
+def test_backup_rejected_raw_measures_by_keys():
+    m_def = SimpleNamespace(name="rejected-measures")
+    measures = [
+        ("2021-06-01T00:00:00", 10, "food"),
+        ("2021-06-02T00:00:00", 100, "hobby"),
+        ("2021-06-03T00:00:00", 20, "food"),
+        ("2021-06-04T00:00:00", 13, "food"),
+        ("2021-06-02T00:00:00", 40, "travel"),
+    ]
+    for last_updated, value, category in measures:
+        db.session.add(
+            RawMeasure(
+                measure_name=m_def.name,
+                last_updated=last_updated,
+                start_date="2021-06-01",
+                aggregation_period="month",
+                value=value,
+                group1={"category": category},
+            )
+        )
+    db.session.flush()
+    aggs = [
+        SimpleNamespace(
+            start_date=datetime(2021, 6, 1),
+            created_by=None,
+            group1={"category": category},
+            group2=None,
+            group3=None,
+        )
+        for category in ["food", "hobby", "other"]
+    ]
+    end_date = datetime(2021, 6, 3)
+    aggregation.backup_rejected_raw_measures(m_def, aggs, end_date)
+
+    all_refused = (
+        db.session.query(RefusedRawMeasure)
+        .filter(RefusedRawMeasure.measure_name == m_def.name)
+        .all()
+    )
+    assert sorted(r.value for r in all_refused) == [10, 20, 100]
+    for refused in all_refused:
+        assert refused.aggregation_period == "month"
+        assert refused.last_updated <= end_date
+        assert refused.rejected_date is not None
+    db.session.rollback()
 
 
 def test_wildcard_aggregation():
@@ -577,3 +774,697 @@ def test_wildcard_aggregation():
     assert aggs[1].group1 == {"slug": "grdf"}
     assert aggs[1].group2 == {"event_type": "*"}
     assert aggs[1].group3 == {"status": "*"}
+
+
+def test_wildcard_aggregates_grouping_sets():
+    m_def = MeasureDefinition.query_by_name("konnector-event-daily")
+    wildcard_groups_sets = [
+        ["group1"],
+        ["group2", "group3"],
+        ["group1", "group2", "group3"],
+    ]
+    end_date = datetime(2021, 5, 4)
+
+    def by_key(aggs):
+        return {
+            aggregation.build_aggregate_key(agg): agg._asdict() for agg in aggs
+        }
+
+    expected = aggregation.compute_all_aggregates_from_raw_measures(
+        m_def, None, end_date
+    )
+    for wildcard_groups in wildcard_groups_sets:
+        expected += aggregation.compute_all_aggregates_from_raw_measures(
+            m_def, None, end_date, wildcard_groups
+        )
+    aggs = aggregation.compute_wildcard_aggregates_from_raw_measures(
+        m_def, None, end_date, wildcard_groups_sets
+    )
+    assert len(aggs) == len(expected)
+    assert by_key(aggs) == by_key(expected)
+
+    slugs = [
+        agg.group1["slug"] for agg in aggs if agg.group2 == {"event_type": "*"}
+    ]
+    assert sorted(slugs) == ["*", "enedis", "grdf"]
+
+
+def test_chunked_aggregation(monkeypatch):
+    m_def = MeasureDefinition(
+        name="dummy-chunks",
+        aggregation_period="day",
+        execution_frequency="day",
+    )
+    db.session.add(m_def)
+    last_updated = datetime(2021, 6, 1)
+    for i in range(5):
+        for start_date in ["2021-05-01", "2021-05-02"]:
+            db.session.add(
+                RawMeasure(
+                    measure_name="dummy-chunks",
+                    value=i,
+                    start_date=start_date,
+                    last_updated=last_updated + timedelta(seconds=i),
+                )
+            )
+    db.session.commit()
+
+    start_date, end_date = aggregation.find_dates_bounds(m_def)
+    chunk_end = aggregation.find_chunk_end_date(m_def, start_date, end_date, 3)
+    # The measures with the same last_updated are in the same chunk
+    assert chunk_end == last_updated + timedelta(seconds=1)
+
+    # Fail on the 3rd chunk
+    chunk_func = aggregation.aggregate_raw_measures_chunk
+    chunks = []
+
+    def aggregate_chunk(m_definition, start, end):
+        chunks.append((start, end))
+        if len(chunks) == 3:
+            raise Exception("dummy failure")
+        return chunk_func(m_definition, start, end)
+
+    monkeypatch.setitem(configdata._config, "aggregation", {"chunk_size": 4})
+    monkeypatch.setattr(
+        aggregation, "aggregate_raw_measures_chunk", aggregate_chunk
+    )
+    assert aggregation.aggregate_raw_measures(m_def) is None
+    agg_date = AggregationDate.query_by_name("dummy-chunks")
+    assert agg_date.last_aggregated_measure_date == chunks[1][1]
+
+    # Resume from the last committed chunk
+    monkeypatch.setattr(
+        aggregation, "aggregate_raw_measures_chunk", chunk_func
+    )
+    _, date = aggregation.aggregate_raw_measures(m_def, force=True)
+    assert date == end_date
+    aggs = (
+        Aggregation.query.filter(Aggregation.measure_name == "dummy-chunks")
+        .order_by(Aggregation.start_date)
+        .all()
+    )
+    assert len(aggs) == 2
+    for agg in aggs:
+        assert agg.count == 5
+        assert agg.sum == 10
+        assert agg.min == 0
+        assert agg.max == 4
+        assert agg.avg == 2
+        assert float(agg.std) == pytest.approx(
+            np.std(range(5), ddof=1), abs=0.01
+        )
+
+    Aggregation.query.filter(
+        Aggregation.measure_name == "dummy-chunks"
+    ).delete()
+    RawMeasure.query.filter(RawMeasure.measure_name == "dummy-chunks").delete()
+    db.session.delete(m_def)
+    db.session.commit()
+
+
+def test_sql_aggregation(monkeypatch):
+    names = {"python": "dummy-python-mode", "sql": "dummy-sql-mode"}
+    m_defs = {}
+    for mode, name in names.items():
+        m_defs[mode] = MeasureDefinition(
+            name=name,
+            group1_key="device",
+            aggregation_period="day",
+            execution_frequency="day",
+        )
+        db.session.add(m_defs[mode])
+
+    def add_raw_measures(values, start_date):
+        for name in names.values():
+            for i, value in enumerate(values):
+                db.session.add(
+                    RawMeasure(
+                        measure_name=name,
+                        value=value,
+                        start_date=start_date,
+                        created_by="app" if i % 2 else None,
+                        group1={"device": "desktop"} if i % 3 else None,
+                    )
+                )
+        db.session.commit()
+
+    def aggregate(mode):
+        monkeypatch.setitem(configdata._config, "aggregation", {"mode": mode})
+        n_aggs, _ = aggregation.aggregate_raw_measures(
+            m_defs[mode], force=True
+        )
+        return n_aggs
+
+    def query_aggregates(name):
+        aggs = (
+            db.session.query(Aggregation)
+            .filter(Aggregation.measure_name == name)
+            .all()
+        )
+        return sorted(
+            [
+                (
+                    agg.start_date,
+                    agg.created_by or "",
+                    json.dumps(agg.group1),
+                    agg.count,
+                    agg.count_not_zero,
+                    agg.sum,
+                    agg.min,
+                    agg.max,
+                    agg.avg,
+                    agg.std,
+                )
+                for agg in aggs
+            ]
+        )
+
+    add_raw_measures([0, 4, 12.5, 7, 3, 3, 9, 1], "2021-05-01")
+    assert aggregate("python") == aggregate("sql") == 4
+
+    # Merge new measures with the existing aggregates
+    add_raw_measures([2, 8, 5, 0, 10, 6], "2021-05-01")
+    add_raw_measures([1, 2], "2021-05-02")
+    assert aggregate("python") == aggregate("sql") == 2
+
+    python_aggs = query_aggregates(names["python"])
+    sql_aggs = query_aggregates(names["sql"])
+    assert len(python_aggs) == len(sql_aggs) == 6
+    for python_agg, sql_agg in zip(python_aggs, sql_aggs):
+        assert python_agg[:-2] == sql_agg[:-2]
+        # avg and std might differ by rounding
+        assert python_agg[-2] == pytest.approx(sql_agg[-2], abs=0.011)
+        assert python_agg[-1] == pytest.approx(sql_agg[-1], abs=0.011)
+
+    for name in names.values():
+        Aggregation.query.filter(Aggregation.measure_name == name).delete()
+        RawMeasure.query.filter(RawMeasure.measure_name == name).delete()
+    for m_def in m_defs.values():
+        db.session.delete(m_def)
+    db.session.commit()
+
+
+def test_query_existing_aggregates():
+    measure_name = "dummy-existing-aggregates"
+    keys = [
+        (datetime(2021, 5, 1), None, {"device": "mobile"}),
+        (datetime(2021, 5, 2), "app", {"device": "desktop"}),
+        (datetime(2021, 5, 1), None, {"device": "desktop"}),
+        (datetime(2021, 5, 2), "app", None),
+    ]
+    for start_date, created_by, group1 in keys:
+        db.session.add(
+            Aggregation(
+                measure_name=measure_name,
+                start_date=start_date,
+                created_by=created_by,
+                group1=group1,
+            )
+        )
+    db.session.commit()
+
+    grouped_measures = [
+        {
+            "start_date": start_date,
+            "created_by": created_by,
+            "group1": group1,
+            "group2": None,
+            "group3": None,
+        }
+        for start_date, created_by, group1 in keys[:2]
+    ]
+    # Unknown key
+    grouped_measures.append(
+        {
+            "start_date": datetime(2021, 5, 2),
+            "created_by": None,
+            "group1": {"device": "mobile"},
+            "group2": None,
+            "group3": None,
+        }
+    )
+    grouped_measures = [SimpleNamespace(**gm) for gm in grouped_measures]
+
+    # Only the exact keys are matched
+    existing = aggregation.query_existing_aggregates(
+        measure_name, grouped_measures
+    )
+    assert len(existing) == 2
+    for gm in grouped_measures[:2]:
+        agg = aggregation.find_existing_aggregate(existing, gm)
+        assert agg.start_date == gm.start_date
+        assert agg.group1 == gm.group1
+
+    Aggregation.query.filter(Aggregation.measure_name == measure_name).delete()
+    db.session.commit()
+
+
+def test_compute_quartiles_from_raw_measures(monkeypatch):
+    monkeypatch.setattr(aggregation, "EXISTING_AGGREGATES_BATCH_SIZE", 4)
+    measure_name = "dummy-batched-quartiles"
+    m_def = MeasureDefinition(
+        name=measure_name, group1_key="slug", with_quartiles=True
+    )
+    db.session.add(m_def)
+
+    rng = np.random.default_rng(42)
+    dates = [datetime(2021, 5, 1), datetime(2021, 5, 2), datetime(2021, 5, 4)]
+    creators = ["ecolyo", "other", ""]
+    slugs = ["enedis", "grdf"]
+    values = {}
+    for start_date in dates:
+        for created_by in creators:
+            for slug in slugs:
+                key_values = [int(v) for v in rng.integers(0, 100, size=5)]
+                values[(start_date, created_by, slug)] = key_values
+                for value in key_values:
+                    db.session.add(
+                        RawMeasure(
+                            measure_name=measure_name,
+                            value=value,
+                            start_date=start_date,
+                            created_by=created_by,
+                            last_updated=datetime(2021, 5, 5),
+                            group1={"slug": slug},
+                        )
+                    )
+    db.session.commit()
+
+    def check_quartiles(aggregates, expected_values, wildcard_groups=None):
+        quartiles = aggregation.compute_quartiles_from_raw_measures(
+            m_def, aggregates, datetime(2021, 5, 5), wildcard_groups
+        )
+        # The aggregates are spread over several batches
+        assert len(aggregates) > aggregation.EXISTING_AGGREGATES_BATCH_SIZE
+        assert len(quartiles) == len(aggregates)
+        for agg, key_values in zip(aggregates, expected_values):
+            row = quartiles[aggregation.build_aggregate_key(agg)]
+            assert float(row.median) == np.quantile(key_values, 0.5)
+            assert float(row.first_quartile) == np.quantile(key_values, 0.25)
+            assert float(row.third_quartile) == np.quantile(key_values, 0.75)
+
+    # A NULL creator matches the empty one
+    aggregates = [
+        Aggregation(
+            start_date=start_date,
+            created_by=created_by or None,
+            group1={"slug": slug},
+        )
+        for start_date, created_by, slug in values
+    ]
+    check_quartiles(aggregates, list(values.values()))
+
+    wildcard_values = {}
+    for (start_date, created_by, _), key_values in values.items():
+        wildcard_values.setdefault((start_date, created_by), [])
+        wildcard_values[(start_date, created_by)] += key_values
+    aggregates = [
+        Aggregation(
+            start_date=start_date,
+            created_by=created_by,
+            group1=aggregation.generate_wildcard_json("slug"),
+        )
+        for start_date, created_by in wildcard_values
+    ]
+    check_quartiles(aggregates, list(wildcard_values.values()), ["group1"])
+
+    RawMeasure.query.filter(RawMeasure.measure_name == measure_name).delete()
+    db.session.delete(m_def)
+    db.session.commit()
+
+
+def test_build_aggregate_key():
+    def key(created_by=None, group1=None, group2=None):
+        agg = Aggregation(
+            start_date=datetime(2021, 5, 1),
+            created_by=created_by,
+            group1=group1,
+            group2=group2,
+        )
+        return aggregation.build_aggregate_key(agg)
+
+    assert key() == key(created_by="")
+    assert key(created_by="app") != key()
+    assert key(group1={"a": "1", "b": "2"}) == key(group1={"b": "2", "a": "1"})
+    assert key(group1={"a": "1"}) != key(group2={"a": "1"})
+    # Not only strings
+    assert key(group1={"a": 1}) != key(group1={"a": "1"})
+    assert key(group1={"a": 1}) != key(group1={"a": True})
+    assert key(group1={"a": [1, 2]}) == key(group1={"a": [1, 2]})
+    # JSON string
+    assert key(group1='{"a": "1"}') != key(group1={"a": "1"})
+    hash(key(group1={"a": [1, 2]}))
+
+
+def test_quantile_sketch_aggregation():
+    measure_name = "dummy-quantile-sketch"
+    m_def = MeasureDefinition(
+        name=measure_name,
+        aggregation_period="day",
+        execution_frequency="day",
+        with_quartiles=True,
+        with_quantile_sketch=True,
+    )
+    db.session.add(m_def)
+
+    def add_raw_measures(values, last_updated):
+        for value in values:
+            db.session.add(
+                RawMeasure(
+                    measure_name=measure_name,
+                    value=value,
+                    start_date="2021-05-01",
+                    last_updated=last_updated,
+                )
+            )
+        db.session.commit()
+
+    values = [3, 8, 1, 12, 7]
+    add_raw_measures(values, datetime(2021, 5, 2))
+    n_aggs, _ = aggregation.aggregate_raw_measures(m_def)
+    assert n_aggs == 1
+    agg = Aggregation.query.filter(
+        Aggregation.measure_name == measure_name
+    ).one()
+    assert agg.median == np.quantile(values, 0.5)
+    assert agg.quantile_sketch["centroids"] == [
+        [1, 1],
+        [3, 1],
+        [7, 1],
+        [8, 1],
+        [12, 1],
+    ]
+
+    # The raw measures can be purged right away
+    purge.purge_measures(m_def)
+    assert (
+        RawMeasure.query.filter(
+            RawMeasure.measure_name == measure_name
+        ).count()
+        == 0
+    )
+
+    # The quartiles are updated from the sketch
+    new_values = [20, 2, 9]
+    add_raw_measures(new_values, datetime(2021, 5, 3))
+    n_aggs, _ = aggregation.aggregate_raw_measures(m_def, force=True)
+    assert n_aggs == 1
+    db.session.refresh(agg)
+    all_values = values + new_values
+    assert agg.count == 8
+    assert agg.median == np.quantile(all_values, 0.5)
+    assert agg.first_quartile == np.quantile(all_values, 0.25)
+    assert agg.third_quartile == np.quantile(all_values, 0.75)
+    refused = RefusedRawMeasure.query.filter(
+        RefusedRawMeasure.measure_name == measure_name
+    )
+    assert refused.count() == 0
+
+    Aggregation.query.filter(Aggregation.measure_name == measure_name).delete()
+    RawMeasure.query.filter(RawMeasure.measure_name == measure_name).delete()
+    db.session.delete(m_def)
+    db.session.commit()
+
+
+@pytest.mark.parametrize("mode", ["python", "sql"])
+def test_incremental_wildcard_aggregation(monkeypatch, mode):
+    monkeypatch.setitem(configdata._config, "aggregation", {"mode": mode})
+    measure_name = "dummy-wildcards"
+    m_def = MeasureDefinition(
+        name=measure_name,
+        aggregation_period="day",
+        execution_frequency="day",
+        group1_key="slug",
+        group2_key="status",
+        wildcard_groups=[["group1"], ["group1", "group2"]],
+    )
+    db.session.add(m_def)
+
+    def add_raw_measures(measures, last_updated):
+        for slug, status, value in measures:
+            db.session.add(
+                RawMeasure(
+                    measure_name=measure_name,
+                    value=value,
+                    start_date="2021-05-01",
+                    last_updated=last_updated,
+                    group1={"slug": slug},
+                    group2={"status": status},
+                )
+            )
+        db.session.commit()
+
+    def query_wildcard_aggregates():
+        aggs = Aggregation.query.filter(
+            Aggregation.measure_name == measure_name,
+            Aggregation.group1 == {"slug": "*"},
+        ).all()
+        return {agg.group2["status"]: agg for agg in aggs}
+
+    first_measures = [("enedis", "ok", 1), ("grdf", "ok", 3)]
+    first_measures += [("grdf", "ko", 5)]
+    add_raw_measures(first_measures, datetime(2021, 5, 2))
+    aggregation.aggregate_raw_measures(m_def)
+    aggs = query_wildcard_aggregates()
+    assert sorted(aggs.keys()) == ["*", "ko", "ok"]
+    assert (aggs["ok"].count, aggs["ok"].sum) == (2, 4)
+    assert (aggs["ko"].count, aggs["ko"].sum) == (1, 5)
+    assert (aggs["*"].count, aggs["*"].sum) == (3, 9)
+
+    # Only the new measures are merged in the wildcard aggregates
+    add_raw_measures(
+        [("enedis", "ok", 10), ("enedis", "ko", 2)], datetime(2021, 5, 3)
+    )
+    aggregation.aggregate_raw_measures(m_def, force=True)
+    aggs = query_wildcard_aggregates()
+    assert sorted(aggs.keys()) == ["*", "ko", "ok"]
+    assert (aggs["ok"].count, aggs["ok"].sum) == (3, 14)
+    assert (aggs["ko"].count, aggs["ko"].sum) == (2, 7)
+    assert (aggs["*"].count, aggs["*"].sum) == (5, 21)
+    assert float(aggs["*"].std) == pytest.approx(
+        np.std([1, 3, 5, 10, 2], ddof=1), abs=0.01
+    )
+
+    # The same as a full wildcard computation
+    full_aggs = aggregation.compute_wildcard_aggregate(
+        m_def, ["group1", "group2"], datetime.min, datetime(2021, 5, 4)
+    )
+    assert len(full_aggs) == 1
+    assert full_aggs[0].count == 5
+    assert full_aggs[0].sum == 21
+
+    Aggregation.query.filter(Aggregation.measure_name == measure_name).delete()
+    RawMeasure.query.filter(RawMeasure.measure_name == measure_name).delete()
+    db.session.delete(m_def)
+    db.session.commit()
+
+
+def test_incremental_wildcard_quartiles():
+    measure_name = "dummy-wildcard-quartiles"
+    m_def = MeasureDefinition(
+        name=measure_name,
+        aggregation_period="day",
+        execution_frequency="day",
+        group1_key="slug",
+        with_quartiles=True,
+        wildcard_groups=[["group1"]],
+    )
+    db.session.add(m_def)
+
+    def add_raw_measures(values, last_updated):
+        for slug, value in values:
+            db.session.add(
+                RawMeasure(
+                    measure_name=measure_name,
+                    value=value,
+                    start_date="2021-05-01",
+                    last_updated=last_updated,
+                    group1={"slug": slug},
+                )
+            )
+        db.session.commit()
+
+    first_values = [("enedis", 1), ("grdf", 4), ("grdf", 8)]
+    add_raw_measures(first_values, datetime(2021, 5, 2))
+    aggregation.aggregate_raw_measures(m_def)
+    new_values = [("enedis", 20), ("egl", 3)]
+    add_raw_measures(new_values, datetime(2021, 5, 3))
+    aggregation.aggregate_raw_measures(m_def, force=True)
+
+    agg = Aggregation.query.filter(
+        Aggregation.measure_name == measure_name,
+        Aggregation.group1 == {"slug": "*"},
+    ).one()
+    all_values = [v for _, v in first_values + new_values]
+    assert agg.count == 5
+    assert agg.median == np.quantile(all_values, 0.5)
+    assert agg.first_quartile == np.quantile(all_values, 0.25)
+    assert agg.third_quartile == np.quantile(all_values, 0.75)
+
+    Aggregation.query.filter(Aggregation.measure_name == measure_name).delete()
+    RawMeasure.query.filter(RawMeasure.measure_name == measure_name).delete()
+    db.session.delete(m_def)
+    db.session.commit()
+
+
+@pytest.mark.parametrize(
+    "mode,with_quartiles",
+    [("python", False), ("python", True), ("sql", False)],
+)
+def test_empty_and_null_creators(monkeypatch, mode, with_quartiles):
+    monkeypatch.setitem(configdata._config, "aggregation", {"mode": mode})
+    measure_name = "dummy-empty-null-creators"
+    m_def = MeasureDefinition(
+        name=measure_name,
+        aggregation_period="day",
+        execution_frequency="day",
+        group1_key="slug",
+        with_quartiles=with_quartiles,
+    )
+    db.session.add(m_def)
+
+    def add_raw_measures(values, last_updated):
+        for created_by, value in values:
+            db.session.add(
+                RawMeasure(
+                    measure_name=measure_name,
+                    value=value,
+                    start_date="2021-05-01",
+                    last_updated=last_updated,
+                    created_by=created_by,
+                    group1={"slug": "enedis"},
+                )
+            )
+        db.session.commit()
+
+    def query_aggregates():
+        return Aggregation.query.filter(
+            Aggregation.measure_name == measure_name
+        ).all()
+
+    # Both creators are the same key, without an existing aggregate
+    add_raw_measures([(None, 1), ("", 3)], datetime(2021, 5, 2))
+    aggregation.aggregate_raw_measures(m_def)
+    aggs = query_aggregates()
+    assert len(aggs) == 1
+    assert (aggs[0].created_by, aggs[0].count, aggs[0].sum) == (None, 2, 4)
+
+    # And with an existing one
+    add_raw_measures([(None, 5), ("", 7)], datetime(2021, 5, 3))
+    aggregation.aggregate_raw_measures(m_def, force=True)
+    db.session.expire_all()
+    aggs = query_aggregates()
+    assert len(aggs) == 1
+    assert (aggs[0].count, aggs[0].sum) == (4, 16)
+    assert float(aggs[0].std) == pytest.approx(
+        np.std([1, 3, 5, 7], ddof=1), abs=0.005
+    )
+    if with_quartiles:
+        assert aggs[0].median == 4
+        assert aggs[0].first_quartile == 2.5
+
+    Aggregation.query.filter(Aggregation.measure_name == measure_name).delete()
+    RawMeasure.query.filter(RawMeasure.measure_name == measure_name).delete()
+    db.session.delete(m_def)
+    db.session.commit()
+
+
+@pytest.mark.parametrize("mode", ["python", "sql"])
+def test_period_aggregates(monkeypatch, mode):
+    monkeypatch.setitem(configdata._config, "aggregation", {"mode": mode})
+    measure_name = "dummy-period-aggregates"
+    m_def = MeasureDefinition(
+        name=measure_name,
+        aggregation_period="day",
+        execution_frequency="day",
+        group1_key="slug",
+        wildcard_groups=[["group1"]],
+        rollup_periods=["week", "month"],
+    )
+    db.session.add(m_def)
+
+    def add_raw_measures(measures, last_updated):
+        for start_date, slug, value in measures:
+            db.session.add(
+                RawMeasure(
+                    measure_name=measure_name,
+                    value=value,
+                    start_date=start_date,
+                    last_updated=last_updated,
+                    group1={"slug": slug},
+                )
+            )
+        db.session.commit()
+
+    def query_period_aggregates(period):
+        aggs = PeriodAggregation.query.filter(
+            PeriodAggregation.measure_name == measure_name,
+            PeriodAggregation.period == period,
+        ).all()
+        return {
+            (agg.start_date.strftime("%Y-%m-%d"), agg.group1["slug"]): agg
+            for agg in aggs
+        }
+
+    add_raw_measures(
+        [
+            ("2021-05-03", "enedis", 1),
+            ("2021-05-04", "enedis", 4),
+            ("2021-05-04", "grdf", 2),
+            ("2021-05-10", "grdf", 8),
+        ],
+        datetime(2021, 5, 11),
+    )
+    aggregation.aggregate_raw_measures(m_def)
+    weeks = query_period_aggregates("week")
+    assert sorted(weeks.keys()) == [
+        ("2021-05-03", "*"),
+        ("2021-05-03", "enedis"),
+        ("2021-05-03", "grdf"),
+        ("2021-05-10", "*"),
+        ("2021-05-10", "grdf"),
+    ]
+    assert (
+        weeks[("2021-05-03", "enedis")].count,
+        weeks[("2021-05-03", "enedis")].sum,
+    ) == (2, 5)
+    assert weeks[("2021-05-03", "*")].count == 3
+    months = query_period_aggregates("month")
+    assert sorted(months.keys()) == [
+        ("2021-05-01", "*"),
+        ("2021-05-01", "enedis"),
+        ("2021-05-01", "grdf"),
+    ]
+
+    # Only the period aggregates of the new measures are merged again
+    untouched_keys = [("2021-05-10", "grdf"), ("2021-05-03", "grdf")]
+    last_updated = [weeks[key].last_updated for key in untouched_keys]
+    add_raw_measures([("2021-05-05", "enedis", 10)], datetime(2021, 5, 12))
+    aggregation.aggregate_raw_measures(m_def, force=True)
+    weeks = query_period_aggregates("week")
+    assert [weeks[key].last_updated for key in untouched_keys] == last_updated
+    assert weeks[("2021-05-03", "*")].count == 4
+    values = [1, 4, 10]
+    week = weeks[("2021-05-03", "enedis")]
+    assert (week.count, week.count_not_zero, week.sum) == (3, 3, 15)
+    assert (week.min, week.max, week.avg) == (1, 10, 5)
+    assert float(week.std) == pytest.approx(np.std(values, ddof=1), abs=0.01)
+    assert float(week.sum_of_squares) == sum(v * v for v in values)
+
+    month = query_period_aggregates("month")[("2021-05-01", "*")]
+    values = [1, 4, 2, 8, 10]
+    assert (month.count, month.sum, month.min, month.max) == (5, 25, 1, 10)
+    assert float(month.std) == pytest.approx(np.std(values, ddof=1), abs=0.01)
+
+    # The backfill recomputes the same period aggregates
+    assert aggregation.compute_period_aggregates(m_def) == 8
+    month = query_period_aggregates("month")[("2021-05-01", "*")]
+    assert (month.count, month.sum) == (5, 25)
+
+    PeriodAggregation.query.filter(
+        PeriodAggregation.measure_name == measure_name
+    ).delete()
+    Aggregation.query.filter(Aggregation.measure_name == measure_name).delete()
+    RawMeasure.query.filter(RawMeasure.measure_name == measure_name).delete()
+    db.session.delete(m_def)
+    db.session.commit()
@@ -0,0 +1,137 @@
+import pytest
+import threading
+from dacc import db, dacc, ingestion, insertion
+from dacc.exceptions import BufferFullException
+from dacc.ingestion import (
+    BackgroundBatcher,
+    GroupCommitter,
+    WriteBehindBuffer,
+)
+from dacc.models import RawMeasure, RawMeasureStaging
+
+
+def query_measures(measure_name):
+    return (
+        db.session.query(RawMeasure)
+        .filter(RawMeasure.measure_name == measure_name)
+        .all()
+    )
+
+
+def get_dummy_measure(measure_name):
+    return {
+        "measureName": measure_name,
+        "value": 42,
+        "startDate": "2021-05-01",
+    }
+
+
+def test_write_behind_buffer():
+    measure_name = "dummy-write-behind"
+    buffer = WriteBehindBuffer(
+        dacc, max_size=10, flush_size=2, flush_interval=0.1
+    )
+    for _ in range(5):
+        buffer.append(get_dummy_measure(measure_name))
+
+    # The pending measures are flushed on stop
+    buffer.stop()
+    assert buffer.pending() == 0
+    db.session.commit()
+    assert len(query_measures(measure_name)) == 5
+
+
+def test_write_behind_buffer_full(monkeypatch):
+    measure_name = "dummy-write-behind-full"
+    buffer = WriteBehindBuffer(dacc, max_size=2)
+    # Do not start the flusher, so that the buffer is never emptied
+    monkeypatch.setattr(buffer, "start", lambda: None)
+
+    buffer.append(get_dummy_measure(measure_name))
+    buffer.append(get_dummy_measure(measure_name))
+    with pytest.raises(BufferFullException):
+        buffer.append(get_dummy_measure(measure_name))
+    assert buffer.pending() == 2
+
+
+def test_write_behind_buffer_dead_letter(monkeypatch):
+    measure_name = "dummy-write-behind-dead-letter"
+    buffer = WriteBehindBuffer(
+        dacc, flush_size=2, flush_interval=0.01, max_retries=2
+    )
+
+    def insert_raw_measures(measures):
+        raise Exception("Database unavailable")
+
+    logs = []
+    monkeypatch.setattr(insertion, "insert_raw_measures", insert_raw_measures)
+    monkeypatch.setattr(
+        ingestion.logger, "log", lambda level, msg: logs.append((level, msg))
+    )
+    for _ in range(3):
+        buffer.append(get_dummy_measure(measure_name))
+    buffer.stop()
+
+    # The measures are kept in the staging table
+    staged = RawMeasureStaging.query.filter(
+        RawMeasureStaging.measure_name == measure_name
+    )
+    assert staged.count() == 3
+    dead_letter_logs = [msg for level, msg in logs if "staging" in msg]
+    assert all(level == "error" for level, _ in logs)
+    assert sum(int(msg.split()[0]) for msg in dead_letter_logs) == 3
+
+    staged.delete()
+    db.session.commit()
+
+
+def test_group_committer():
+    measure_name = "dummy-group-commit"
+    committer = GroupCommitter(dacc, window=0.1, max_size=10)
+
+    threads = [
+        threading.Thread(
+            target=committer.submit, args=(get_dummy_measure(measure_name),)
+        )
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    db.session.commit()
+    assert len(query_measures(measure_name)) == 5
+
+    # An invalid measure only fails its own insert
+    measure = get_dummy_measure(measure_name)
+    measure["value"] = 1e20
+    with pytest.raises(Exception):
+        committer.submit(measure)
+    committer.submit(get_dummy_measure(measure_name))
+    committer.stop()
+    db.session.commit()
+    assert len(query_measures(measure_name)) == 6
+
+
+def test_group_committer_timeout(monkeypatch):
+    measure_name = "dummy-group-commit-timeout"
+    committer = GroupCommitter(dacc, queue_size=1, timeout=0.1)
+    # Do not start the committer, so that the measures are never committed
+    monkeypatch.setattr(committer, "start", lambda: None)
+
+    with pytest.raises(BufferFullException) as e_info:
+        committer.submit(get_dummy_measure(measure_name))
+    assert "please retry later" in str(e_info.value)
+    with pytest.raises(BufferFullException) as e_info:
+        committer.submit(get_dummy_measure(measure_name))
+    assert "queue is full" in str(e_info.value)
+
+    # The timed out measure is not inserted afterwards
+    committer._process(committer._drain())
+    db.session.commit()
+    assert len(query_measures(measure_name)) == 0
+
+
+def test_background_batcher_abstract():
+    with pytest.raises(TypeError):
+        BackgroundBatcher(dacc, batch_size=1, batch_interval=1)
@@ -0,0 +1,137 @@
+import pytest
+from dacc import db, insertion
+from dacc.exceptions import ValidationException
+from dacc.models import RawMeasure
+
+
+def test_insert_raw_measures():
+    measure_name = "dummy-insert-batch"
+    assert insertion.insert_raw_measures([]) == 0
+
+    measures = [
+        {
+            "measureName": measure_name,
+            "value": 42,
+            "startDate": "2021-05-01",
+            "createdBy": "ecolyo",
+            "group1": {"device": "desktop"},
+        },
+        {
+            "measureName": measure_name,
+            "value": 0,
+            "startDate": "2021-05-02",
+            "createdBy": "ecolyo",
+        },
+    ]
+    assert insertion.insert_raw_measures(measures) == 2
+
+    raw_measures = (
+        db.session.query(RawMeasure)
+        .filter(RawMeasure.measure_name == measure_name)
+        .order_by(RawMeasure.start_date)
+        .all()
+    )
+    assert len(raw_measures) == 2
+    assert raw_measures[0].value == 42
+    assert raw_measures[0].group1 == {"device": "desktop"}
+    assert raw_measures[0].last_updated is not None
+    assert raw_measures[1].value == 0
+    assert raw_measures[1].group1 is None
+
+    RawMeasure.query.filter(RawMeasure.measure_name == measure_name).delete()
+    db.session.commit()
+
+
+def test_insert_raw_measures_from_lines():
+    valid_line = (
+        b'{"measureName": "connection-count-daily", "value": 42, '
+        b'"startDate": "2021-05-10", "group1": {"device": "mobile"}}\n'
+    )
+    lines = [
+        valid_line,
+        b"not-a-json\n",
+        b"\n",
+        valid_line,
+        b'{"measureName": "fake-dummy", "value": 42}\n',
+        valid_line,
+    ]
+    n_inserted, n_rejected, errors = insertion.insert_raw_measures_from_lines(
+        lines, chunk_size=2, max_errors=1
+    )
+    assert n_inserted == 3
+    assert n_rejected == 2
+    assert len(errors) == 1
+    assert errors[0]["line"] == 2
+    assert errors[0]["error"] == "The line is not a valid JSON"
+
+    raw_measures = (
+        db.session.query(RawMeasure)
+        .filter(RawMeasure.start_date == "2021-05-10")
+        .all()
+    )
+    assert len(raw_measures) == 3
+
+    RawMeasure.query.filter(
+        RawMeasure.measure_name == "connection-count-daily",
+        RawMeasure.start_date == "2021-05-10",
+    ).delete()
+    db.session.commit()
+
+
+def test_copy_raw_measures():
+    measure_name = "dummy-copy"
+    measures = [
+        {
+            "measureName": measure_name,
+            "value": 42.5,
+            "startDate": "2021-05-01",
+            "createdBy": "ecolyo",
+            "group1": {"device": 'desktop, "beta"'},
+        },
+        {
+            "measureName": measure_name,
+            "value": 0,
+            "startDate": "2021-05-02T00:00:00",
+            "createdBy": "",
+        },
+    ]
+    assert insertion.copy_raw_measures(measures) == 2
+
+    raw_measures = (
+        db.session.query(RawMeasure)
+        .filter(RawMeasure.measure_name == measure_name)
+        .order_by(RawMeasure.start_date)
+        .all()
+    )
+    assert len(raw_measures) == 2
+    assert raw_measures[0].value == 42.5
+    assert raw_measures[0].group1 == {"device": 'desktop, "beta"'}
+    assert raw_measures[0].group2 is None
+    assert raw_measures[0].last_updated is not None
+    assert raw_measures[1].created_by == ""
+    assert raw_measures[1].last_updated == raw_measures[0].last_updated
+
+    RawMeasure.query.filter(RawMeasure.measure_name == measure_name).delete()
+    db.session.commit()
+
+
+def test_parse_csv_row():
+    row = {
+        "measureName": "connection-count-daily",
+        "value": "42",
+        "startDate": "2021-05-01",
+        "createdBy": "",
+        "group1": '{"device": "mobile"}',
+        "group2": "",
+    }
+    measure = insertion.parse_csv_row(row)
+    assert measure == {
+        "measureName": "connection-count-daily",
+        "value": "42",
+        "startDate": "2021-05-01",
+        "group1": {"device": "mobile"},
+    }
+
+    row["group1"] = "not-a-json"
+    with pytest.raises(ValidationException):
+        insertion.parse_csv_row(row)
@@ -1,6 +1,12 @@
 from datetime import datetime
-from dacc import db
-from dacc.models import MeasureDefinition, RawMeasure, Aggregation
+from dacc import db, configdata
+from dacc.models import (
+    MeasureDefinition,
+    RawMeasure,
+    Aggregation,
+    AggregationDate,
+    RefusedRawMeasure,
+)
 from dacc.purge import purge_measures
 from dacc.aggregation import aggregate_raw_measures
 from tests.fixtures import fixtures
@@ -155,3 +161,109 @@ def test_purge_measures_with_quartiles():
     agg_nq = get_aggregate(dummy_not_quartiles, "2022-01-01")
     assert agg_q.last_raw_measures_purged is not None
     assert agg_nq.last_raw_measures_purged is None
+
+
+def test_purge_measures_empty_creator(monkeypatch):
+    # The sql mode saves an empty creator as NULL
+    monkeypatch.setitem(configdata._config, "aggregation", {"mode": "sql"})
+    measure_name = "dummy_empty_creator"
+    m_def = insert_definition(measure_name)
+    for value in [1, 2, 3]:
+        db.session.add(
+            RawMeasure(
+                measure_name=measure_name,
+                value=value,
+                start_date="2022-01-01",
+                created_by="",
+                group1={"key1": 1},
+            )
+        )
+    db.session.commit()
+    aggregate_raw_measures(m_def)
+
+    purge_measures(m_def)
+    assert len(RawMeasure.query_by_name(measure_name)) == 0
+    measure = RawMeasure(
+        measure_name=measure_name,
+        start_date="2022-01-01",
+        created_by="",
+        group1={"key1": 1},
+    )
+    agg = Aggregation.query_aggregate_by_measure(measure_name, measure)
+    assert agg.created_by is None
+    assert agg.count == 3
+    assert agg.last_raw_measures_purged is not None
+
+    Aggregation.query.filter(Aggregation.measure_name == measure_name).delete()
+    AggregationDate.query.filter(
+        AggregationDate.measure_definition_id == m_def.id
+    ).delete()
+    db.session.delete(m_def)
+    db.session.commit()
+
+
+def test_purge_wildcard_aggregates():
+    measure_name = "dummy_purge_wildcards"
+    m_def = MeasureDefinition(
+        name=measure_name,
+        aggregation_threshold=0,
+        group1_key="slug",
+        with_quartiles=True,
+        wildcard_groups=[["group1"]],
+    )
+    db.session.add(m_def)
+
+    def add_raw_measure(slug, value):
+        db.session.add(
+            RawMeasure(
+                measure_name=measure_name,
+                value=value,
+                start_date="2022-01-01",
+                group1={"slug": slug},
+            )
+        )
+        db.session.commit()
+
+    def query_aggregates():
+        aggs = Aggregation.query.filter(
+            Aggregation.measure_name == measure_name
+        ).all()
+        return {agg.group1["slug"]: agg for agg in aggs}
+
+    for slug, value in [("enedis", 1), ("enedis", 3), ("grdf", 5)]:
+        add_raw_measure(slug, value)
+    aggregate_raw_measures(m_def)
+    db.session.query(RawMeasure).filter(
+        RawMeasure.measure_name == measure_name
+    ).update({"last_updated": "2020-01-01"})
+    AggregationDate.query.filter(
+        AggregationDate.measure_definition_id == m_def.id
+    ).update({"last_aggregated_measure_date": "2020-01-01"})
+    purge_measures(m_def)
+    assert len(RawMeasure.query_by_name(measure_name)) == 0
+    aggs = query_aggregates()
+    assert sorted(aggs.keys()) == ["*", "enedis", "grdf"]
+    for agg in aggs.values():
+        assert agg.last_raw_measures_purged is not None
+
+    # The late measure is rejected by the regular and wildcard aggregates
+    add_raw_measure("enedis", 10)
+    aggregate_raw_measures(m_def, force=True)
+    aggs = query_aggregates()
+    assert (aggs["enedis"].count, aggs["enedis"].median) == (2, 2)
+    assert (aggs["*"].count, aggs["*"].median) == (3, 3)
+    refused = RefusedRawMeasure.query.filter(
+        RefusedRawMeasure.measure_name == measure_name
+    ).all()
+    assert [float(measure.value) for measure in refused] == [10]
+
+    RefusedRawMeasure.query.filter(
+        RefusedRawMeasure.measure_name == measure_name
+    ).delete()
+    Aggregation.query.filter(Aggregation.measure_name == measure_name).delete()
+    RawMeasure.query.filter(RawMeasure.measure_name == measure_name).delete()
+    AggregationDate.query.filter(
+        AggregationDate.measure_definition_id == m_def.id
+    ).delete()
+    db.session.delete(m_def)
+    db.session.commit()
@@ -0,0 +1,125 @@
+from dacc import db, registry
+from dacc.models import Auth, MeasureDefinition
+from dacc.registry import MeasureDefinitionRegistry, TokenRegistry
+
+
+def test_measure_definitions_registry(monkeypatch):
+    m_definitions = MeasureDefinitionRegistry(refresh_interval=60)
+    assert m_definitions.is_stale(None) is True
+
+    m_def = m_definitions.get("connection-count-daily")
+    assert m_definitions.version == 1
+    assert m_def.name == "connection-count-daily"
+    assert m_def.group1_key == "device"
+
+    # Served from memory
+    assert m_definitions.get("connection-count-daily") is m_def
+    assert m_definitions.get("fake-dummy") is None
+    assert m_definitions.version == 1
+
+    # New definitions are looked up in database
+    db.session.add(MeasureDefinition(name="dummy-registry"))
+    assert m_definitions.get("dummy-registry").name == "dummy-registry"
+
+    # Unknown names are remembered until the next load
+    db.session.add(MeasureDefinition(name="fake-dummy"))
+    assert m_definitions.get("fake-dummy") is None
+
+    m_definitions.invalidate()
+    assert m_definitions.get("fake-dummy").name == "fake-dummy"
+    assert m_definitions.version == 2
+
+    # Beyond the limit, the oldest unknown names are forgotten
+    monkeypatch.setattr(registry, "MAX_UNKNOWN_NAMES", 1)
+    assert m_definitions.get("fake-dummy-1") is None
+    assert m_definitions.get("fake-dummy-2") is None
+    db.session.add(MeasureDefinition(name="fake-dummy-1"))
+    db.session.add(MeasureDefinition(name="fake-dummy-2"))
+    assert m_definitions.get("fake-dummy-1").name == "fake-dummy-1"
+    assert m_definitions.get("fake-dummy-2") is None
+    assert m_definitions.version == 2
+
+    # The definitions are reloaded when the refresh interval is passed
+    m_definitions.refresh_interval = -1
+    m_definitions.get("fake-dummy")
+    assert m_definitions.version == 3
+
+    db.session.rollback()
+
+
+def test_token_registry(monkeypatch):
+    db.session.add(Auth(org="dummy-org", token="dummy-token"))
+    db.session.flush()
+    tokens = TokenRegistry(refresh_interval=60)
+    assert tokens.get_org("dummy-token") == "dummy-org"
+    assert tokens.version == 1
+    assert tokens.get_org(None) is None
+
+    # New tokens are looked up in database
+    db.session.add(Auth(org="new-org", token="new-token"))
+    assert tokens.get_org("new-token") == "new-org"
+
+    # Unknown tokens are remembered until the next load
+    assert tokens.get_org("bad-token") is None
+    db.session.add(Auth(org="bad-org", token="bad-token"))
+    assert tokens.get_org("bad-token") is None
+    tokens.invalidate()
+    assert tokens.get_org("bad-token") == "bad-org"
+    assert tokens.version == 2
+
+    # Beyond the limit, the oldest unknown tokens are forgotten
+    monkeypatch.setattr(registry, "MAX_UNKNOWN_TOKENS", 1)
+    assert tokens.get_org("fake-token-1") is None
+    db.session.add(Auth(org="late-org", token="late-token"))
+    assert tokens.get_org("late-token") == "late-org"
+    assert tokens.get_org("fake-token-2") is None
+    db.session.add(Auth(org="fake-org", token="fake-token-1"))
+    assert tokens.get_org("fake-token-1") == "fake-org"
+    assert tokens.version == 2
+
+    db.session.rollback()
+
+
+def test_token_registry_shared_version():
+    auth = Auth(org="dummy-org", token="dummy-token")
+    db.session.add(auth)
+    db.session.flush()
+    # Two processes, checking the shared version on each access
+    tokens = TokenRegistry(check_interval=0)
+    cli_tokens = TokenRegistry(check_interval=0)
+    assert tokens.get_org("dummy-token") == "dummy-org"
+    assert tokens.get_org("dummy-token") == "dummy-org"
+    assert tokens.version == 1
+
+    db.session.delete(auth)
+    cli_tokens.notify_change()
+    assert tokens.get_org("dummy-token") is None
+    assert tokens.version == 2
+
+    # Not checked again before the check interval
+    tokens.check_interval = 60
+    db.session.add(Auth(org="other-org", token="other-token"))
+    cli_tokens.notify_change()
+    assert tokens.get_org("dummy-token") is None
+    assert tokens.version == 2
+
+    db.session.rollback()
+
+
+def test_measure_definitions_registry_shared_version():
+    # Two processes, checking the shared version on each access
+    m_definitions = MeasureDefinitionRegistry(check_interval=0)
+    cli_definitions = MeasureDefinitionRegistry(check_interval=0)
+    m_def = m_definitions.get("connection-count-daily")
+    assert m_def.group1_key == "device"
+    assert m_definitions.version == 1
+
+    db_def = MeasureDefinition.query_by_name("connection-count-daily")
+    db_def.group1_key = "dummy-key"
+    cli_definitions.notify_change()
+    assert m_definitions.get("connection-count-daily").group1_key == (
+        "dummy-key"
+    )
+    assert m_definitions.version == 2
+
+    db.session.rollback()
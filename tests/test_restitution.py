@@ -1,7 +1,14 @@
-from dacc import db, restitution, aggregation
-from dacc.models import MeasureDefinition
+from dacc import db, restitution, aggregation, registry
+from dacc.models import (
+    Aggregation,
+    MeasureDefinition,
+    PeriodAggregation,
+    RawMeasure,
+)
 from tests.fixtures import fixtures
 from dateutil.parser import parse
+import numpy as np
+import pytest
 
 
 def insert_dummy(n_measures, n_days, measure_name, date, created_by="ecolyo"):
@@ -141,3 +148,210 @@ def test_restitute_quartiles():
     assert "median" in res[0]
     assert "firstQuartile" in res[0]
     assert "thirdQuartile" in res[0]
+
+
+def test_restitute_rollup():
+    measure_name = "dummy-restitute-rollup"
+    m_def = MeasureDefinition(
+        name=measure_name,
+        aggregation_threshold=3,
+        group1_key="slug",
+        group2_key="status",
+        with_quartiles=True,
+    )
+    db.session.add(m_def)
+    measures = [
+        ("2021-05-03", "enedis", "ok", 1),
+        ("2021-05-03", "enedis", "ok", 4),
+        ("2021-05-03", "grdf", "ok", 2),
+        ("2021-05-04", "grdf", "ko", 8),
+        ("2021-05-05", "grdf", "ok", 5),
+        ("2021-05-12", "enedis", "ok", 7),
+    ]
+    for start_date, slug, status, value in measures:
+        db.session.add(
+            RawMeasure(
+                measure_name=measure_name,
+                start_date=start_date,
+                value=value,
+                group1={"slug": slug},
+                group2={"status": status},
+            )
+        )
+    aggregation.aggregate_raw_measures(m_def, force=True)
+
+    p = {
+        "measureName": measure_name,
+        "startDate": "2021-05-01",
+        "endDate": "2021-06-01",
+    }
+    # No stored aggregate reaches the threshold
+    assert restitution.get_aggregated_results(p) == []
+
+    p["rollup"] = {"groups": ["group1", "group2"], "period": "week"}
+    res = restitution.get_aggregated_results(p)
+    # The second week does not reach the threshold
+    assert len(res) == 1
+    values = [1, 4, 2, 8, 5]
+    assert res[0]["startDate"] == parse("2021-05-03")
+    assert res[0]["group1"] == {"slug": "*"}
+    assert res[0]["group2"] == {"status": "*"}
+    assert res[0]["count"] == 5
+    assert res[0]["countNotZero"] == 5
+    assert res[0]["sum"] == 20
+    assert res[0]["min"] == 1
+    assert res[0]["max"] == 8
+    assert res[0]["avg"] == 4
+    # Rounded as the stored aggregates
+    assert float(res[0]["std"]) == pytest.approx(
+        np.std(values, ddof=1), abs=0.005
+    )
+    # The quartiles cannot be merged without quantile sketch
+    assert "median" not in res[0]
+
+    p["rollup"] = {"groups": ["group1"], "period": "month"}
+    res = restitution.get_aggregated_results(p)
+    assert len(res) == 1
+    assert res[0]["startDate"] == parse("2021-05-01")
+    assert res[0]["group1"] == {"slug": "*"}
+    assert res[0]["group2"] == {"status": "ok"}
+    assert res[0]["count"] == 5
+    assert res[0]["sum"] == 19
+
+    Aggregation.query.filter(Aggregation.measure_name == measure_name).delete()
+    RawMeasure.query.filter(RawMeasure.measure_name == measure_name).delete()
+    db.session.delete(m_def)
+    db.session.commit()
+
+
+def test_restitute_period_aggregates():
+    measure_name = "dummy-restitute-periods"
+    m_def = MeasureDefinition(
+        name=measure_name,
+        aggregation_threshold=2,
+        group1_key="slug",
+        rollup_periods=["week"],
+    )
+    db.session.add(m_def)
+    measures = [
+        ("2021-05-03", "enedis", 1),
+        ("2021-05-04", "enedis", 4),
+        ("2021-05-04", "grdf", 2),
+        ("2021-05-10", "grdf", 8),
+    ]
+    for start_date, slug, value in measures:
+        db.session.add(
+            RawMeasure(
+                measure_name=measure_name,
+                start_date=start_date,
+                value=value,
+                group1={"slug": slug},
+            )
+        )
+    aggregation.aggregate_raw_measures(m_def, force=True)
+
+    # The stored week aggregates are read
+    p = {
+        "measureName": measure_name,
+        "startDate": "2021-05-01",
+        "endDate": "2021-06-01",
+        "rollup": {"period": "week"},
+    }
+    res = restitution.get_aggregated_results(p)
+    assert len(res) == 1
+    assert res[0]["startDate"] == parse("2021-05-03")
+    assert res[0]["group1"] == {"slug": "enedis"}
+    assert (res[0]["count"], res[0]["sum"]) == (2, 5)
+
+    # The week aggregates are rolled up on the groups
+    p["rollup"]["groups"] = ["group1"]
+    res = restitution.get_aggregated_results(p)
+    assert len(res) == 1
+    assert res[0]["startDate"] == parse("2021-05-03")
+    assert res[0]["group1"] == {"slug": "*"}
+    assert (res[0]["count"], res[0]["sum"]) == (3, 7)
+
+    # The aggregates themselves are not read
+    Aggregation.query.filter(Aggregation.measure_name == measure_name).delete()
+    assert restitution.get_aggregated_results(p) == res
+
+    PeriodAggregation.query.filter(
+        PeriodAggregation.measure_name == measure_name
+    ).delete()
+    RawMeasure.query.filter(RawMeasure.measure_name == measure_name).delete()
+    db.session.delete(m_def)
+    db.session.commit()
+
+
+def test_restitute_rollup_bounds():
+    names = {
+        "stored": "dummy-rollup-bounds-stored",
+        "merged": "dummy-rollup-bounds-merged",
+    }
+    m_defs = {}
+    for path, name in names.items():
+        m_defs[path] = MeasureDefinition(
+            name=name,
+            aggregation_threshold=1,
+            group1_key="slug",
+            rollup_periods=["week"] if path == "stored" else None,
+        )
+        db.session.add(m_defs[path])
+        for start_date, slug, value in [
+            ("2021-05-04", "enedis", 1),
+            ("2021-05-06", "grdf", 2),
+            ("2021-05-11", "enedis", 3),
+            ("2021-05-13", "enedis", 4),
+        ]:
+            db.session.add(
+                RawMeasure(
+                    measure_name=name,
+                    start_date=start_date,
+                    value=value,
+                    group1={"slug": slug},
+                )
+            )
+        aggregation.aggregate_raw_measures(m_defs[path], force=True)
+
+    def get_results(path, groups):
+        # Both bounds are within a week
+        results = restitution.get_aggregated_results(
+            {
+                "measureName": names[path],
+                "startDate": "2021-05-05",
+                "endDate": "2021-05-12",
+                "rollup": {"groups": groups, "period": "week"},
+            }
+        )
+        for res in results:
+            del res["measureName"]
+        return results
+
+    for groups in [[], ["group1"]]:
+        stored = get_results("stored", groups)
+        merged = get_results("merged", groups)
+        assert stored == merged
+        # The weeks at the bounds are whole
+        assert sorted(set(res["startDate"] for res in stored)) == [
+            parse("2021-05-03"),
+            parse("2021-05-10"),
+        ]
+        assert sum(res["count"] for res in stored) == 4
+        assert sum(res["sum"] for res in stored) == 10
+
+    # No aggregate reaches an undefined threshold
+    m_defs["merged"].aggregation_threshold = None
+    db.session.commit()
+    registry.measure_definitions.invalidate()
+    assert get_results("merged", ["group1"]) == []
+
+    for name in names.values():
+        for model, column in [
+            (PeriodAggregation, PeriodAggregation.measure_name),
+            (Aggregation, Aggregation.measure_name),
+            (RawMeasure, RawMeasure.measure_name),
+        ]:
+            model.query.filter(column == name).delete()
+    for m_def in m_defs.values():
+        db.session.delete(m_def)
+    db.session.commit()
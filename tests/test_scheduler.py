@@ -0,0 +1,131 @@
+from dacc import db, scheduler
+from dacc.models import (
+    Aggregation,
+    AggregationDate,
+    MeasureDefinition,
+    RawMeasure,
+)
+from datetime import datetime, timedelta
+import threading
+
+MEASURE_NAMES = ["dummy-parallel-1", "dummy-parallel-2"]
+
+
+def test_aggregate_measures():
+    for name in MEASURE_NAMES:
+        db.session.add(
+            MeasureDefinition(
+                name=name,
+                aggregation_period="day",
+                execution_frequency="day",
+                aggregation_threshold=0,
+            )
+        )
+        for value in [1, 2, 3]:
+            db.session.add(
+                RawMeasure(
+                    measure_name=name, value=value, start_date="2021-05-01"
+                )
+            )
+    db.session.commit()
+
+    results = scheduler.aggregate_measures(
+        MEASURE_NAMES + ["fake-dummy"], jobs=2
+    )
+    results = {r["measure_name"]: r for r in results}
+    assert len(results) == 3
+    for name in MEASURE_NAMES:
+        assert results[name]["error"] is None
+        assert results[name]["aggregates"] == 1
+    assert results["fake-dummy"]["error"] == "No measure definition found"
+
+    for name in MEASURE_NAMES:
+        agg = Aggregation.query.filter(Aggregation.measure_name == name).one()
+        assert agg.count == 3
+        assert agg.sum == 6
+
+    # Nothing new to aggregate
+    result = scheduler.aggregate_measure(MEASURE_NAMES[0])
+    assert result["error"] is None
+    assert result["aggregates"] is None
+
+    for model, column in [
+        (Aggregation, Aggregation.measure_name),
+        (RawMeasure, RawMeasure.measure_name),
+        (MeasureDefinition, MeasureDefinition.name),
+    ]:
+        model.query.filter(column.in_(MEASURE_NAMES)).delete(
+            synchronize_session=False
+        )
+    db.session.commit()
+
+
+def test_get_next_run_date():
+    date = datetime(2021, 5, 1)
+    assert scheduler.get_next_run_date("week", None) == datetime.min
+    assert scheduler.get_next_run_date("day", date) == datetime(2021, 5, 2)
+    assert scheduler.get_next_run_date("week", date) == datetime(2021, 5, 8)
+    assert scheduler.get_next_run_date(None, date) == datetime(2021, 5, 2)
+
+
+def test_aggregation_daemon():
+    due_names = ["dummy-daemon-1", "dummy-daemon-2"]
+    names = due_names + ["dummy-daemon-later"]
+    for name in names:
+        m_def = MeasureDefinition(
+            name=name,
+            aggregation_period="day",
+            execution_frequency="week",
+            aggregation_threshold=0,
+        )
+        db.session.add(m_def)
+        db.session.add(
+            RawMeasure(measure_name=name, value=2, start_date="2021-05-01")
+        )
+    # Aggregated less than a week ago, hence not due
+    db.session.add(
+        AggregationDate(
+            measure_definition=m_def,
+            last_aggregated_measure_date=datetime.now() - timedelta(days=1),
+        )
+    )
+    db.session.commit()
+
+    results = []
+    stopped = threading.Event()
+
+    def on_result(result):
+        results.append(result)
+        if len(results) == len(due_names):
+            stopped.set()
+
+    daemon = scheduler.AggregationDaemon(
+        jobs=2, measure_names=names, poll_interval=1, on_result=on_result
+    )
+    thread = threading.Thread(target=daemon.run, args=(stopped,))
+    thread.start()
+    thread.join(timeout=30)
+    stopped.set()
+    thread.join()
+
+    assert sorted(r["measure_name"] for r in results) == due_names
+    for result in results:
+        assert result["error"] is None
+        assert result["aggregates"] == 1
+    next_runs = daemon.next_run_dates()
+    # The aggregated measures are due a week after their last measure
+    for name in due_names:
+        assert next_runs[name] > datetime.now() + timedelta(days=6)
+    assert next_runs["dummy-daemon-later"] < datetime.now() + timedelta(days=6)
+    assert (
+        Aggregation.query.filter(Aggregation.measure_name == names[2]).count()
+        == 0
+    )
+
+    for model, column in [
+        (Aggregation, Aggregation.measure_name),
+        (RawMeasure, RawMeasure.measure_name),
+        (MeasureDefinition, MeasureDefinition.name),
+    ]:
+        model.query.filter(column.in_(names)).delete(synchronize_session=False)
+    db.session.commit()
@@ -0,0 +1,50 @@
+from dacc.sketch import QuantileSketch
+import numpy as np
+import pytest
+
+
+def test_exact_quantiles():
+    rng = np.random.default_rng(42)
+    for n in [1, 2, 5, 42, 100]:
+        values = rng.integers(0, 50, n).tolist()
+        sketch = QuantileSketch.from_values(values)
+        assert sketch.exact is True
+        assert sketch.count == n
+        for q in [0, 0.25, 0.5, 0.75, 1]:
+            assert sketch.quantile(q) == np.quantile(values, q)
+
+        # Merging keeps the quantiles exact
+        half = n // 2
+        merged = QuantileSketch.from_values(values[:half]).merge(
+            QuantileSketch.from_values(values[half:])
+        )
+        for q in [0.25, 0.5, 0.75]:
+            assert merged.quantile(q) == np.quantile(values, q)
+
+    assert QuantileSketch().quantile(0.5) is None
+
+
+def test_approximate_quantiles():
+    values = np.random.default_rng(42).normal(100, 20, 50000)
+    sketch = QuantileSketch()
+    for part in np.array_split(values, 50):
+        sketch = sketch.merge(QuantileSketch.from_values(part))
+
+    assert sketch.exact is False
+    assert sketch.count == 50000
+    assert len(sketch.centroids) <= sketch.compression
+    assert sketch.min == values.min()
+    assert sketch.max == values.max()
+    for q in [0.01, 0.25, 0.5, 0.75, 0.99]:
+        assert sketch.quantile(q) == pytest.approx(
+            np.quantile(values, q), rel=0.01
+        )
+
+
+def test_sketch_json():
+    sketch = QuantileSketch.from_values([3, 1, 2, 2])
+    data = sketch.to_json()
+    assert data["centroids"] == [[1, 1], [2, 2], [3, 1]]
+    copy = QuantileSketch.from_json(data)
+    assert copy.quantile(0.5) == sketch.quantile(0.5) == 2
+    assert QuantileSketch.from_json(None) is None
@@ -0,0 +1,54 @@
+from dacc import db, insertion, staging, configdata
+from dacc.models import RawMeasure, RawMeasureStaging
+
+
+def query_measures(model, measure_name):
+    return db.session.query(model).filter(model.measure_name == measure_name)
+
+
+def insert_staged_measures(monkeypatch, measure_name, n_measures):
+    monkeypatch.setitem(configdata._config, "ingestion", {"staging": True})
+    measure = {
+        "measureName": measure_name,
+        "value": 42,
+        "startDate": "2021-05-01",
+        "group1": {"device": "mobile"},
+    }
+    insertion.insert_raw_measures([measure] * n_measures)
+
+
+def test_insert_staged_measures(monkeypatch):
+    measure_name = "dummy-staging-insert"
+    insert_staged_measures(monkeypatch, measure_name, 3)
+    assert query_measures(RawMeasureStaging, measure_name).count() == 3
+    assert query_measures(RawMeasure, measure_name).count() == 0
+
+    query_measures(RawMeasureStaging, measure_name).delete()
+    db.session.commit()
+
+
+def test_merge_staged_measures(monkeypatch):
+    measure_name = "dummy-staging-merge"
+    insert_staged_measures(monkeypatch, measure_name, 5)
+    insert_staged_measures(monkeypatch, "dummy-staging-other", 1)
+
+    n_moved = staging.merge_staged_measures(measure_name, batch_size=2)
+    assert n_moved == 5
+    assert query_measures(RawMeasureStaging, measure_name).count() == 0
+    other_name = "dummy-staging-other"
+    assert query_measures(RawMeasureStaging, other_name).count() == 1
+
+    measures = query_measures(RawMeasure, measure_name).all()
+    assert len(measures) == 5
+    assert measures[0].value == 42
+    assert measures[0].group1 == {"device": "mobile"}
+    assert measures[0].last_updated is not None
+
+    # Without measure name, all the staged measures are moved
+    staging.merge_staged_measures()
+    assert db.session.query(RawMeasureStaging).count() == 0
+    assert query_measures(RawMeasure, other_name).count() == 1
+
+    for name in (measure_name, other_name):
+        query_measures(RawMeasure, name).delete()
+    db.session.commit()
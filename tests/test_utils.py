@@ -1,5 +1,7 @@
 from dacc import utils
 from dateutil.parser import parse
+from datetime import datetime, timezone
+import pytest
 
 
 def test_is_date_interval_higher():
@@ -35,3 +37,39 @@ def test_to_camel_case():
 
     str4 = "alreadyCamelCase"
     assert utils.to_camel_case(str4) == "alreadyCamelCase"
+
+
+def test_parse_date():
+    assert utils.parse_date("2021-05-01") == datetime(2021, 5, 1)
+    assert utils.parse_date("2021-05-01T10:20:30.123") == datetime(
+        2021, 5, 1, 10, 20, 30, 123000
+    )
+    assert utils.parse_date("2021-05-01T10:00:00Z") == datetime(
+        2021, 5, 1, 10, tzinfo=timezone.utc
+    )
+    # Not ISO 8601, parsed by dateutil
+    assert utils.parse_date("May 1 2021 10:00") == datetime(2021, 5, 1, 10)
+    with pytest.raises(ValueError):
+        utils.parse_date("not-a-date")
+    with pytest.raises(ValueError):
+        utils.parse_date(1234)
+
+
+def test_truncate_date():
+    date = datetime(2021, 5, 13, 10, 20, 30)  # A Thursday
+    assert utils.truncate_date(date, "day") == datetime(2021, 5, 13)
+    assert utils.truncate_date(date, "week") == datetime(2021, 5, 10)
+    assert utils.truncate_date(date, "month") == datetime(2021, 5, 1)
+    assert utils.truncate_date(datetime(2021, 5, 1), "week") == datetime(
+        2021, 4, 26
+    )
+
+
+def test_get_period_end():
+    date = datetime(2021, 12, 16, 10, 20, 30)  # A Thursday
+    assert utils.get_period_end(date, "day") == datetime(2021, 12, 17)
+    assert utils.get_period_end(date, "week") == datetime(2021, 12, 20)
+    assert utils.get_period_end(date, "month") == datetime(2022, 1, 1)
+    # The start of a period is already its end
+    date = datetime(2021, 12, 20)
+    assert utils.get_period_end(date, "week") == date
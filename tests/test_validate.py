@@ -1,5 +1,6 @@
 import pytest
-from dacc import validate, db
+from datetime import datetime
+from dacc import validate, db, registry, insertion
 from dacc.models import MeasureDefinition
 from dacc.exceptions import AccessException, ValidationException
 
@@ -30,6 +31,10 @@ def test_check_incoming_raw_measure():
         m, "value type is incorrect, it must be a number"
     )
 
+    for value in [1e10, -1e10, "1e10", float("nan"), float("inf")]:
+        m = {"measureName": "connection-count-daily", "value": value}
+        assert_raw_measure_exception(m, "value is out of range")
+
     m = {"measureName": "connection-count-daily", "value": 42}
     assert_raw_measure_exception(m, "startDate must be given")
 
@@ -99,12 +104,90 @@ def test_check_incoming_raw_measure():
     assert validate.check_incoming_raw_measure(m) is True
 
 
+def test_check_incoming_raw_measure_timezone():
+    m = {
+        "measureName": "connection-count-daily",
+        "value": 42,
+        "startDate": "2021-05-01T10:00:00+02:00",
+        "group1": {"device": "desktop"},
+    }
+    assert validate.check_incoming_raw_measure(m) is True
+    # The offset is dropped, as PostgreSQL does for a TIMESTAMP column
+    assert m["startDate"] == datetime(2021, 5, 1, 10)
+
+
+def test_check_incoming_raw_measures():
+    with pytest.raises(ValidationException) as e_info:
+        validate.check_incoming_raw_measures({"measureName": "dummy"})
+    assert "The measures must be given as a list" in str(e_info.value)
+
+    with pytest.raises(ValidationException) as e_info:
+        validate.check_incoming_raw_measures([])
+    assert "The measures cannot be empty" in str(e_info.value)
+
+    with pytest.raises(ValidationException) as e_info:
+        validate.check_incoming_raw_measures([{}, {}], max_measures=1)
+    assert "Too many measures" in str(e_info.value)
+
+    valid_measure = {
+        "measureName": "connection-count-daily",
+        "value": 42,
+        "startDate": "2021-05-01",
+        "group1": {"device": "desktop"},
+    }
+    measures = [
+        valid_measure,
+        "not-a-measure",
+        {"measureName": "fake-dummy", "value": 42},
+        {
+            "measureName": "konnector-event-daily",
+            "value": 42,
+            "startDate": "2021-05-01",
+            "group1": {"slug": "enedis"},
+            "group2": {"event_type": "connexion"},
+            "group3": {"status": "success"},
+        },
+    ]
+    valid, errors = validate.check_incoming_raw_measures(measures)
+    assert len(valid) == 2
+    assert valid[0] == valid_measure
+    assert valid[1]["measureName"] == "konnector-event-daily"
+    assert len(errors) == 2
+    assert errors[0]["index"] == 1
+    assert errors[0]["error"] == "The measure format is incorrect"
+    assert errors[1]["index"] == 2
+    assert "No measure definition found for: fake-dummy" in (
+        errors[1]["error"]
+    )
+
+
 def assert_restitution_exception(m, exception_value):
     with pytest.raises(ValidationException) as e_info:
         validate.check_restitution_params(m)
     assert exception_value in str(e_info.value)
 
 
+def test_get_validator():
+    m_def = registry.measure_definitions.get("connection-count-daily")
+    validator = validate.get_validator(m_def)
+    assert validator.groups == (
+        ("group1", "Group1", "device"),
+        ("group2", "Group2", None),
+        ("group3", "Group3", None),
+    )
+    # The validator is compiled once per definition
+    assert validate.get_validator(m_def) is validator
+
+    registry.measure_definitions.invalidate()
+    m_def = registry.measure_definitions.get("connection-count-daily")
+    assert validate.get_validator(m_def) is not validator
+
+    m = {"measureName": "connection-count-daily", "value": None}
+    with pytest.raises(ValidationException) as e_info:
+        validator.validate(m)
+    assert "value type is incorrect" in str(e_info.value)
+
+
 def test_check_restitution_params():
 
     m_def = MeasureDefinition(
@@ -153,6 +236,87 @@ def test_check_restitution_params():
     }
     assert validate.check_restitution_params(p) is True
 
+    p["rollup"] = ["group1"]
+    assert_restitution_exception(p, "The rollup must be an object")
+
+    p["rollup"] = {"groups": ["group4"]}
+    assert_restitution_exception(
+        p, "The rollup groups must be a list of group1, group2, group3"
+    )
+
+    p["rollup"] = {"groups": ["group1"], "period": "year"}
+    assert_restitution_exception(
+        p, "The rollup period must be one of: day, week, month"
+    )
+
+    p["rollup"] = {"groups": ["group1"], "period": "month"}
+    assert validate.check_restitution_params(p) is True
+
+
+def test_check_rollup_periods():
+    validate.check_rollup_periods(None, "day")
+    validate.check_rollup_periods(["week", "month"], "day")
+    # Without aggregation period, only the periods themselves are checked
+    validate.check_rollup_periods(["week"], None)
+
+    with pytest.raises(ValidationException) as e_info:
+        validate.check_rollup_periods("month", "day")
+    assert "The rollup periods must be a list" in str(e_info.value)
+
+    with pytest.raises(ValidationException) as e_info:
+        validate.check_rollup_periods(["week", "year"], "day")
+    assert "The rollup period must be one of" in str(e_info.value)
+
+    for period in ["day", "week"]:
+        with pytest.raises(ValidationException) as e_info:
+            validate.check_rollup_periods([period], "week")
+        assert "must be coarser than the aggregation period: week" in str(
+            e_info.value
+        )
+
+    # A week can straddle two months
+    with pytest.raises(ValidationException) as e_info:
+        validate.check_rollup_periods(["month"], "week")
+    assert "cannot be rolled up by month" in str(e_info.value)
+
+    # Not inserted
+    definition = {
+        "name": "dummy-weekly-rollup",
+        "aggregationPeriod": "week",
+        "rollupPeriods": ["month"],
+    }
+    assert insertion.insert_measure_definition(definition) is None
+    assert MeasureDefinition.query_by_name("dummy-weekly-rollup") is None
+
+
+def test_check_restitution_rollup_period():
+    m_def = MeasureDefinition(
+        name="dummy-weekly-params",
+        aggregation_period="week",
+        aggregation_threshold=5,
+        access_app=True,
+    )
+    db.session.add(m_def)
+    p = {
+        "measureName": "dummy-weekly-params",
+        "startDate": "2021-05-03",
+        "endDate": "2021-06-07",
+        "rollup": {"groups": ["group1"]},
+    }
+    assert validate.check_restitution_params(p) is True
+
+    p["rollup"] = {"groups": ["group1"], "period": "week"}
+    assert_restitution_exception(
+        p, "The rollup period must be coarser than the aggregation period"
+    )
+
+    p["rollup"] = {"groups": ["group1"], "period": "month"}
+    assert_restitution_exception(
+        p, "The weekly aggregates cannot be rolled up by month"
+    )
+
+    db.session.rollback()
+
 
 def test_check_restitution_access():
     m_def = MeasureDefinition(